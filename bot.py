@@ -5,7 +5,8 @@ import sys
 
 # 1. Налаштування Django (Обов'язково на самому початку)
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "coursebot.settings")
-os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+# The bot works with a connection pool (see DATABASES in settings), the admin does not
+os.environ.setdefault("DJANGO_DB_POOL", "1")
 
 import django
 django.setup()
@@ -18,37 +19,108 @@ from aiogram.fsm.storage.redis import RedisStorage
 from redis.asyncio import Redis
 
 # Імпортуємо наш новий планувальник
-from services.scheduler import scheduler_loop
+from services.scheduler import scheduler, scheduler_loop
+from services import botcache, catalog, dbpool, events, faq_index
+from services.dedup import DedupMiddleware
+from services.fsm_storage import CachedStorage, CompactRedisStorage, FlushMiddleware
+from services.identity import UserMiddleware, identity
+from services.pipeline import pipeline
+from services.throttling import ThrottlingMiddleware, missing_codes
+from services.update_stream import IngestMiddleware, OrderedDispatcher, UpdateConsumer
+from services.webhook import run_webhook
 
-from config import BOT_TOKEN
+from config import (
+    BOT_MODE, BOT_ROLE, BOT_TOKEN, DEDUP_TTL, DROP_PENDING_UPDATES, FSM_CACHE_SIZE, FSM_STORAGE,
+    REDIS_HOST, REDIS_PORT, SCHEDULER_WORKER_ID, UPDATE_CONCURRENCY, UPDATE_QUEUE,
+)
 from handlers import common, registration, learning, support, faq
 
 async def main():
     # --- REDIS CONFIGURATION ---
     # If running in Docker, the host will be ‘redis’.
-    redis_host = os.getenv("REDIS_HOST", "localhost")
-    redis = Redis(host=redis_host, port=6379, db=0)
+    redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
 
     ONE_MONTH = 30 * 24 * 60 * 60
     
-    storage = RedisStorage(
-        redis=redis,
-        state_ttl=ONE_MONTH, 
-        data_ttl=ONE_MONTH
-    )
+    if FSM_STORAGE == "compact":
+        # One msgpack hash per user; users saved in the old two-key layout are moved over once
+        storage = CompactRedisStorage(redis=redis, ttl=ONE_MONTH)
+        moved = await storage.migrate_legacy_keys()
+        if moved:
+            print(f"🧠 FSM: {moved} старых ключей перенесено в хэши")
+    else:
+        storage = RedisStorage(
+            redis=redis,
+            state_ttl=ONE_MONTH, 
+            data_ttl=ONE_MONTH
+        )
+    if FSM_CACHE_SIZE:
+        # Active users' states are served from memory, writes of one update go to Redis in one pipeline
+        storage = CachedStorage(storage)
 
     # --- BOT & DISPATCHER ---
-    dp = Dispatcher(storage=storage)
+    # The updates of one user are handled one after another (FSM read-modify-write stays consistent)
+    dp = OrderedDispatcher(storage=storage)
                     
     bot = Bot(
         token=BOT_TOKEN, 
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
 
+    # All outgoing lesson messages go through one rate-limited queue
+    pipeline.start()
+    asyncio.create_task(pipeline.report_loop())
+
+    # Every update gives its DB connection back to the pool
+    dp.update.outer_middleware(dbpool.ReleaseConnectionMiddleware())
+    if DEDUP_TTL:
+        # Redelivered updates (polling restart, webhook retry, stream reclaim) are handled once
+        dedup = DedupMiddleware(redis)
+        dp.update.outer_middleware(dedup)
+        asyncio.create_task(dedup.report_loop())
+    if isinstance(storage, CachedStorage):
+        dp.update.outer_middleware(FlushMiddleware(storage))
+        asyncio.create_task(storage.report_loop())
+    # Anti-flood before any handler touches the DB (the FSM state is already known here)
+    throttling = ThrottlingMiddleware(redis)
+    dp.update.outer_middleware(throttling)
+    asyncio.create_task(throttling.report_loop())
+    missing_codes.connect(redis)
+    # The sender's BotUser from the identity cache, passed to the handlers as bot_user
+    identity.start()
+    dp.update.outer_middleware(UserMiddleware(identity))
+    asyncio.create_task(identity.flush_loop())
+    asyncio.create_task(identity.report_loop())
+    asyncio.create_task(dbpool.report_loop())
+    asyncio.create_task(botcache.report_loop())
+
     # --- 🔥 ГОЛОВНА ЗМІНА: ПЛАНУВАЛЬНИК ---
     # Ми прибрали APScheduler, бо він конфліктував.
-    # Запускаємо наш новий цикл як фонове завдання.
-    asyncio.create_task(scheduler_loop(bot))
+    # Запускаємо наш новий цикл як фонове завдання (спить до найближчого due_at).
+    # Можна запускати кілька воркерів: кожен захоплює свої рядки плану (SKIP LOCKED).
+    scheduler_task = asyncio.create_task(scheduler_loop(bot, dp))
+
+    # Courses and lessons are kept in memory, loaded once at startup
+    await catalog.aload()
+
+    # Events from the admin container (lesson edits etc.) wake the scheduler up / refresh the catalog
+    event_handlers = {
+        events.SCHEDULE_CHANGED: scheduler.wake,
+        events.CATALOG_CHANGED: catalog.invalidate,
+        events.TEXTS_CHANGED: botcache.invalidate,
+        events.FAQ_CHANGED: faq_index.invalidate,
+        events.USERS_CHANGED: identity.on_remote_change,
+    }
+    if isinstance(storage, CachedStorage):
+        # FSM writes of other processes (scheduler replicas, workers)
+        event_handlers[events.FSM_CHANGED] = storage.on_remote_change
+    asyncio.create_task(events.listen(redis, event_handlers))
+
+    if BOT_ROLE == "scheduler":
+        # Extra delivery worker: only one process may poll Telegram for updates
+        print(f"🚀 Воркер розсилки запущено ({SCHEDULER_WORKER_ID})")
+        await scheduler_task
+        return
 
     # --- ROUTERS ---
     dp.include_router(faq.router)
@@ -61,9 +133,30 @@ async def main():
     # Але поки залишаємо.
     dp.include_router(learning.router)
     
+    if BOT_ROLE == "worker":
+        # Handles the updates the receiving process put into Redis Streams (UPDATE_QUEUE=stream)
+        consumer = UpdateConsumer(dp, bot, redis)
+        asyncio.create_task(consumer.report_loop())
+        print(f"🚀 Воркер апдейтов запущено ({SCHEDULER_WORKER_ID})")
+        await consumer.run()
+        return
+
+    receiver = dp
+    if UPDATE_QUEUE == "stream":
+        # This process only receives updates and appends them to the streams, workers handle them
+        receiver = Dispatcher()
+        receiver.update.outer_middleware(IngestMiddleware(redis))
+    allowed_updates = dp.resolve_used_update_types()
+
     print("🚀 Бот запущено з підтримкою Multi-Course!")
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        # Telegram pushes updates to our HTTP server; acked at once, handled in the background
+        await run_webhook(receiver, bot, allowed_updates)
+        return
+
+    # Fallback: long polling (only one process may poll)
+    await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+    await receiver.start_polling(bot, tasks_concurrency_limit=UPDATE_CONCURRENCY, allowed_updates=allowed_updates)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
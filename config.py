@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -8,4 +9,96 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 # Telegram admin user id
-ADMIN_ID = int(os.getenv("ADMIN_ID"))
\ No newline at end of file
+ADMIN_ID = int(os.getenv("ADMIN_ID"))
+
+# Redis (FSM storage + events between the bot and the admin containers)
+# If running in Docker, the host will be ‘redis’.
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+# Scheduler catch-up after restarts/stalls
+# Lessons missed longer ago than this are not sent anymore (status "skipped")
+SCHEDULER_CATCHUP_HOURS = float(os.getenv("SCHEDULER_CATCHUP_HOURS", "6"))
+# Backlog is drained in small batches with a pause, so Telegram is not flooded
+SCHEDULER_CATCHUP_BATCH = int(os.getenv("SCHEDULER_CATCHUP_BATCH", "50"))
+SCHEDULER_CATCHUP_PAUSE = float(os.getenv("SCHEDULER_CATCHUP_PAUSE", "2"))
+# A block that failed because Telegram or the network was down is tried again after this long
+SCHEDULER_RETRY_SECONDS = int(os.getenv("SCHEDULER_RETRY_SECONDS", "300"))
+
+# Outgoing messages (Telegram limits: ~30 msg/s in total, ~1 msg/s per chat)
+SEND_RATE = float(os.getenv("SEND_RATE", "25"))
+SEND_PER_CHAT_INTERVAL = float(os.getenv("SEND_PER_CHAT_INTERVAL", "1"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "16"))
+
+# Several scheduler workers (processes/hosts) share the delivery plan.
+# Every worker claims rows for SCHEDULER_LEASE_SECONDS and extends the lease while sending.
+SCHEDULER_WORKER_ID = os.getenv("SCHEDULER_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+SCHEDULER_LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", "300"))
+
+# BotMessage/BotSettings are cached in memory and refreshed on admin edits (events);
+# the TTL (seconds) is a safety net in case an event is lost
+BOT_CACHE_TTL = float(os.getenv("BOT_CACHE_TTL", "600"))
+# Courses/lessons snapshot: reloaded on change events, the TTL (seconds) is a safety net for a lost event
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", "600"))
+
+# "all" - polling + scheduler, "scheduler" - only lesson delivery (extra replicas),
+# "worker" - handles updates from the Redis stream (UPDATE_QUEUE=stream) + lesson delivery
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
+
+# Updates: "polling" (getUpdates, one process) or "webhook" (Telegram POSTs updates to our HTTP server)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Public HTTPS address Telegram calls, e.g. https://bot.example.com (path is added below)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Telegram sends it in X-Telegram-Bot-Api-Secret-Token; requests without it are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Parallel HTTPS connections Telegram opens to the webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Updates processed at the same time (both modes); further updates wait for a free slot
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "100"))
+# Drop updates that arrived while the bot was down (students' answers would be lost)
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+
+# "local" - updates are handled in the receiving process,
+# "stream" - it only appends them to Redis Streams, BOT_ROLE=worker processes handle them
+UPDATE_QUEUE = os.getenv("UPDATE_QUEUE", "local")
+# One stream per partition; a user always lands in the same partition (order of their updates is kept)
+UPDATE_PARTITIONS = int(os.getenv("UPDATE_PARTITIONS", "16"))
+# A worker owns its partitions for this long and renews them; a crashed worker's partitions move on after it
+UPDATE_LEASE_SECONDS = float(os.getenv("UPDATE_LEASE_SECONDS", "15"))
+# A handler running longer is cancelled. A partition taken over from a stalled/crashed worker
+# waits this long before its unacknowledged entries are handled again (the old handlers are over by then)
+UPDATE_HANDLE_TIMEOUT = float(os.getenv("UPDATE_HANDLE_TIMEOUT", "60"))
+# Memory all update streams together may take (MB). Each partition is trimmed to its share,
+# counted in entries from the average update size (old, already handled entries go first).
+# Redis runs with noeviction, so this budget plus FSM states must stay below its maxmemory.
+UPDATE_STREAM_MAX_MB = float(os.getenv("UPDATE_STREAM_MAX_MB", "32"))
+
+# FSM states/data of active users are kept in process memory in front of Redis (0 - off).
+# Other processes' writes arrive as events; the TTL (seconds) is a safety net for a lost event.
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "300"))
+# "compact" - one msgpack hash per user, "json" - aiogram's RedisStorage (two JSON keys per user)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "compact")
+
+# Anti-flood: token bucket per user and handler group (rate - tokens per second, burst - bucket size).
+# "code" - access code attempts, "answer" - quiz/text answers, "default" - everything else
+THROTTLE_RULES = {
+    'code': (float(os.getenv("THROTTLE_CODE_RATE", "0.1")), int(os.getenv("THROTTLE_CODE_BURST", "5"))),
+    'answer': (float(os.getenv("THROTTLE_ANSWER_RATE", "1")), int(os.getenv("THROTTLE_ANSWER_BURST", "8"))),
+    'default': (float(os.getenv("THROTTLE_DEFAULT_RATE", "2")), int(os.getenv("THROTTLE_DEFAULT_BURST", "20"))),
+}
+# Access codes that were just tried and don't exist are answered without the DB for this long (seconds)
+MISSING_CODE_TTL = int(os.getenv("MISSING_CODE_TTL", "300"))
+# Processed update_ids are remembered this long (seconds, 0 - off): redelivered updates are skipped
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "86400"))
+# BotUser rows of active students kept in memory (0 - off) and for how long (seconds)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+# Changed usernames/first names are written in one batch this often (seconds)
+USER_REFRESH_EVERY = int(os.getenv("USER_REFRESH_EVERY", "30"))
+# The bot keeps its pooled DB connection between updates and returns it to the pool
+# (where it is health-checked) this often (seconds), or at once after a database error
+DB_RELEASE_EVERY = float(os.getenv("DB_RELEASE_EVERY", "60"))
@@ -1,8 +1,17 @@
 import csv
+import io
+import itertools
+from django import forms
 from django.contrib import admin, messages
 from django.contrib.auth.models import Group
-from django.http import HttpResponse
-from .models import BotMessage, Course, Lesson, AccessCode, BotUser, FAQItem, Enrollment
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.utils import timezone
+from .models import BotMessage, Course, Lesson, AccessCode, BotUser, FAQItem, Enrollment, ScheduledDelivery, SupportTicket, SupportMessage
+from services import codes
+from services.tickets import format_duration
+from services.media import MEDIA_FIELDS, forget as forget_media
+from services.planner import plan_enrollments, replan_blocks, replan_course
 
 # It's a simple registration process
 
@@ -56,12 +65,84 @@ def duplicate_course(modeladmin, request, queryset):
         messages.SUCCESS
     )
 
+class CodeBatchForm(forms.Form):
+    count = forms.IntegerField(label="Сколько кодов создать", min_value=1, max_value=100000, required=False)
+    length = forms.IntegerField(label="Длина кода", min_value=4, max_value=20, initial=codes.DEFAULT_LENGTH)
+    alphabet = forms.CharField(label="Алфавит", initial=codes.DEFAULT_ALPHABET)
+    prefix = forms.CharField(label="Префикс", required=False, max_length=10)
+    file = forms.FileField(
+        label="...или импортировать готовый список",
+        required=False,
+        help_text="Текст/CSV: по коду в строке (первая колонка). Уже существующие коды пропускаются.",
+    )
+
+    def clean(self):
+        data = super().clean()
+        if not data.get('count') and not data.get('file'):
+            raise forms.ValidationError("Укажите количество кодов или файл для импорта.")
+        return data
+
+
+class Echo:
+    # csv.writer writes into it, the streaming response sends every line right away
+    def write(self, value):
+        return value
+
+
+@admin.action(description="🔑 Сгенерировать / импортировать коды доступа")
+def generate_access_codes(modeladmin, request, queryset):
+    course_ids = list(queryset.values_list('id', flat=True))
+    form = CodeBatchForm(request.POST, request.FILES) if 'apply' in request.POST else CodeBatchForm()
+
+    if 'apply' in request.POST and form.is_valid():
+        data = form.cleaned_data
+        if data['file']:
+            lines = io.TextIOWrapper(data['file'].file, encoding='utf-8-sig', newline='')
+            stats = codes.import_codes(lines, course_ids)
+            modeladmin.message_user(
+                request,
+                f"Импортировано: {stats['created']}, уже были: {stats['existing']}, некорректных: {stats['invalid']}.",
+                messages.SUCCESS,
+            )
+            return None
+
+        try:
+            batches = codes.generate_codes(data['count'], course_ids, data['alphabet'], data['length'], data['prefix'])
+            first = next(batches)       # parameter errors show up before the download starts
+        except (ValueError, RuntimeError) as e:
+            form.add_error(None, str(e))
+        else:
+            def rows():
+                writer = csv.writer(Echo())
+                yield writer.writerow(['code'])
+                for batch in itertools.chain([first], batches):
+                    for code in batch:
+                        yield writer.writerow([code])
+
+            response = StreamingHttpResponse(rows(), content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename=access_codes.csv'
+            return response
+
+    return TemplateResponse(request, 'admin/core/course/generate_codes.html', {
+        **modeladmin.admin_site.each_context(request),
+        'title': "Коды доступа",
+        'form': form,
+        'courses': queryset,
+        'action_checkbox_name': admin.helpers.ACTION_CHECKBOX_NAME,
+        'opts': modeladmin.model._meta,
+    })
+
 @admin.register(Course)
 class CourseAdmin(admin.ModelAdmin):
     list_display = ('title', 'duration_days')   # What to show in the list table
     inlines = [LessonInline]                    # Insert lessons directly into the course page
-    actions = [duplicate_course]
+    actions = [duplicate_course, generate_access_codes]
     search_fields = ('title',)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Lessons could be changed inline - rebuild the delivery plan of the course
+        replan_course(form.instance.pk)
     
 
 @admin.register(Lesson)
@@ -85,6 +166,35 @@ class LessonAdmin(admin.ModelAdmin):
 
     def short_text(self, obj):
         return obj.text[:50] + "..." if obj.text else "-"
+
+    # --- Delivery plan sync ---
+    # Only the old and the new (day, time) block of the lesson are rebuilt.
+    def save_model(self, request, obj, form, change):
+        old = None
+        if change:
+            old = Lesson.objects.filter(pk=obj.pk).values_list('course_id', 'day_number', 'send_time').first()
+        super().save_model(request, obj, form, change)
+
+        # A replaced file must be uploaded to Telegram again
+        changed_media = [field for field in MEDIA_FIELDS if field in form.changed_data]
+        if change and changed_media:
+            forget_media(obj.pk, changed_media)
+
+        if old and old[0] != obj.course_id:
+            replan_blocks(old[0], [old[1:]])
+            old = None
+        replan_blocks(obj.course_id, [(obj.day_number, obj.send_time), old[1:] if old else None])
+
+    def delete_model(self, request, obj):
+        course_id, key = obj.course_id, (obj.day_number, obj.send_time)
+        super().delete_model(request, obj)
+        replan_blocks(course_id, [key])
+
+    def delete_queryset(self, request, queryset):
+        course_ids = set(queryset.values_list('course_id', flat=True))
+        super().delete_queryset(request, queryset)
+        for course_id in course_ids:
+            replan_course(course_id)
     
 @admin.register(BotUser)
 class BotUserAdmin(admin.ModelAdmin):
@@ -95,6 +205,19 @@ class BotUserAdmin(admin.ModelAdmin):
     actions = ["export_as_csv"]
 
     inlines = [EnrollmentInline]
+
+    # Enrollments added or switched on here need a delivery plan, like the ones created by an access code
+    def save_formset(self, request, form, formset, change):
+        super().save_formset(request, form, formset, change)
+        if formset.model is not Enrollment:
+            return
+        to_plan = [obj.pk for obj in formset.new_objects if obj.is_active]
+        to_plan += [
+            obj.pk for obj, changed in formset.changed_objects
+            if obj.is_active and {'is_active', 'course'} & set(changed)
+        ]
+        if to_plan:
+            plan_enrollments(to_plan)
     
     # Export to Excel table
     @admin.action(description="Испортировать выбранные в Excel (CSV)")
@@ -172,4 +295,46 @@ class AccessCodeAdmin(admin.ModelAdmin):
         courses = [c.title for c in obj.courses.all()]
         if not courses:
             return "⚠️ ПУСТОЙ (Ничего не откроет)"
-        return ", ".join(courses)
\ No newline at end of file
+        return ", ".join(courses)
+
+@admin.register(ScheduledDelivery)
+class ScheduledDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('enrollment', 'day_number', 'send_time', 'due_at', 'status', 'sent_at')
+    list_filter = ('status', 'enrollment__course')
+    search_fields = ('enrollment__user__username', 'enrollment__user__telegram_id')
+    readonly_fields = ('enrollment', 'day_number', 'send_time', 'due_at', 'sent_at')
+    list_select_related = ('enrollment__user', 'enrollment__course')
+    ordering = ('due_at',)
+
+class SupportMessageInline(admin.TabularInline):
+    model = SupportMessage
+    extra = 0
+    can_delete = False
+    fields = ('created_at', 'direction', 'author_name', 'text')
+    readonly_fields = fields
+    ordering = ('created_at',)
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+@admin.register(SupportTicket)
+class SupportTicketAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'status', 'created_at', 'first_responder_name', 'get_response_time', 'closed_at')
+    list_filter = ('status', 'first_responder_name')
+    search_fields = ('user__username', 'user__first_name', 'user__telegram_id')
+    readonly_fields = ('user', 'created_at', 'closed_at', 'first_response_at', 'first_responder_id', 'first_responder_name')
+    list_select_related = ('user',)
+    ordering = ('-created_at',)
+    inlines = [SupportMessageInline]
+    actions = ['close_tickets']
+
+    @admin.display(description='Время ответа')
+    def get_response_time(self, obj):
+        if not obj.first_response_at:
+            return "⏳ Ждёт ответа" if obj.status == 'open' else "-"
+        return format_duration(obj.first_response_at - obj.created_at)
+
+    @admin.action(description="Закрыть выбранные обращения")
+    def close_tickets(self, request, queryset):
+        updated = queryset.filter(status='open').update(status='closed', closed_at=timezone.now())
+        self.message_user(request, f"Закрыто обращений: {updated}")
@@ -0,0 +1,140 @@
+import queue
+import statistics
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+
+from core.models import AccessCode, BotUser, Course, Enrollment, Lesson
+from services.activation import activate_code
+
+
+class Command(BaseCommand):
+    help = (
+        "Нагрузочный тест активации кодов: несколько учеников одновременно вводят один и тот же код. "
+        "Проверяет, что каждый код достаётся ровно одному, и меряет латентность. "
+        "Работает на отдельной тестовой базе (Postgres: SQLite не умеет блокировать строки)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--codes', type=int, default=200)
+        parser.add_argument('--contenders', type=int, default=4, help="Сколько учеников одновременно вводят один код")
+        parser.add_argument('--courses', type=int, default=2, help="Курсов на код")
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--keepdb', action='store_true', help="Не удалять тестовую базу")
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+
+        # Never touch the real data: everything happens in test_<db name>
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity, keepdb=options['keepdb'])
+
+    def populate(self, options) -> list[tuple[int, str]]:
+        courses = Course.objects.bulk_create(
+            [Course(title=f"Bench course {i + 1}", duration_days=5) for i in range(options['courses'])]
+        )
+        Lesson.objects.bulk_create(
+            [Lesson(course=course, day_number=day, text=f"Day {day}") for course in courses for day in range(1, 6)]
+        )
+        codes = AccessCode.objects.bulk_create([AccessCode(code=f"BENCH{i:06d}") for i in range(options['codes'])])
+        AccessCode.courses.through.objects.bulk_create([
+            AccessCode.courses.through(accesscode_id=code.id, course_id=course.id) for code in codes for course in courses
+        ])
+
+        users = BotUser.objects.bulk_create([
+            BotUser(telegram_id=10 ** 9 + i) for i in range(options['codes'] * options['contenders'])
+        ])
+        # Every code gets `contenders` different users, interleaved so they really collide
+        attempts = []
+        for turn in range(options['contenders']):
+            for i, code in enumerate(codes):
+                attempts.append((users[i * options['contenders'] + turn].telegram_id, code.code))
+        return attempts
+
+    def run(self, options):
+        attempts = self.populate(options)
+
+        # Count every query of every thread
+        queries = Counter()
+        lock = threading.Lock()
+
+        def count_queries(execute, sql, params, many, context):
+            with lock:
+                queries['total'] += 1
+            return execute(sql, params, many, context)
+
+        def install_counter(sender, connection, **kwargs):
+            connection.execute_wrappers.append(count_queries)
+
+        connection_created.connect(install_counter)
+
+        todo = queue.SimpleQueue()
+        for args in attempts:
+            todo.put(args)
+        results = []
+
+        def worker():
+            # One connection per thread for the whole run, closed at the end
+            try:
+                while True:
+                    try:
+                        telegram_id, code = todo.get_nowait()
+                    except queue.Empty:
+                        return
+                    started = time.perf_counter()
+                    try:
+                        status = activate_code(telegram_id, code).status
+                    except Exception as e:
+                        # e.g. SQLite "table is locked": it has no row locks, run the benchmark on Postgres
+                        status = f"error: {type(e).__name__}"
+                    results.append((code, status, time.perf_counter() - started))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        connection_created.disconnect(install_counter)
+
+        self.report(options, results, elapsed, queries['total'])
+
+    def report(self, options, results, elapsed: float, total_queries: int):
+        statuses = Counter(status for _, status, _ in results)
+        winners = Counter(code for code, status, _ in results if status == 'activated')
+        latencies = sorted(seconds * 1000 for _, _, seconds in results)
+
+        double = [code for code, count in winners.items() if count > 1]
+        owners = AccessCode.objects.filter(activated_by__isnull=False).count()
+        enrollments = Enrollment.objects.count()
+        expected_enrollments = len(winners) * options['courses']
+
+        self.stdout.write(
+            f"\n📊 {len(results)} попыток ({options['codes']} кодов × {options['contenders']} ученика), "
+            f"{options['threads']} потоков, {elapsed:.2f} s ({len(results) / elapsed:.0f} активаций/с)"
+        )
+        self.stdout.write(f"Статусы: {dict(statuses)}")
+        self.stdout.write(
+            f"Латентность: p50 {statistics.median(latencies):.1f} ms, "
+            f"p95 {latencies[int((len(latencies) - 1) * 0.95)]:.1f} ms, max {latencies[-1]:.1f} ms"
+        )
+        self.stdout.write(f"SQL-запросов на попытку: {total_queries / len(results):.1f}")
+
+        if double or len(winners) != options['codes'] or owners != options['codes'] or enrollments != expected_enrollments:
+            self.stdout.write(self.style.ERROR(
+                f"❌ Гонка! Кодов с несколькими владельцами: {len(double)}, активировано {len(winners)} "
+                f"из {options['codes']}, подписок {enrollments} (ожидалось {expected_enrollments})"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS("✅ Каждый код достался ровно одному ученику"))
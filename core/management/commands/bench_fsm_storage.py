@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from django.core.management.base import BaseCommand
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from config import REDIS_HOST, REDIS_PORT
+from services.fsm_storage import CompactRedisStorage
+
+TTL = 30 * 24 * 60 * 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает RedisStorage (два JSON-ключа на ученика) и CompactRedisStorage (один msgpack-хэш): "
+        "байт на ученика и операций в секунду. Очищает указанную базу Redis (по умолчанию 15)!"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--db', type=int, default=15)
+        parser.add_argument('--concurrency', type=int, default=50)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=options['db'])
+        backends = {
+            'json (RedisStorage)': RedisStorage(redis=redis, state_ttl=TTL, data_ttl=TTL),
+            'compact (msgpack hash)': CompactRedisStorage(redis=redis, ttl=TTL),
+        }
+        results = {}
+        for name, storage in backends.items():
+            await redis.flushdb()
+            results[name] = await self.measure(redis, storage, options)
+        await redis.flushdb()
+        await redis.aclose()
+
+        self.stdout.write(f"\n📊 {options['users']} учеников, {options['concurrency']} запросов параллельно")
+        self.stdout.write(f"{'хранилище':<24} {'байт/ученик':>12} {'ключей':>8} {'запись оп/с':>12} {'чтение оп/с':>12}")
+        for name, (per_user, keys, write_ops, read_ops) in results.items():
+            self.stdout.write(f"{name:<24} {per_user:>12.0f} {keys:>8} {write_ops:>12.0f} {read_ops:>12.0f}")
+
+    async def measure(self, redis: Redis, storage, options) -> tuple[float, int, float, float]:
+        users = options['users']
+        slots = asyncio.Semaphore(options['concurrency'])
+
+        # Like the real bot: half of the students wait for a text answer (state + data),
+        # the other half just learn (state only, no data)
+        async def write(user_id: int):
+            key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+            async with slots:
+                if user_id % 2:
+                    await storage.set_state(key, "Learning:waiting_for_text_answer")
+                    await storage.set_data(key, {'lesson_id': 1000 + user_id % 500, 'attempts': user_id % 3})
+                else:
+                    await storage.set_state(key, "Learning:in_process")
+                    await storage.set_data(key, {})
+
+        async def read(user_id: int):
+            key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+            async with slots:
+                await storage.get_state(key)
+                await storage.get_data(key)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[write(user_id) for user_id in range(1, users + 1)])
+        write_ops = users * 2 / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[read(user_id) for user_id in range(1, users + 1)])
+        read_ops = users * 2 / (time.perf_counter() - started)
+
+        keys = [key async for key in redis.scan_iter(count=1000)]
+        return await self.bytes_used(redis, keys) / users, len(keys), write_ops, read_ops
+
+    async def bytes_used(self, redis: Redis, keys: list) -> int:
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.memory_usage(key, samples=0)
+                return sum(size or 0 for size in await pipe.execute())
+        except RedisError:
+            # No MEMORY USAGE (a Redis-compatible server): key names + payload, without Redis overhead
+            self.stderr.write("⚠️ MEMORY USAGE недоступен, считаю только имена ключей и значения")
+            total = 0
+            for key in keys:
+                if await redis.type(key) == b'hash':
+                    total += sum(len(part) for item in (await redis.hgetall(key)).items() for part in item)
+                else:
+                    total += await redis.strlen(key)
+                total += len(key)
+            return total
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import statistics
+import time
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message
+from aiohttp import ClientSession, web
+from django.core.management.base import BaseCommand
+
+from services.webhook import build_app
+
+TOKEN = "123456:BENCH"
+SECRET = "bench-secret"
+
+
+class FakeTelegram:
+    """
+    Minimal Bot API on localhost: getUpdates long polling over an in-memory queue,
+    sendMessage records when the answer to every update arrived.
+    `delay` emulates the network round trip of every API call.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.pending = []               # updates not confirmed by getUpdates offset yet
+        self.arrived = asyncio.Event()
+        self.sent_at = {}               # update text -> perf_counter of injection
+        self.latencies = []
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    def make_update(self, update_id: int, chat_id: int) -> dict:
+        text = f"ping {update_id}"
+        self.sent_at[text] = time.perf_counter()
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+            },
+        }
+
+    def push(self, update: dict):
+        self.pending.append(update)
+        self.arrived.set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getUpdates':
+            result = await self.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        elif method == 'sendMessage':
+            text = params['text']
+            started = self.sent_at.pop(text, None)
+            if started is not None:
+                self.latencies.append(time.perf_counter() - started)
+                if len(self.latencies) >= self.expected:
+                    self.done.set()
+            chat = {'id': int(params['chat_id']), 'type': 'private'}
+            result = {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': text}
+        else:
+            # deleteWebhook, setWebhook, ...
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, offset: int, timeout: float) -> list:
+        # Confirmed updates (below offset) are gone, as in the real API
+        self.pending = [update for update in self.pending if update['update_id'] >= offset]
+        if not self.pending and timeout:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[:100]
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает латентность апдейтов в режимах polling и webhook на локальном фейковом Telegram API: "
+        "от появления апдейта до прихода ответа бота (sendMessage). База данных не используется."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--updates', type=int, default=2000)
+        parser.add_argument('--rate', type=float, default=200, help="Апдейтов в секунду")
+        parser.add_argument('--chats', type=int, default=100)
+        parser.add_argument('--work-ms', type=float, default=5, help="Время обработки одного апдейта")
+        parser.add_argument('--rtt-ms', type=float, default=20, help="Сетевая задержка каждого запроса")
+        parser.add_argument('--concurrency', type=int, default=100, help="UPDATE_CONCURRENCY")
+        parser.add_argument('--connections', type=int, default=40, help="WEBHOOK_MAX_CONNECTIONS")
+        parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+
+    def handle(self, *args, **options):
+        modes = ['polling', 'webhook'] if options['mode'] == 'both' else [options['mode']]
+        for mode in modes:
+            result = asyncio.run(self.run(mode, options))
+            self.report(mode, options, *result)
+
+    def make_dispatcher(self, work: float) -> Dispatcher:
+        router = Router()
+
+        @router.message()
+        async def echo(message: Message):
+            await asyncio.sleep(work)
+            await message.answer(message.text)
+
+        dp = Dispatcher()
+        dp.include_router(router)
+        return dp
+
+    async def start_site(self, app: web.Application) -> tuple[web.AppRunner, str]:
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://127.0.0.1:{port}"
+
+    async def run(self, mode: str, options) -> tuple[list, float, int]:
+        delay = options['rtt_ms'] / 1000 / 2
+        fake = FakeTelegram(delay)
+        fake.expected = options['updates']
+
+        api_app = web.Application()
+        api_app.router.add_post('/bot{token}/{method}', fake.handle)
+        api_runner, api_url = await self.start_site(api_app)
+
+        bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+        dp = self.make_dispatcher(options['work_ms'] / 1000)
+        rejected = 0
+
+        if mode == 'polling':
+            poller = asyncio.create_task(dp.start_polling(
+                bot, polling_timeout=10, handle_signals=False, close_bot_session=False,
+                tasks_concurrency_limit=options['concurrency'],
+            ))
+            deliver = fake.push
+            bot_runner = http = None
+        else:
+            app = build_app(dp, bot, path='/webhook', secret=SECRET, concurrency=options['concurrency'])
+            bot_runner, bot_url = await self.start_site(app)
+            http = ClientSession()
+            connections = asyncio.Semaphore(options['connections'])
+            posts = set()
+
+            async def post(update):
+                # Telegram keeps at most max_connections requests open to the webhook
+                async with connections:
+                    if delay:
+                        await asyncio.sleep(delay)
+                    async with http.post(
+                        f"{bot_url}/webhook", data=json.dumps(update),
+                        headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET},
+                    ) as response:
+                        await response.read()
+
+            def deliver(update):
+                task = asyncio.create_task(post(update))
+                posts.add(task)
+                task.add_done_callback(posts.discard)
+
+            # A request without the secret must be refused
+            async with http.post(f"{bot_url}/webhook", json={'update_id': 0}) as response:
+                rejected = int(response.status == 401)
+
+        started = time.perf_counter()
+        interval = 1 / options['rate']
+        for i in range(options['updates']):
+            deliver(fake.make_update(i + 1, 10 ** 6 + i % options['chats']))
+            # Keep the pace without a timer per update
+            ahead = started + (i + 1) * interval - time.perf_counter()
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+        try:
+            await asyncio.wait_for(fake.done.wait(), timeout=60 + options['updates'] / options['rate'])
+        except asyncio.TimeoutError:
+            self.stderr.write(f"⚠️ {mode}: дошло только {len(fake.latencies)} ответов из {options['updates']}")
+        elapsed = time.perf_counter() - started
+
+        if mode == 'polling':
+            await dp.stop_polling()
+            await poller
+        else:
+            await http.close()
+            await bot_runner.cleanup()
+        await bot.session.close()
+        await api_runner.cleanup()
+        return fake.latencies, elapsed, rejected
+
+    def report(self, mode: str, options, latencies: list, elapsed: float, rejected: int):
+        if not latencies:
+            self.stdout.write(self.style.ERROR(f"❌ {mode}: ни одного ответа"))
+            return
+        ms = sorted(seconds * 1000 for seconds in latencies)
+        self.stdout.write(
+            f"\n📊 {mode}: {len(ms)} апдейтов за {elapsed:.2f} s ({len(ms) / elapsed:.0f}/с), "
+            f"RTT {options['rtt_ms']:.0f} ms, обработка {options['work_ms']:.0f} ms"
+        )
+        self.stdout.write(
+            f"Латентность: p50 {statistics.median(ms):.1f} ms, "
+            f"p95 {ms[int((len(ms) - 1) * 0.95)]:.1f} ms, max {ms[-1]:.1f} ms"
+        )
+        if mode == 'webhook':
+            status = self.style.SUCCESS("✅ отклонён") if rejected else self.style.ERROR("❌ принят")
+            self.stdout.write(f"Запрос без секрета: {status}")
@@ -0,0 +1,48 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Course
+from services import codes
+
+
+class Command(BaseCommand):
+    help = (
+        "Генерирует N уникальных кодов доступа для курсов и выводит их в CSV (по мере создания). "
+        "Пример: generate_codes 50000 --course 1 --course 2 -o promo.csv"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int)
+        parser.add_argument('--course', type=int, action='append', required=True, help="ID курса, можно несколько раз")
+        parser.add_argument('--length', type=int, default=codes.DEFAULT_LENGTH)
+        parser.add_argument('--alphabet', default=codes.DEFAULT_ALPHABET)
+        parser.add_argument('--prefix', default='', help="Например PROMO- (входит в длину поля кода)")
+        parser.add_argument('-o', '--output', help="CSV-файл (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        course_ids = options['course']
+        found = set(Course.objects.filter(id__in=course_ids).values_list('id', flat=True))
+        if missing := set(course_ids) - found:
+            raise CommandError(f"Курсы не найдены: {sorted(missing)}")
+
+        output = open(options['output'], 'w', newline='', encoding='utf-8') if options['output'] else sys.stdout
+        try:
+            writer = csv.writer(output)
+            writer.writerow(['code'])
+            total = 0
+            for chunk in codes.generate_codes(
+                options['count'], course_ids, options['alphabet'], options['length'], options['prefix']
+            ):
+                writer.writerows([code] for code in chunk)
+                total += len(chunk)
+                if options['output']:
+                    self.stderr.write(f"... {total}/{options['count']}")
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(str(e))
+        finally:
+            if options['output']:
+                output.close()
+
+        self.stderr.write(self.style.SUCCESS(f"Создано кодов: {total}"))
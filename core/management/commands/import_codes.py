@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Course
+from services import codes
+
+
+class Command(BaseCommand):
+    help = (
+        "Импортирует готовый список кодов (по коду в строке или CSV, код в первой колонке) для курсов. "
+        "Уже существующие коды пропускаются."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--course', type=int, action='append', required=True, help="ID курса, можно несколько раз")
+
+    def handle(self, *args, **options):
+        course_ids = options['course']
+        found = set(Course.objects.filter(id__in=course_ids).values_list('id', flat=True))
+        if missing := set(course_ids) - found:
+            raise CommandError(f"Курсы не найдены: {sorted(missing)}")
+
+        with open(options['file'], newline='', encoding='utf-8-sig') as f:
+            stats = codes.import_codes(f, course_ids)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Импортировано: {stats['created']}, уже были: {stats['existing']}, некорректных: {stats['invalid']}."
+        ))
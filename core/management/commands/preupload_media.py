@@ -0,0 +1,67 @@
+import asyncio
+
+from aiogram import Bot
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+
+from config import ADMIN_ID, BOT_TOKEN
+from services import catalog, media
+
+
+class Command(BaseCommand):
+    help = (
+        "Загружает все медиа уроков в Telegram (в приватный чат) и сохраняет file_id, "
+        "чтобы первая рассылка не грузила файлы каждому ученику. Запускать до первой отправки."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat-id', type=int, default=ADMIN_ID, help="Куда загружать (по умолчанию ADMIN_ID)")
+        parser.add_argument('--course', type=int, action='append', help="Только эти курсы (ID), можно несколько раз")
+        parser.add_argument('--force', action='store_true', help="Загрузить заново, даже если file_id уже есть")
+
+    def handle(self, *args, **options):
+        if not BOT_TOKEN:
+            raise CommandError("BOT_TOKEN не задан.")
+        asyncio.run(self.upload(options['chat_id'], options['course'], options['force']))
+
+    async def upload(self, chat_id: int, course_ids, force: bool):
+        snapshot = await catalog.aload()
+        lessons = sorted(
+            (lesson for lesson in snapshot.lessons.values() if not course_ids or lesson.course_id in course_ids),
+            key=lambda lesson: (lesson.course_id, lesson.day_number, lesson.send_time, lesson.id),
+        )
+
+        await media.load_cache()
+        bot = Bot(token=BOT_TOKEN)
+        uploaded = skipped = failed = 0
+        try:
+            for lesson in lessons:
+                for field in media.MEDIA_FIELDS:
+                    if not getattr(lesson, field):
+                        continue
+                    if force:
+                        await media.aforget(lesson.id, [field])
+                    try:
+                        hash_ = await sync_to_async(media.file_hash)(getattr(lesson, field))
+                    except OSError as e:
+                        self.stderr.write(f"❌ Урок {lesson.id} / {field}: файл не найден ({e})")
+                        failed += 1
+                        continue
+
+                    if media.cached_file_id(lesson.id, field, hash_):
+                        skipped += 1
+                        continue
+
+                    try:
+                        await media.send_media(bot, chat_id, lesson, field)
+                        uploaded += 1
+                        self.stdout.write(f"⬆️ Урок {lesson.id} / {field}")
+                    except Exception as e:
+                        self.stderr.write(f"❌ Урок {lesson.id} / {field}: {e}")
+                        failed += 1
+        finally:
+            await bot.session.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Готово: загружено {uploaded}, уже в кэше {skipped}, ошибок {failed}."
+        ))
@@ -0,0 +1,65 @@
+import re
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from redis import Redis
+
+from config import REDIS_HOST, REDIS_PORT
+
+# fsm:12345:12345:data -> fsm:*:*:data, updates:owner:3 -> updates:owner:*
+NUMBER = re.compile(r'-?\d+')
+
+
+def pattern_of(key: str) -> str:
+    return NUMBER.sub('*', key)
+
+
+class Command(BaseCommand):
+    help = (
+        "Память Redis по шаблонам ключей (числа заменены на *): сколько ключей, байт всего и на ключ, "
+        "сколько из них без TTL. Для больших шаблонов MEMORY USAGE меряется на выборке."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--db', type=int, default=0)
+        parser.add_argument('--sample', type=int, default=1000, help="Сколько ключей шаблона измерять")
+
+    def handle(self, *args, **options):
+        redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=options['db'], decode_responses=True)
+
+        keys = defaultdict(int)
+        measured = defaultdict(list)
+        persistent = defaultdict(int)
+        for key in redis.scan_iter(count=1000):
+            pattern = pattern_of(key)
+            keys[pattern] += 1
+            if len(measured[pattern]) < options['sample']:
+                measured[pattern].append(key)
+
+        rows = []
+        for pattern, sample in measured.items():
+            with redis.pipeline(transaction=False) as pipe:
+                for key in sample:
+                    pipe.memory_usage(key, samples=0)
+                    pipe.ttl(key)
+                results = pipe.execute()
+            sizes = [size or 0 for size in results[0::2]]
+            no_ttl = sum(1 for ttl in results[1::2] if ttl == -1)
+            per_key = sum(sizes) / len(sizes)
+            persistent[pattern] = round(no_ttl / len(sample) * keys[pattern])
+            rows.append((per_key * keys[pattern], pattern, keys[pattern], per_key))
+
+        info = redis.info('memory')
+        self.stdout.write(
+            f"used_memory {info['used_memory_human']}, maxmemory {info.get('maxmemory_human', '?')}, "
+            f"policy {info.get('maxmemory_policy', '?')}"
+        )
+        if info.get('maxmemory_policy', 'noeviction') != 'noeviction':
+            self.stdout.write(self.style.WARNING(
+                "⚠️ Политика вытеснения может удалить состояния FSM и аренды партиций - нужен noeviction"
+            ))
+        self.stdout.write(f"{'шаблон':<40} {'ключей':>9} {'байт/ключ':>10} {'всего':>10} {'без TTL':>8}")
+        for total, pattern, count, per_key in sorted(rows, reverse=True):
+            self.stdout.write(
+                f"{pattern:<40} {count:>9} {per_key:>10.0f} {total / 1024:>8.0f}KB {persistent[pattern]:>8}"
+            )
@@ -0,0 +1,171 @@
+import asyncio
+import random
+import statistics
+import time
+from collections import Counter
+from datetime import datetime, time as dtime, timedelta
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+from core.models import BotUser, Course, Enrollment, Lesson
+from services import catalog, clock
+from services.pipeline import TokenBucket, pipeline
+from services.planner import plan_enrollments
+from services.scheduler import CLAIM_BATCH_SIZE, check_and_send_lessons, scheduler
+
+
+class FakeBot:
+    """
+    Records every send instead of calling Telegram.
+    """
+    id = 0
+
+    def __init__(self):
+        self.sent = []  # (virtual time, chat_id, method)
+
+    def _record(self, method):
+        async def send(chat_id, *args, **kwargs):
+            self.sent.append((clock.now(), chat_id, method))
+            return SimpleNamespace(message_id=len(self.sent), chat=SimpleNamespace(id=chat_id))
+        return send
+
+    def __getattr__(self, name):
+        if name.startswith('send_'):
+            return self._record(name)
+        raise AttributeError(name)
+
+
+class Command(BaseCommand):
+    help = (
+        "Прогоняет настоящий планировщик на виртуальных часах и фейковом боте: "
+        "N учеников, M курсов, весь курс за секунды. Работает на отдельной тестовой базе."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--courses', type=int, default=3)
+        parser.add_argument('--days', type=int, default=30, help="Длительность курса в днях")
+        parser.add_argument('--lessons-per-day', type=int, default=2)
+        parser.add_argument('--spread-days', type=int, default=3, help="Регистрации распределены по стольким дням")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keepdb', action='store_true', help="Не удалять тестовую базу")
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        verbosity = options['verbosity']
+
+        # Never touch the real data: everything happens in test_<db name>
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            self.simulate(options)
+        finally:
+            clock.set_source(None)
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity, keepdb=options['keepdb'])
+
+    # --- DATA ---
+    def populate(self, options, start: datetime):
+        slots = [dtime(9, 0), dtime(12, 30), dtime(17, 0), dtime(20, 15)]
+        courses = Course.objects.bulk_create(
+            [Course(title=f"Sim course {i + 1}", duration_days=options['days']) for i in range(options['courses'])]
+        )
+        lessons = []
+        for course in courses:
+            for day in range(1, options['days'] + 1):
+                for slot in random.sample(slots, min(options['lessons_per_day'], len(slots))):
+                    lessons.append(Lesson(course=course, day_number=day, send_time=slot, text=f"Day {day}"))
+        Lesson.objects.bulk_create(lessons, batch_size=1000)
+
+        users = BotUser.objects.bulk_create(
+            [BotUser(telegram_id=10 ** 9 + i, first_name=f"Sim {i}") for i in range(options['users'])],
+            batch_size=1000,
+        )
+        enrollments = Enrollment.objects.bulk_create(
+            [Enrollment(user=user, course=random.choice(courses)) for user in users], batch_size=1000
+        )
+        # start_date is auto_now_add - move it to the virtual registration moment
+        for enrollment in enrollments:
+            offset = timedelta(days=random.randrange(max(options['spread_days'], 1)), minutes=random.randrange(24 * 60))
+            enrollment.start_date = start + offset
+        Enrollment.objects.bulk_update(enrollments, ['start_date'], batch_size=1000)
+
+        plan_enrollments([e.id for e in enrollments])
+        # bulk_create sends no signals - the snapshot has to be rebuilt by hand
+        catalog.invalidate()
+        return len(lessons)
+
+    # --- RUN ---
+    def simulate(self, options):
+        start = timezone.make_aware(datetime.combine(timezone.localdate(), dtime(0, 0)))
+        virtual_now = [start]
+        clock.set_source(lambda: virtual_now[0])
+
+        lessons_count = self.populate(options, start)
+        self.stdout.write(
+            f"👥 {options['users']} учеников, {options['courses']} курсов, {lessons_count} уроков, "
+            f"{options['days']} дней"
+        )
+
+        # Count every query of every connection (sync_to_async works in its own thread)
+        self.queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            self.queries += 1
+            return execute(sql, params, many, context)
+
+        def install_counter(sender, connection, **kwargs):
+            connection.execute_wrappers.append(count_queries)
+
+        connection_created.connect(install_counter)
+
+        # No real Telegram limits: pacing would only slow the simulation down
+        pipeline.bucket = TokenBucket(rate=10 ** 9)
+        pipeline.per_chat_interval = 0
+
+        bot = FakeBot()
+        ticks = asyncio.run(self.run_ticks(bot, virtual_now))
+        connection_created.disconnect(install_counter)
+        self.report(bot, ticks, virtual_now[0] - start)
+
+    async def run_ticks(self, bot: FakeBot, virtual_now: list) -> list[tuple]:
+        """
+        Event-driven like the real scheduler: jump straight to the next due_at.
+        Returns [(real seconds, queries, claimed blocks), ...] per tick.
+        """
+        ticks = []
+        while True:
+            deadlines = await scheduler.load_deadlines()
+            if not deadlines:
+                return ticks
+            virtual_now[0] = max(virtual_now[0], deadlines[0])
+
+            while True:
+                started, queries_before = time.perf_counter(), self.queries
+                claimed = await check_and_send_lessons(bot, None, virtual_now[0])
+                ticks.append((time.perf_counter() - started, self.queries - queries_before, claimed))
+                if claimed < CLAIM_BATCH_SIZE:
+                    break
+
+    def report(self, bot: FakeBot, ticks: list, duration: timedelta):
+        latencies = sorted(t[0] * 1000 for t in ticks) or [0]
+        tick_queries = [t[1] for t in ticks] or [0]
+        per_minute = Counter(sent_at.replace(second=0, microsecond=0) for sent_at, _, _ in bot.sent)
+
+        self.stdout.write(self.style.SUCCESS(f"\n📊 Симуляция: {duration.days} виртуальных дней"))
+        self.stdout.write(f"Тиков: {len(ticks)}, блоков: {sum(t[2] for t in ticks)}")
+        self.stdout.write(
+            f"Латентность тика: p50 {statistics.median(latencies):.1f} ms, "
+            f"p95 {latencies[int((len(latencies) - 1) * 0.95)]:.1f} ms, max {latencies[-1]:.1f} ms"
+        )
+        self.stdout.write(
+            f"SQL-запросов на тик: в среднем {statistics.mean(tick_queries):.1f}, максимум {max(tick_queries)}"
+        )
+        self.stdout.write(
+            f"Сообщений: {len(bot.sent)}, активных минут {len(per_minute)}, "
+            f"в среднем {len(bot.sent) / max(len(per_minute), 1):.1f} в минуту, "
+            f"пик {max(per_minute.values(), default=0)} в минуту"
+        )
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:27
+
+import django.db.models.deletion
+from datetime import datetime, timedelta
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_plan(apps, schema_editor):
+    """
+    Plans the remaining (future) lesson blocks of the already active enrollments.
+    """
+    Enrollment = apps.get_model('core', 'Enrollment')
+    Lesson = apps.get_model('core', 'Lesson')
+    ScheduledDelivery = apps.get_model('core', 'ScheduledDelivery')
+
+    now = timezone.now()
+    blocks = {}
+    for course_id, day_number, send_time in Lesson.objects.values_list('course_id', 'day_number', 'send_time').distinct():
+        blocks.setdefault(course_id, set()).add((day_number, send_time))
+
+    deliveries = []
+    for enrollment_id, course_id, start_date in Enrollment.objects.filter(is_active=True).values_list('id', 'course_id', 'start_date'):
+        start_day = timezone.localtime(start_date).date()
+        for day_number, send_time in blocks.get(course_id, ()):
+            due_at = timezone.make_aware(datetime.combine(start_day + timedelta(days=day_number), send_time))
+            if due_at >= now:
+                deliveries.append(ScheduledDelivery(
+                    enrollment_id=enrollment_id, day_number=day_number, send_time=send_time, due_at=due_at
+                ))
+
+    ScheduledDelivery.objects.bulk_create(deliveries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_remove_course_keyword'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day_number', models.PositiveIntegerField(verbose_name='День')),
+                ('send_time', models.TimeField(verbose_name='Время отправки')),
+                ('due_at', models.DateTimeField(verbose_name='Когда отправить')),
+                ('status', models.CharField(choices=[('pending', '⏳ Ожидает'), ('sending', '📤 Отправляется'), ('sent', '✅ Отправлено'), ('failed', '❌ Ошибка')], default='pending', max_length=10, verbose_name='Статус')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Отправлено')),
+                ('enrollment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='core.enrollment', verbose_name='Подписка')),
+            ],
+            options={
+                'verbose_name': 'Запланированная отправка',
+                'verbose_name_plural': 'План отправок',
+                'indexes': [models.Index(condition=models.Q(('status', 'pending')), fields=['due_at'], name='delivery_pending_due_idx')],
+                'unique_together': {('enrollment', 'day_number', 'send_time')},
+            },
+        ),
+        migrations.RunPython(fill_plan, migrations.RunPython.noop),
+    ]
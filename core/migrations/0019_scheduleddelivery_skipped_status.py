@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_scheduleddelivery'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scheduleddelivery',
+            name='status',
+            field=models.CharField(choices=[('pending', '⏳ Ожидает'), ('sending', '📤 Отправляется'), ('sent', '✅ Отправлено'), ('failed', '❌ Ошибка'), ('skipped', '⏭ Пропущено (бот был выключен)')], default='pending', max_length=10, verbose_name='Статус'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_scheduleddelivery_skipped_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LessonMediaCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=20, verbose_name='Поле')),
+                ('file_hash', models.CharField(max_length=64, verbose_name='Хэш файла')),
+                ('file_id', models.CharField(max_length=255, verbose_name='Telegram file_id')),
+                ('uploaded_at', models.DateTimeField(auto_now=True, verbose_name='Загружено')),
+                ('lesson', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_cache', to='core.lesson', verbose_name='Урок')),
+            ],
+            options={
+                'verbose_name': 'Кэш медиа (file_id)',
+                'verbose_name_plural': 'Кэш медиа (file_id)',
+                'unique_together': {('lesson', 'field')},
+            },
+        ),
+    ]
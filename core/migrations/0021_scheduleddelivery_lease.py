@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_lessonmediacache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduleddelivery',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=100, verbose_name='Воркер'),
+        ),
+        migrations.AddField(
+            model_name='scheduleddelivery',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Захвачено до'),
+        ),
+        migrations.AddIndex(
+            model_name='scheduleddelivery',
+            index=models.Index(condition=models.Q(('status', 'sending')), fields=['claimed_until'], name='delivery_sending_lease_idx'),
+        ),
+    ]
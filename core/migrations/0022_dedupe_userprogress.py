@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:33
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def dedupe_progress(apps, schema_editor):
+    """
+    Keeps the first UserProgress row of every (user, lesson) pair before the unique constraint is added.
+    """
+    UserProgress = apps.get_model('core', 'UserProgress')
+
+    duplicates = (
+        UserProgress.objects.values('user_id', 'lesson_id')
+        .annotate(first_id=Min('id'), rows=Count('id'))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates.iterator():
+        UserProgress.objects.filter(
+            user_id=row['user_id'], lesson_id=row['lesson_id']
+        ).exclude(id=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_scheduleddelivery_lease'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_progress, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_dedupe_userprogress'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='userprogress',
+            constraint=models.UniqueConstraint(fields=('user', 'lesson'), name='unique_user_lesson_progress'),
+        ),
+    ]
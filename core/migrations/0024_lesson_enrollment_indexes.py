@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_userprogress_unique_user_lesson'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='enrollment',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['course'], include=('start_date',), name='enrollment_active_course_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['course', 'day_number', 'send_time'], name='lesson_course_block_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_lesson_enrollment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SupportTicket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('open', '🟢 Открыт'), ('closed', '⚪️ Закрыт')], default='open', max_length=10, verbose_name='Статус')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создан')),
+                ('closed_at', models.DateTimeField(blank=True, null=True, verbose_name='Закрыт')),
+                ('first_response_at', models.DateTimeField(blank=True, null=True, verbose_name='Первый ответ')),
+                ('first_responder_id', models.BigIntegerField(blank=True, null=True, verbose_name='Ответил (Telegram ID)')),
+                ('first_responder_name', models.CharField(blank=True, max_length=255, verbose_name='Ответил')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tickets', to='core.botuser', verbose_name='Ученик')),
+            ],
+            options={
+                'verbose_name': 'Обращение в поддержку',
+                'verbose_name_plural': 'Обращения в поддержку',
+            },
+        ),
+        migrations.CreateModel(
+            name='SupportMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField(verbose_name='Группа')),
+                ('message_id', models.BigIntegerField(verbose_name='ID сообщения в группе')),
+                ('direction', models.CharField(choices=[('in', '📩 От ученика'), ('out', '👩\u200d🏫 От куратора')], max_length=3, verbose_name='Направление')),
+                ('author_id', models.BigIntegerField(verbose_name='Автор (Telegram ID)')),
+                ('author_name', models.CharField(blank=True, max_length=255, verbose_name='Автор')),
+                ('text', models.TextField(blank=True, verbose_name='Текст')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время')),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='core.supportticket', verbose_name='Обращение')),
+            ],
+            options={
+                'verbose_name': 'Сообщение поддержки',
+                'verbose_name_plural': 'Сообщения поддержки',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='supportticket',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'open')), fields=('user',), name='unique_open_ticket_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='supportmessage',
+            constraint=models.UniqueConstraint(fields=('chat_id', 'message_id'), name='unique_support_group_message'),
+        ),
+    ]
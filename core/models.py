@@ -1,7 +1,7 @@
 from django.utils import timezone
 from django.db import models
 from django.utils.safestring import mark_safe
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
 class Course(models.Model):
@@ -85,6 +85,28 @@ class Lesson(models.Model):
         verbose_name = "Урок/Задания"
         verbose_name_plural = "Уроки"
         ordering = ['day_number', 'send_time', 'id']
+        indexes = [
+            # Planner: blocks (day + time) of a course - answered from the index alone
+            models.Index(fields=['course', 'day_number', 'send_time'], name='lesson_course_block_idx'),
+        ]
+
+class LessonMediaCache(models.Model):
+    """
+    Telegram file_id уже загруженного медиа урока (чтобы не грузить файл каждому ученику).
+    """
+    lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, related_name='media_cache', verbose_name="Урок")
+    field = models.CharField("Поле", max_length=20)
+    file_hash = models.CharField("Хэш файла", max_length=64)
+    file_id = models.CharField("Telegram file_id", max_length=255)
+    uploaded_at = models.DateTimeField("Загружено", auto_now=True)
+
+    class Meta:
+        unique_together = ('lesson', 'field')
+        verbose_name = "Кэш медиа (file_id)"
+        verbose_name_plural = "Кэш медиа (file_id)"
+
+    def __str__(self):
+        return f"{self.lesson_id}.{self.field} -> {self.file_id[:20]}..."
 
 class AccessCode(models.Model):
     code = models.CharField("Код доступа", max_length=20, unique=True)
@@ -133,6 +155,12 @@ class UserProgress(models.Model):
     lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE)
     sent_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # One row per lesson and user: double taps and parallel ticks must not duplicate it
+            models.UniqueConstraint(fields=['user', 'lesson'], name='unique_user_lesson_progress'),
+        ]
+
     def __str__(self):
         return f"{self.user} -> {self.lesson} ({self.sent_at.date()})"
     
@@ -191,6 +219,13 @@ class Enrollment(models.Model):
     # Час тут більше не потрібен, бо час задається в самому Уроці.
     class Meta:
         unique_together = ('user', 'course')
+        indexes = [
+            # Re-planning a course walks its active subscriptions (start_date is read from the index)
+            models.Index(
+                fields=['course'], include=['start_date'], name='enrollment_active_course_idx',
+                condition=models.Q(is_active=True),
+            ),
+        ]
         verbose_name = "Подписка"
         verbose_name_plural = "Подписки"
 
@@ -202,7 +237,105 @@ class Enrollment(models.Model):
             return 0
         delta = timezone.now() - self.start_date
         return delta.days + 1
+
+class ScheduledDelivery(models.Model):
+    """
+    План розсилки. Один рядок = один блок уроків (день + час) для однієї підписки.
+    """
+    STATUS_CHOICES = [
+        ('pending', '⏳ Ожидает'),
+        ('sending', '📤 Отправляется'),
+        ('sent', '✅ Отправлено'),
+        ('failed', '❌ Ошибка'),
+        ('skipped', '⏭ Пропущено (бот был выключен)'),
+    ]
+
+    enrollment = models.ForeignKey(Enrollment, on_delete=models.CASCADE, related_name='deliveries', verbose_name="Подписка")
+    day_number = models.PositiveIntegerField("День")
+    send_time = models.TimeField("Время отправки")
+    due_at = models.DateTimeField("Когда отправить")
+    status = models.CharField("Статус", max_length=10, choices=STATUS_CHOICES, default='pending')
+    sent_at = models.DateTimeField("Отправлено", null=True, blank=True)
+
+    # Which scheduler worker took the row and until when (lease). If the worker dies,
+    # the lease expires and another worker picks the row up.
+    claimed_by = models.CharField("Воркер", max_length=100, blank=True)
+    claimed_until = models.DateTimeField("Захвачено до", null=True, blank=True)
+
+    class Meta:
+        unique_together = ('enrollment', 'day_number', 'send_time')
+        indexes = [
+            # The scheduler only ever scans pending rows by due_at
+            models.Index(fields=['due_at'], name='delivery_pending_due_idx', condition=models.Q(status='pending')),
+            # ...and claimed rows by lease expiry
+            models.Index(fields=['claimed_until'], name='delivery_sending_lease_idx', condition=models.Q(status='sending')),
+        ]
+        verbose_name = "Запланированная отправка"
+        verbose_name_plural = "План отправок"
+
+    def __str__(self):
+        return f"{self.enrollment_id} | День {self.day_number} {self.send_time} -> {self.due_at} ({self.status})"
     
+class SupportTicket(models.Model):
+    """
+    Обращение ученика в поддержку. Все сообщения ученика, пока тикет открыт, и ответы кураторов
+    относятся к одному тикету.
+    """
+    STATUS_CHOICES = [
+        ('open', '🟢 Открыт'),
+        ('closed', '⚪️ Закрыт'),
+    ]
+
+    user = models.ForeignKey(BotUser, on_delete=models.CASCADE, related_name='tickets', verbose_name="Ученик")
+    status = models.CharField("Статус", max_length=10, choices=STATUS_CHOICES, default='open')
+    created_at = models.DateTimeField("Создан", auto_now_add=True)
+    closed_at = models.DateTimeField("Закрыт", null=True, blank=True)
+
+    # First curator answer: response time = first_response_at - created_at
+    first_response_at = models.DateTimeField("Первый ответ", null=True, blank=True)
+    first_responder_id = models.BigIntegerField("Ответил (Telegram ID)", null=True, blank=True)
+    first_responder_name = models.CharField("Ответил", max_length=255, blank=True)
+
+    class Meta:
+        constraints = [
+            # At most one open ticket per student: new messages are appended to it
+            models.UniqueConstraint(fields=['user'], condition=models.Q(status='open'), name='unique_open_ticket_per_user'),
+        ]
+        verbose_name = "Обращение в поддержку"
+        verbose_name_plural = "Обращения в поддержку"
+
+    def __str__(self):
+        return f"#{self.id} {self.user} ({self.status})"
+
+class SupportMessage(models.Model):
+    """
+    Сообщение тикета в группе поддержки: по ответу (reply) на любое из них находится тикет и ученик.
+    """
+    DIRECTION_CHOICES = [
+        ('in', '📩 От ученика'),
+        ('out', '👩‍🏫 От куратора'),
+    ]
+
+    ticket = models.ForeignKey(SupportTicket, on_delete=models.CASCADE, related_name='messages', verbose_name="Обращение")
+    chat_id = models.BigIntegerField("Группа")
+    message_id = models.BigIntegerField("ID сообщения в группе")
+    direction = models.CharField("Направление", max_length=3, choices=DIRECTION_CHOICES)
+    author_id = models.BigIntegerField("Автор (Telegram ID)")
+    author_name = models.CharField("Автор", max_length=255, blank=True)
+    text = models.TextField("Текст", blank=True)
+    created_at = models.DateTimeField("Время", auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # Reply lookup: (group, message_id) -> ticket
+            models.UniqueConstraint(fields=['chat_id', 'message_id'], name='unique_support_group_message'),
+        ]
+        verbose_name = "Сообщение поддержки"
+        verbose_name_plural = "Сообщения поддержки"
+
+    def __str__(self):
+        return f"#{self.ticket_id} {self.get_direction_display()}: {self.text[:30]}"
+
 @receiver(pre_delete, sender=BotUser)
 def delete_linked_access_code(sender, instance, **kwargs):
     """
@@ -219,4 +352,47 @@ def delete_linked_access_code(sender, instance, **kwargs):
             print(f"🔥 Разом із юзером {instance.telegram_id} знищено код доступу (всього: {count}).")
             
     except Exception as e:
-        print(f"⚠️ Помилка при видаленні коду: {e}")
\ No newline at end of file
+        print(f"⚠️ Помилка при видаленні коду: {e}")
+
+@receiver([post_save, post_delete], sender=Course)
+@receiver([post_save, post_delete], sender=Lesson)
+def catalog_changed(sender, instance, **kwargs):
+    """
+    Курси/уроки змінились - бот має перечитати каталог (у всіх процесах).
+    """
+    from services import catalog
+    catalog.changed()
+
+@receiver([post_save, post_delete], sender=BotMessage)
+@receiver([post_save, post_delete], sender=BotSettings)
+def bot_cache_changed(sender, instance, **kwargs):
+    """
+    Тексти/налаштування змінились - бот має перечитати кеш (у всіх процесах).
+    """
+    from services import botcache
+    botcache.changed()
+
+@receiver([post_save, post_delete], sender=FAQItem)
+def faq_changed(sender, instance, **kwargs):
+    """
+    FAQ змінився - меню і пошуковий індекс будуються заново (у всіх процесах).
+    """
+    from services import faq_index
+    faq_index.changed()
+
+@receiver([post_save, post_delete], sender=BotUser)
+def bot_user_changed(sender, instance, **kwargs):
+    """
+    Юзера додали/змінили/видалили в адмінці - бот має забути його копію в кеші.
+    """
+    from services import identity
+    identity.changed(instance.telegram_id)
+
+@receiver(post_save, sender=AccessCode)
+def access_code_created(sender, instance, created, **kwargs):
+    """
+    Новий код - бот не має вважати його "не знайденим" (негативний кеш кодів).
+    """
+    if created:
+        from services.throttling import forget_missing_codes
+        forget_missing_codes([instance.code])
@@ -1,3 +1,2220 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import os
+import threading
+import time as time_module
+import unittest
+from datetime import time, timedelta
+from types import SimpleNamespace
+from unittest import mock
+from unittest.mock import AsyncMock
 
-# Create your tests here.
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from asgiref.sync import async_to_sync
+from django.db import connection, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.models import AccessCode, BotMessage, BotSettings, BotUser, Course, Enrollment, FAQItem, Lesson, LessonMediaCache, ScheduledDelivery, SupportMessage, SupportTicket, UserProgress
+from services import botcache, catalog, faq_index, tickets
+
+
+def fake_message(user_id: int, text: str = ""):
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=user_id, username="student", first_name="Student", full_name="Student"),
+        chat=SimpleNamespace(id=user_id, type="private"),
+        text=text,
+        reply_markup=None,
+        answer=AsyncMock(),
+        reply=AsyncMock(),
+        edit_reply_markup=AsyncMock(),
+    )
+
+
+def redis_available() -> bool:
+    from redis import Redis
+    from config import REDIS_HOST, REDIS_PORT
+
+    try:
+        return Redis(host=REDIS_HOST, port=REDIS_PORT, socket_connect_timeout=0.5).ping()
+    except Exception:
+        return False
+
+
+def fake_state(user_id: int) -> FSMContext:
+    return FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=user_id, user_id=user_id))
+
+
+class AsyncDatabaseAccessTests(TestCase):
+    """
+    Guard against blocking ORM calls on the event loop.
+    Django raises SynchronousOnlyOperation for a sync query inside a running loop,
+    so every handler/service driven here must use the async ORM (or a thread).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(title="Norsk A1", duration_days=1)
+        cls.quiz = Lesson.objects.create(
+            course=cls.course, day_number=1, send_time=time(9, 0), lesson_type='quiz', text="Hva heter du?",
+            quiz_options="Jeg heter Ola\nJeg er Ola", correct_answer="Jeg heter Ola", error_feedback="\nNei",
+        )
+        cls.user = BotUser.objects.create(telegram_id=111, first_name="Ola")
+
+    def setUp(self):
+        catalog.invalidate()
+        botcache.invalidate()
+        faq_index.invalidate()
+
+    def test_async_unsafe_is_not_enabled(self):
+        # With this flag Django stops raising and the guard below means nothing
+        self.assertNotIn("DJANGO_ALLOW_ASYNC_UNSAFE", os.environ)
+        with open(os.path.join(os.path.dirname(__file__), '..', 'bot.py'), encoding='utf-8') as f:
+            self.assertNotIn("DJANGO_ALLOW_ASYNC_UNSAFE", f.read())
+
+    async def test_start_creates_user(self):
+        from handlers.common import cmd_start
+
+        await cmd_start(fake_message(222, "/start"), fake_state(222))
+        self.assertTrue(await BotUser.objects.filter(telegram_id=222).aexists())
+
+    async def test_access_code_enrolls(self):
+        from handlers.registration import process_code
+
+        code = await AccessCode.objects.acreate(code="NORSK1")
+        await code.courses.aadd(self.course)
+        await process_code(fake_message(111, "NORSK1"), fake_state(111))
+
+        self.assertTrue(await Enrollment.objects.filter(user=self.user, course=self.course, is_active=True).aexists())
+        self.assertTrue(await ScheduledDelivery.objects.filter(enrollment__user=self.user).aexists())
+
+    async def test_quiz_answer_records_progress(self):
+        from handlers.learning import check_quiz_answer
+
+        callback = SimpleNamespace(
+            data=f"ans:{self.quiz.id}:Jeg heter Ola", from_user=SimpleNamespace(id=111),
+            message=fake_message(111), answer=AsyncMock(),
+        )
+        await check_quiz_answer(callback, bot=None)
+        self.assertTrue(await UserProgress.objects.filter(user=self.user, lesson=self.quiz).aexists())
+
+    async def test_wrong_quiz_answer_shows_explanation(self):
+        from handlers.learning import check_quiz_answer
+
+        callback = SimpleNamespace(
+            data=f"ans:{self.quiz.id}:Jeg er Ola", from_user=SimpleNamespace(id=111),
+            message=fake_message(111), answer=AsyncMock(),
+        )
+        await check_quiz_answer(callback, bot=None)
+        callback.answer.assert_awaited_with("❌ Nei", show_alert=True)
+
+    async def test_text_answer_records_progress(self):
+        from handlers.learning import check_text_answer
+
+        state = fake_state(111)
+        await state.update_data(lesson_id=self.quiz.id, attempts=0)
+        await check_text_answer(fake_message(111, "jeg heter Ola!"), state, bot=None)
+        self.assertTrue(await UserProgress.objects.filter(user=self.user, lesson=self.quiz).aexists())
+
+    async def test_support_message(self):
+        from handlers.support import process_support_message
+
+        await BotSettings.objects.acreate(key="support_group_id", value="-100")
+        bot = SimpleNamespace(send_message=AsyncMock(return_value=SimpleNamespace(message_id=500)))
+        await process_support_message(fake_message(111, "Hjelp"), fake_state(111), bot)
+        bot.send_message.assert_awaited()
+        self.assertTrue(await SupportMessage.objects.filter(chat_id=-100, message_id=500, ticket__user=self.user).aexists())
+
+    async def test_faq(self):
+        from handlers.faq import get_faq_answer, get_faq_main_kb
+
+        item = await FAQItem.objects.acreate(question="Hva?", answer="Svar")
+        self.assertIsNotNone(await get_faq_main_kb())
+        self.assertEqual((await get_faq_answer(item.id)).answer, "Svar")
+
+    async def test_scheduler_tick(self):
+        from core.management.commands.simulate_schedule import FakeBot
+        from services.scheduler import check_and_send_lessons
+
+        enrollment = await Enrollment.objects.acreate(user=self.user, course=self.course)
+        await ScheduledDelivery.objects.acreate(
+            enrollment=enrollment, day_number=1, send_time=time(9, 0), due_at=timezone.now() - timedelta(minutes=1)
+        )
+        bot = FakeBot()
+
+        self.assertEqual(await check_and_send_lessons(bot), 1)
+        self.assertTrue(await UserProgress.objects.filter(user=self.user, lesson=self.quiz).aexists())
+        self.assertFalse((await Enrollment.objects.aget(id=enrollment.id)).is_active)
+        self.assertTrue(bot.sent)
+
+
+class BotCacheTests(TestCase):
+
+    def setUp(self):
+        botcache.invalidate()
+
+    def test_served_from_memory(self):
+        from services.utils import get_text
+
+        BotMessage.objects.create(slug="welcome_text", text="Hei!")
+        self.assertEqual(async_to_sync(get_text)("welcome_text"), "Hei!")
+        misses = botcache.misses
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(get_text)("welcome_text"), "Hei!")
+            self.assertEqual(async_to_sync(get_text)("missing", default="Standard"), "Standard")
+            self.assertIsNone(async_to_sync(botcache.get_setting)("support_group_id"))
+        self.assertEqual(botcache.misses, misses)
+
+    async def test_reloaded_after_invalidation(self):
+        await botcache.get_setting("support_group_id")
+        await BotSettings.objects.acreate(key="support_group_id", value="-100")
+        # post_save invalidates on commit - the test transaction never commits
+        botcache.invalidate()
+        self.assertEqual(await botcache.get_setting("support_group_id"), "-100")
+
+    async def test_ttl(self):
+        await botcache.get_setting("support_group_id")
+        await BotSettings.objects.acreate(key="support_group_id", value="-100")
+        with mock.patch.object(botcache, 'BOT_CACHE_TTL', 0):
+            self.assertEqual(await botcache.get_setting("support_group_id"), "-100")
+
+    async def test_watermark_does_not_invalidate(self):
+        from services.scheduler import save_watermark
+
+        await save_watermark(timezone.now())
+        await botcache.get_setting("support_group_id")
+        misses = botcache.misses
+        with self.captureOnCommitCallbacks() as callbacks:
+            await save_watermark(timezone.now())
+        self.assertEqual(callbacks, [])
+        await botcache.get_setting("support_group_id")
+        self.assertEqual(botcache.misses, misses)
+
+
+class FaqIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.payment = FAQItem.objects.create(question="Как оплатить курс?", answer="Оплата картой или через Vipps.")
+        cls.code = FAQItem.objects.create(question="Не приходит код доступа", answer="Проверьте почту и папку «Спам».")
+        cls.lessons = FAQItem.objects.create(
+            question="Når kommer leksjonene?", answer="Leksjonene kommer hver dag kl. 9:00 og 18:00."
+        )
+        FAQItem.objects.create(question="Скрытый вопрос", answer="Оплата", is_visible=False)
+
+    def setUp(self):
+        faq_index.invalidate()
+
+    def search(self, query: str) -> list[int]:
+        snapshot = async_to_sync(faq_index.aload)()
+        return [item.id for item in snapshot.search(query)]
+
+    def test_word_forms_match(self):
+        self.assertEqual(self.search("оплатой курсов")[0], self.payment.id)
+        self.assertEqual(self.search("коды не пришли")[0], self.code.id)
+        self.assertEqual(self.search("leksjon i dag")[0], self.lessons.id)
+
+    def test_hidden_and_unknown(self):
+        self.assertEqual(self.search("оплата"), [self.payment.id])
+        self.assertEqual(self.search("погода"), [])
+        self.assertEqual(self.search("?!"), [])
+
+    def test_short_words_use_the_prefix_map(self):
+        words = "код кодом коды кодекс ко курс курсы курсов kurset kursene"
+        snapshot = faq_index.FaqSnapshot(1, [SimpleNamespace(id=1, question=words, answer="")])
+        self.assertEqual(sorted(snapshot.prefixes["код"]), ["кодек", "кодом", "коды"])
+
+        def scan(token):
+            # What the prefix map replaces: a pass over the whole vocabulary
+            for known in snapshot.index:
+                shorter, longer = sorted((token, known), key=len)
+                if known == token or (faq_index.MIN_PREFIX <= len(shorter) < faq_index.STEM_LENGTH
+                                      and longer.startswith(shorter)):
+                    yield known
+
+        for token in ["код", "коды", "кодек", "курс", "kurs", "kurse", "ко", "погод"]:
+            self.assertEqual(sorted(snapshot._matching_stems(token)), sorted(scan(token)), token)
+
+    async def test_search_covers_only_the_next_message(self):
+        from handlers.faq import faq_search_callback, faq_search_query
+        from states import Faq, Registration
+
+        state = fake_state(111)
+        await state.set_state(Registration.waiting_for_access_code)
+        await state.update_data(attempts=1)
+        callback = SimpleNamespace(message=fake_message(111), answer=AsyncMock())
+        await faq_search_callback(callback, state)
+        self.assertEqual(await state.get_state(), Faq.waiting_for_query.state)
+
+        message = fake_message(111, "оплата")
+        await faq_search_query(message, state)
+        self.assertIn("Возможно", message.answer.await_args.args[0])
+        # The next message (an access code) goes where it went before the search
+        self.assertEqual(await state.get_state(), Registration.waiting_for_access_code.state)
+        self.assertEqual(await state.get_data(), {'attempts': 1})
+
+    def test_keyboard_is_built_once(self):
+        from handlers.faq import get_faq_main_kb
+
+        kb = async_to_sync(get_faq_main_kb)()
+        with self.assertNumQueries(0):
+            self.assertIs(async_to_sync(get_faq_main_kb)(), kb)
+            self.assertEqual(len(self.search("код")), 1)
+
+
+class SupportTicketTests(TestCase):
+    """
+    Curator replies find the student by the replied message_id, not by the text of the message.
+    """
+    GROUP = -100
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = BotUser.objects.create(telegram_id=111, first_name="Ola")
+        BotSettings.objects.create(key="support_group_id", value=str(cls.GROUP))
+
+    def setUp(self):
+        botcache.invalidate()
+        tickets.invalidate()
+        self.next_id = 1000
+
+    def make_bot(self):
+        def send_message(chat_id, text, **kwargs):
+            self.next_id += 1
+            return SimpleNamespace(message_id=self.next_id, chat_id=chat_id, text=text)
+
+        return SimpleNamespace(send_message=AsyncMock(side_effect=send_message))
+
+    def group_reply(self, replied_id: int, text: str, curator_id: int = 7, message_id: int = None):
+        message = fake_message(curator_id, text)
+        message.from_user.full_name = "Kari"
+        message.chat = SimpleNamespace(id=self.GROUP, type="supergroup")
+        message.message_id = message_id or replied_id + 100
+        message.reply_to_message = SimpleNamespace(message_id=replied_id, text="")
+        message.react = AsyncMock()
+        return message
+
+    async def ask(self, bot, text: str):
+        from handlers.support import process_support_message
+
+        await process_support_message(fake_message(111, text), fake_state(111), bot)
+        return bot.send_message.await_args.args[1], self.next_id
+
+    async def test_reply_ignores_id_in_student_text(self):
+        from handlers.support import process_admin_reply
+
+        bot = self.make_bot()
+        _, group_message_id = await self.ask(bot, "ID: 999\nHvordan?")
+        await process_admin_reply(self.group_reply(group_message_id, "Svar"), bot)
+
+        chat_id, text = bot.send_message.await_args.args
+        self.assertEqual(chat_id, 111)
+        self.assertIn("Svar", text)
+
+    async def test_thread_continues_in_open_ticket(self):
+        from handlers.support import process_admin_reply
+
+        bot = self.make_bot()
+        first_text, first_id = await self.ask(bot, "Hei")
+        second_text, second_id = await self.ask(bot, "Hei igjen")
+        self.assertIn("Новый вопрос", first_text)
+        self.assertIn("Продолжение", second_text)
+        self.assertEqual(await SupportTicket.objects.acount(), 1)
+
+        # A reply to the curator's own answer still reaches the student
+        await process_admin_reply(self.group_reply(second_id, "Svar 1", message_id=5000), bot)
+        await process_admin_reply(self.group_reply(5000, "Svar 2", message_id=5001), bot)
+        self.assertEqual(bot.send_message.await_args.args[0], 111)
+        self.assertEqual(await SupportMessage.objects.filter(direction='out').acount(), 2)
+
+    async def test_failed_send_leaves_no_ticket(self):
+        bot = self.make_bot()
+        bot.send_message.side_effect = RuntimeError("bot is not in the group")
+        await self.ask(bot, "Hei")
+        self.assertEqual(await SupportTicket.objects.acount(), 0)
+        self.assertEqual(await tickets.waiting_count(), (0, 0))
+
+        # A follow-up that fails keeps the ticket the first question opened
+        bot = self.make_bot()
+        await self.ask(bot, "Hei")
+        bot.send_message.side_effect = RuntimeError("flood")
+        await self.ask(bot, "Hei igjen")
+        self.assertEqual(await SupportTicket.objects.filter(status='open').acount(), 1)
+
+    async def test_unrelated_reply_is_ignored(self):
+        from handlers.support import process_admin_reply
+
+        bot = self.make_bot()
+        await process_admin_reply(self.group_reply(42, "Hm"), bot)
+        bot.send_message.assert_not_awaited()
+
+    def test_resolve_is_a_dict_lookup(self):
+        bot = self.make_bot()
+        _, group_message_id = async_to_sync(self.ask)(bot, "Hei")
+        with self.assertNumQueries(0):
+            ref = async_to_sync(tickets.resolve)(self.GROUP, group_message_id)
+        self.assertEqual(ref.telegram_id, 111)
+
+        # After a restart the unique index answers in one query
+        tickets.invalidate()
+        with self.assertNumQueries(1):
+            self.assertEqual(async_to_sync(tickets.resolve)(self.GROUP, group_message_id), ref)
+
+    async def test_close_and_reopen(self):
+        from handlers.support import cmd_close_ticket
+
+        bot = self.make_bot()
+        _, group_message_id = await self.ask(bot, "Hei")
+        await cmd_close_ticket(self.group_reply(group_message_id, "/close"), bot)
+        ticket = await SupportTicket.objects.aget()
+        self.assertEqual(ticket.status, 'closed')
+        self.assertIsNotNone(ticket.closed_at)
+
+        await self.ask(bot, "Et nytt spørsmål")
+        self.assertEqual(await SupportTicket.objects.filter(status='open').acount(), 1)
+
+    async def test_curator_stats(self):
+        ticket_id, _ = await tickets.open_ticket(self.user.id)
+        ref = tickets.TicketRef(ticket_id, 111)
+        await tickets.record_answer(ref, self.GROUP, 1, curator_id=7, curator_name="Kari")
+        # Only the first answer counts
+        await tickets.record_answer(ref, self.GROUP, 2, curator_id=8, curator_name="Nora")
+
+        await SupportTicket.objects.filter(id=ticket_id).aupdate(created_at=timezone.now() - timedelta(minutes=10))
+        stats = await tickets.curator_stats()
+        self.assertEqual([(item.curator_id, item.tickets) for item in stats], [(7, 1)])
+        self.assertGreaterEqual(stats[0].median, timedelta(minutes=9))
+        self.assertEqual(await tickets.waiting_count(), (1, 0))
+
+
+class WebhookTests(SimpleTestCase):
+    """
+    Webhook mode: the secret is checked, updates are acked before the handlers finish,
+    and no more than `concurrency` updates are handled at once.
+    """
+
+    def make_app(self, handler, concurrency=10):
+        from aiogram import Bot, Dispatcher, Router
+        from services.webhook import build_app
+
+        router = Router()
+        router.message()(handler)
+        dp = Dispatcher()
+        dp.include_router(router)
+        return build_app(dp, Bot("123456:TEST"), path="/hook", secret="s3cret", concurrency=concurrency)
+
+    @staticmethod
+    def update(update_id: int) -> dict:
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': 0, 'text': "hei",
+                'chat': {'id': 5, 'type': 'private'}, 'from': {'id': 5, 'is_bot': False, 'first_name': "Ola"},
+            },
+        }
+
+    async def test_secret_and_fast_ack(self):
+        from aiohttp.test_utils import TestClient, TestServer
+
+        release = asyncio.Event()
+        handled = []
+
+        async def handler(message):
+            await release.wait()
+            handled.append(message.message_id)
+
+        async with TestClient(TestServer(self.make_app(handler))) as client:
+            response = await client.post("/hook", json=self.update(1))
+            self.assertEqual(response.status, 401)
+
+            headers = {'X-Telegram-Bot-Api-Secret-Token': "s3cret"}
+            response = await asyncio.wait_for(client.post("/hook", json=self.update(2), headers=headers), 5)
+            # Acked while the handler is still waiting
+            self.assertEqual(response.status, 200)
+            self.assertEqual(handled, [])
+
+            release.set()
+            for _ in range(100):
+                if handled:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(handled, [2])
+
+    async def test_concurrency_limit(self):
+        from aiohttp.test_utils import TestClient, TestServer
+
+        running = 0
+        peak = 0
+
+        async def handler(message):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+
+        app = self.make_app(handler, concurrency=3)
+        headers = {'X-Telegram-Bot-Api-Secret-Token': "s3cret"}
+        async with TestClient(TestServer(app)) as client:
+            responses = await asyncio.gather(*[
+                client.post("/hook", json=self.update(i), headers=headers) for i in range(1, 13)
+            ])
+            self.assertTrue(all(response.status == 200 for response in responses))
+            while app['webhook_handler'].stats()['in_progress']:
+                await asyncio.sleep(0.01)
+
+        self.assertEqual(peak, 3)
+        self.assertEqual(app['webhook_handler'].received, 12)
+
+
+@unittest.skipUnless(redis_available(), "needs a Redis server (REDIS_HOST)")
+class UpdateStreamTests(SimpleTestCase):
+    """
+    UPDATE_QUEUE=stream: updates go through Redis Streams, the updates of one user keep their order
+    and unacknowledged updates of a crashed worker are handled by the next owner of the partition.
+    Uses Redis db 15 and flushes it.
+    """
+    PARTITIONS = 4
+
+    async def connect(self):
+        from redis.asyncio import Redis
+        from config import REDIS_HOST, REDIS_PORT
+
+        self.redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=15)
+        await self.redis.flushdb()
+
+    def make_dispatcher(self, handled: list):
+        from aiogram import Dispatcher, Router
+
+        router = Router()
+
+        @router.message()
+        async def record(message):
+            # Later updates of a user finish faster - without ordering they would overtake
+            await asyncio.sleep(0.02 / message.message_id)
+            handled.append((message.from_user.id, message.message_id))
+
+        dp = Dispatcher()
+        dp.include_router(router)
+        return dp
+
+    def make_consumer(self, dp, name: str):
+        from aiogram import Bot
+        from services.update_stream import UpdateConsumer
+
+        return UpdateConsumer(dp, Bot("123456:TEST"), self.redis, consumer=name, partitions=self.PARTITIONS,
+                              lease=3, handle_timeout=0.3)
+
+    async def ingest(self, count: int, users=(1, 2, 3)):
+        from aiogram import Bot, Dispatcher
+        from aiogram.types import Update
+        from services.update_stream import IngestMiddleware
+
+        bot = Bot("123456:TEST")
+        receiver = Dispatcher()
+        receiver.update.outer_middleware(IngestMiddleware(self.redis, partitions=self.PARTITIONS))
+        for i in range(1, count + 1):
+            user_id = users[i % len(users)]
+            await receiver.feed_update(bot, Update.model_validate({
+                'update_id': i,
+                'message': {
+                    'message_id': i, 'date': 0, 'text': "hei",
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': "Ola"},
+                },
+            }))
+
+    async def run_until(self, consumers, condition, timeout: float = 10):
+        tasks = [asyncio.create_task(consumer.run()) for consumer in consumers]
+        try:
+            for _ in range(int(timeout / 0.05)):
+                if condition():
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            for consumer in consumers:
+                consumer.stop()
+            await asyncio.gather(*tasks)
+
+    async def pending(self) -> int:
+        from services.update_stream import GROUP, STREAM
+
+        total = 0
+        for partition in range(self.PARTITIONS):
+            total += (await self.redis.xpending(STREAM.format(partition), GROUP))['pending']
+        return total
+
+    async def test_per_user_order(self):
+        await self.connect()
+        handled = []
+        consumers = [self.make_consumer(self.make_dispatcher(handled), f"w{i}") for i in range(2)]
+        await self.ingest(30)
+        await self.run_until(consumers, lambda: len(handled) == 30)
+
+        self.assertEqual(len(handled), 30)
+        for user_id in (1, 2, 3):
+            ids = [message_id for user, message_id in handled if user == user_id]
+            self.assertEqual(ids, sorted(ids))
+        # Everything acknowledged
+        self.assertEqual(await self.pending(), 0)
+
+    async def test_streams_are_capped_by_memory(self):
+        from aiogram import Bot, Dispatcher
+        from aiogram.types import Update
+        from services.update_stream import MIN_MAXLEN, IngestMiddleware
+
+        await self.connect()
+        ingest = IngestMiddleware(self.redis, partitions=4, max_mb=16)
+        receiver = Dispatcher()
+        receiver.update.outer_middleware(ingest)
+        bot = Bot("123456:TEST")
+        for i in range(1, 301):
+            await receiver.feed_update(bot, Update.model_validate({
+                'update_id': i,
+                'message': {
+                    'message_id': i, 'date': 0, 'text': "x" * 4000,
+                    'chat': {'id': 1, 'type': 'private'},
+                    'from': {'id': 1, 'is_bot': False, 'first_name': "Ola"},
+                },
+            }))
+        # The cap follows the update size: 4 MB per partition of ~4 KB updates
+        self.assertLess(abs(ingest.entry_size - 4200), 300)
+        self.assertLess(abs(ingest.maxlen - 1000), 100)
+
+        ingest.budget = 1024
+        self.assertEqual(ingest.maxlen, MIN_MAXLEN)
+
+    async def test_partitions_are_split(self):
+        await self.connect()
+        first, second = self.make_consumer(self.make_dispatcher([]), "w1"), self.make_consumer(self.make_dispatcher([]), "w2")
+        await first.ensure_groups()
+        await first.balance()
+        self.assertEqual(len(first.owned), self.PARTITIONS)
+
+        await second.balance()
+        await first.balance()       # sees the second worker, gives half away
+        await second.balance()
+        self.assertEqual(len(first.owned), self.PARTITIONS // 2)
+        self.assertEqual(first.owned | second.owned, set(range(self.PARTITIONS)))
+        self.assertFalse(first.owned & second.owned)
+
+    async def test_crashed_worker_entries_are_reclaimed(self):
+        from services.update_stream import GROUP, STREAM
+
+        await self.connect()
+        await self.ingest(9)
+        crashed = self.make_consumer(self.make_dispatcher([]), "crashed")
+        await crashed.ensure_groups()
+        # Read everything and die without acknowledging (its leases are gone after expiry)
+        for partition in range(self.PARTITIONS):
+            await self.redis.xreadgroup(GROUP, "crashed", {STREAM.format(partition): '>'})
+        self.assertEqual(await self.pending(), 9)
+
+        handled = []
+        survivor = self.make_consumer(self.make_dispatcher(handled), "survivor")
+        await self.run_until([survivor], lambda: len(handled) == 9)
+        self.assertEqual(sorted(message_id for _, message_id in handled), list(range(1, 10)))
+        self.assertEqual(survivor.reclaimed, 9)
+        self.assertEqual(await self.pending(), 0)
+
+    async def test_stalled_worker_entries_wait_for_its_handlers(self):
+        from services.update_stream import GROUP, STREAM, partition_of
+
+        await self.connect()
+        await self.ingest(9)
+        stalled = self.make_consumer(self.make_dispatcher([]), "stalled")
+        await stalled.ensure_groups()
+        for partition in range(self.PARTITIONS):
+            await self.redis.xreadgroup(GROUP, "stalled", {STREAM.format(partition): '>'})
+
+        busy = {partition_of(user_id, self.PARTITIONS) for user_id in (1, 2, 3)}
+
+        successor = self.make_consumer(self.make_dispatcher([]), "successor")
+        await successor.balance()
+        # Leased, but neither read nor claimed while the old handlers may still run
+        self.assertFalse(successor.owned & busy)
+        self.assertEqual(successor.reclaimed, 0)
+
+        await asyncio.sleep(0.35)
+        await successor.balance()
+        self.assertEqual(successor.reclaimed, 9)
+        self.assertEqual(successor.owned, set(range(self.PARTITIONS)))
+        await successor.shutdown()
+
+    async def test_nothing_is_handled_or_acked_after_the_lease_ran_out(self):
+        from services.update_stream import GROUP, STREAM, partition_of
+
+        await self.connect()
+        await self.ingest(3, users=(1,))
+        handled = []
+        consumer = self.make_consumer(self.make_dispatcher(handled), "w1")
+        await consumer.ensure_groups()
+        await consumer.balance()
+        partition = partition_of(1, self.PARTITIONS)
+        # Stalled past the lease: balance() hasn't noticed yet
+        consumer._lease_until[partition] = 0
+
+        response = await self.redis.xreadgroup(GROUP, "w1", {STREAM.format(partition): '>'})
+        for _, entries in response:
+            for entry_id, fields in entries:
+                consumer.schedule(partition, entry_id, fields)
+        await asyncio.wait(list(consumer._tails.values()))
+
+        self.assertEqual(handled, [])
+        self.assertEqual(consumer.skipped, 3)
+        self.assertEqual(await self.pending(), 3)      # left for the next owner
+
+
+@unittest.skipUnless(redis_available(), "needs a Redis server (REDIS_HOST)")
+class CachedStorageTests(SimpleTestCase):
+    """
+    FSM cache in front of RedisStorage: one pipelined write per update, reads from memory,
+    and the keys stay readable by a plain RedisStorage. Uses Redis db 15 and flushes it.
+    """
+
+    async def make_storage(self, **kwargs):
+        from aiogram.fsm.storage.redis import RedisStorage
+        from redis.asyncio import Redis
+        from config import REDIS_HOST, REDIS_PORT
+        from services.fsm_storage import CachedStorage
+
+        redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=15)
+        await redis.flushdb()
+        plain = RedisStorage(redis=redis, state_ttl=60, data_ttl=60)
+        return CachedStorage(plain, **kwargs), plain
+
+    def make_dispatcher(self, storage, handler):
+        from aiogram import Router
+        from services.fsm_storage import FlushMiddleware
+        from services.update_stream import OrderedDispatcher
+
+        router = Router()
+        router.message()(handler)
+        dp = OrderedDispatcher(storage=storage)
+        dp.update.outer_middleware(FlushMiddleware(storage))
+        dp.include_router(router)
+        return dp
+
+    @staticmethod
+    def update(update_id: int, user_id: int = 5):
+        from aiogram.types import Update
+
+        return Update.model_validate({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': 0, 'text': "hei",
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': "Ola"},
+            },
+        })
+
+    async def test_update_writes_once(self):
+        from aiogram import Bot
+        from states import Learning
+
+        storage, plain = await self.make_storage()
+        seen = []
+
+        async def handler(message, state: FSMContext):
+            seen.append(await state.get_state())
+            if message.message_id > 1:
+                return
+            await state.set_state(Learning.waiting_for_text_answer)
+            await state.update_data(lesson_id=7)
+            await state.update_data(attempts=1)
+            # Not in Redis yet, but the handler sees its own writes
+            self.assertEqual(await plain.get_data(state.key), {})
+            self.assertEqual(await state.get_data(), {'lesson_id': 7, 'attempts': 1})
+
+        dp = self.make_dispatcher(storage, handler)
+        await dp.feed_update(Bot("123456:TEST"), self.update(1))
+
+        self.assertEqual(seen, [None])
+        self.assertEqual((storage.writes, storage.misses), (1, 1))
+        key = StorageKey(bot_id=123456, chat_id=5, user_id=5)
+        self.assertEqual(await plain.get_state(key), Learning.waiting_for_text_answer.state)
+        self.assertEqual(await plain.get_data(key), {'lesson_id': 7, 'attempts': 1})
+
+        # Next update of the user: read from memory
+        await dp.feed_update(Bot("123456:TEST"), self.update(2))
+        self.assertEqual(seen[-1], Learning.waiting_for_text_answer.state)
+        self.assertEqual(storage.misses, 1)
+
+    async def test_write_outside_update_and_remote_change(self):
+        storage, plain = await self.make_storage(origin="me")
+        key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+        # Scheduler path: no update around - written at once, empty data deleted instead of "{}"
+        await storage.set_state(key, "Registration:waiting_for_access_code")
+        self.assertEqual(await plain.get_state(key), "Registration:waiting_for_access_code")
+        self.assertFalse(await plain.redis.exists(storage.key_builder.build(key, "data")))
+
+        # Another process changes the state and announces it
+        await plain.set_state(key, None)
+        self.assertEqual(await storage.get_state(key), "Registration:waiting_for_access_code")
+        storage.on_remote_change(f"me {storage.key_builder.build(key)}")
+        self.assertIsNotNone(await storage.get_state(key))
+        storage.on_remote_change(f"other {storage.key_builder.build(key)}")
+        self.assertIsNone(await storage.get_state(key))
+
+    async def test_lru_bound(self):
+        storage, _ = await self.make_storage(size=3)
+        for user_id in range(10):
+            await storage.get_state(StorageKey(bot_id=1, chat_id=user_id, user_id=user_id))
+        self.assertEqual(storage.stats()['cached'], 3)
+
+    async def test_concurrent_misses_share_one_entry(self):
+        storage, plain = await self.make_storage()
+        key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+        # Both miss at once: with separate entries the second write would drop the state
+        await asyncio.gather(storage.set_state(key, "Learning:waiting_for_text_answer"), storage.set_data(key, {'a': 1}))
+        self.assertEqual(storage.misses, 1)
+        self.assertEqual(await plain.get_state(key), "Learning:waiting_for_text_answer")
+        self.assertEqual(await plain.get_data(key), {'a': 1})
+
+    async def test_updates_of_a_user_run_one_after_another(self):
+        from aiogram import Bot
+
+        storage, plain = await self.make_storage()
+
+        async def handler(message, state: FSMContext):
+            count = (await state.get_data()).get('count', 0)
+            await asyncio.sleep(0.01)
+            await state.update_data(count=count + 1)
+
+        dp = self.make_dispatcher(storage, handler)
+        bot = Bot("123456:TEST")
+        # Polling/webhook: every update in its own task
+        await asyncio.gather(*(dp.feed_update(bot, self.update(i)) for i in range(1, 6)))
+
+        key = StorageKey(bot_id=123456, chat_id=5, user_id=5)
+        self.assertEqual(await plain.get_data(key), {'count': 5})
+        self.assertFalse(dp._users)
+
+
+@unittest.skipUnless(redis_available(), "needs a Redis server (REDIS_HOST)")
+class CompactStorageTests(SimpleTestCase):
+    """
+    One msgpack hash per user; empty data is not stored; users in the RedisStorage layout are moved over.
+    Uses Redis db 15 and flushes it.
+    """
+
+    async def connect(self):
+        from redis.asyncio import Redis
+        from config import REDIS_HOST, REDIS_PORT
+
+        redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=15)
+        await redis.flushdb()
+        return redis
+
+    async def test_one_hash_per_user(self):
+        from services.fsm_storage import CompactRedisStorage
+
+        redis = await self.connect()
+        storage = CompactRedisStorage(redis, ttl=60)
+        key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+        await storage.set_state(key, "Learning:waiting_for_text_answer")
+        await storage.update_data(key, {'lesson_id': 7})
+        self.assertEqual(await redis.keys(), [b"fsm:5:5"])
+        self.assertEqual(await storage.get_state(key), "Learning:waiting_for_text_answer")
+        self.assertEqual(await storage.get_data(key), {'lesson_id': 7})
+        self.assertGreater(await redis.ttl("fsm:5:5"), 0)
+
+        # Empty data is a missing field, not "{}"; nothing left - no key
+        await storage.set_data(key, {})
+        self.assertEqual(await redis.hkeys("fsm:5:5"), [b"s"])
+        await storage.set_state(key, None)
+        self.assertEqual(await redis.keys(), [])
+
+    async def test_legacy_keys_are_migrated(self):
+        from aiogram.fsm.storage.redis import RedisStorage
+        from services.fsm_storage import CompactRedisStorage
+
+        redis = await self.connect()
+        key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+        legacy = RedisStorage(redis=redis)
+        await legacy.set_state(key, "Support:waiting_for_message")
+        await legacy.set_data(key, {'attempts': 2})
+        await legacy.set_data(StorageKey(bot_id=1, chat_id=6, user_id=6), {'lesson_id': 1})
+
+        storage = CompactRedisStorage(redis)
+        self.assertEqual(await storage.migrate_legacy_keys(), 2)
+        self.assertEqual(await storage.load(key), ("Support:waiting_for_message", {'attempts': 2}))
+        self.assertEqual(await storage.get_data(StorageKey(bot_id=1, chat_id=6, user_id=6)), {'lesson_id': 1})
+        self.assertEqual(sorted(await redis.keys()), [b"fsm:5:5", b"fsm:6:6"])
+        self.assertEqual(await storage.migrate_legacy_keys(), 0)
+
+    async def test_behind_the_cache(self):
+        from services.fsm_storage import CachedStorage, CompactRedisStorage, _pending
+
+        redis = await self.connect()
+        compact = CompactRedisStorage(redis)
+        storage = CachedStorage(compact)
+        key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+        token = _pending.set({})
+        await storage.set_state(key, "Learning:waiting_for_text_answer")
+        await storage.update_data(key, {'lesson_id': 7})
+        changes = _pending.get()
+        _pending.reset(token)
+        await storage.write(changes)
+
+        self.assertEqual(storage.writes, 1)
+        self.assertEqual(await compact.load(key), ("Learning:waiting_for_text_answer", {'lesson_id': 7}))
+
+
+@unittest.skipUnless(redis_available(), "needs a Redis server (REDIS_HOST)")
+class ThrottlingTests(SimpleTestCase):
+    """
+    Token buckets in Redis per user and handler group; a throttled update never reaches the handlers;
+    wrong access codes are remembered. Uses Redis db 15 and flushes it.
+    """
+
+    async def connect(self):
+        from redis.asyncio import Redis
+        from config import REDIS_HOST, REDIS_PORT
+
+        redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=15)
+        await redis.flushdb()
+        return redis
+
+    @staticmethod
+    def update(update_id: int, user_id: int = 5, text: str = "hei"):
+        from aiogram.types import Update
+
+        return Update.model_validate({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': 0, 'text': text,
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': "Ola"},
+            },
+        })
+
+    async def test_burst_then_throttle(self):
+        from services.throttling import ThrottlingMiddleware
+
+        redis = await self.connect()
+        throttling = ThrottlingMiddleware(redis, rules={'code': (0.01, 3), 'default': (0.01, 5)})
+        handler = AsyncMock()
+        user = SimpleNamespace(id=5)
+        code_state = {'event_from_user': user, 'raw_state': "Registration:waiting_for_access_code"}
+
+        with mock.patch("aiogram.types.Message.answer", new=AsyncMock()) as answer:
+            for update_id in range(1, 6):
+                await throttling(handler, self.update(update_id), dict(code_state))
+            self.assertEqual(handler.await_count, 3)
+            # Told once, the rest are dropped silently
+            self.assertEqual(answer.await_count, 1)
+
+            # Other groups and other users have their own buckets
+            await throttling(handler, self.update(6), {'event_from_user': user, 'raw_state': None})
+            await throttling(handler, self.update(7, user_id=6), {**code_state, 'event_from_user': SimpleNamespace(id=6)})
+        self.assertEqual(handler.await_count, 5)
+        self.assertEqual(throttling.stats()['throttled'], {'code': 2, 'default': 0})
+        self.assertEqual(throttling.stats()['allowed'], {'code': 4, 'default': 1})
+        self.assertGreater(await redis.pttl("throttle:code:5"), 0)
+
+    async def test_redis_down_lets_updates_through(self):
+        from redis.asyncio import Redis
+        from services.throttling import ThrottlingMiddleware
+
+        throttling = ThrottlingMiddleware(Redis(port=1, socket_connect_timeout=0.1))
+        handler = AsyncMock(return_value="ok")
+        result = await throttling(handler, self.update(1), {'event_from_user': SimpleNamespace(id=5)})
+        self.assertEqual(result, "ok")
+        self.assertEqual(throttling.stats()['redis_errors'], 1)
+
+    async def test_group_of(self):
+        from aiogram.types import Update
+        from services.throttling import group_of
+
+        callback = Update.model_validate({
+            'update_id': 1,
+            'callback_query': {
+                'id': "1", 'chat_instance': "1", 'data': "ans:3:1",
+                'from': {'id': 5, 'is_bot': False, 'first_name': "Ola"},
+            },
+        })
+        self.assertEqual(group_of(callback, None), 'answer')
+        self.assertEqual(group_of(self.update(1), "Learning:waiting_for_text_answer"), 'answer')
+        self.assertEqual(group_of(self.update(1), "Registration:waiting_for_access_code"), 'code')
+        self.assertEqual(group_of(self.update(1), None), 'default')
+
+    async def test_missing_code_skips_activation(self):
+        from handlers.registration import process_code
+        from redis import Redis as SyncRedis
+        from config import REDIS_HOST, REDIS_PORT
+        from services.activation import Activation
+        from services.throttling import forget_missing_codes, missing_codes
+
+        redis = await self.connect()
+        missing_codes.connect(redis)
+        self.addCleanup(missing_codes.connect, None)
+
+        activate = mock.Mock(return_value=Activation("not_found", [], []))
+        with mock.patch("handlers.registration.activate_code", activate):
+            await process_code(fake_message(5, "NOPE"), fake_state(5), bot_user=SimpleNamespace(id=1))
+            await process_code(fake_message(5, " NOPE "), fake_state(5), bot_user=SimpleNamespace(id=1))
+        self.assertEqual(activate.call_count, 1)
+        self.assertEqual(missing_codes.hits, 1)
+
+        # A code created later is not "missing" anymore
+        sync = SyncRedis(host=REDIS_HOST, port=REDIS_PORT, db=15)
+        with mock.patch("services.throttling.transaction.on_commit", lambda func: func()), \
+                mock.patch("services.throttling.events.run_sync", lambda what, call: call(sync)):
+            forget_missing_codes(["NOPE"])
+        self.assertFalse(await missing_codes.is_missing("NOPE"))
+
+
+@unittest.skipUnless(redis_available(), "needs a Redis server (REDIS_HOST)")
+class DedupTests(SimpleTestCase):
+    """
+    A redelivered update_id is handled once; a failed update may be handled again.
+    Uses Redis db 15 and flushes it.
+    """
+
+    async def connect(self):
+        from redis.asyncio import Redis
+        from config import REDIS_HOST, REDIS_PORT
+
+        redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=15)
+        await redis.flushdb()
+        return redis
+
+    async def test_duplicates_are_skipped(self):
+        from aiogram import Bot, Dispatcher, Router
+        from services.dedup import BLOCK_BITS, DedupMiddleware
+
+        redis = await self.connect()
+        dedup = DedupMiddleware(redis, ttl=60)
+        seen = []
+        router = Router()
+
+        @router.message()
+        async def handler(message):
+            seen.append(message.message_id)
+            if message.text == "boom":
+                raise RuntimeError("boom")
+
+        dp = Dispatcher()
+        dp.update.outer_middleware(dedup)
+        dp.include_router(router)
+        bot = Bot("123456:TEST")
+
+        for update_id in (1, 2, 1, BLOCK_BITS + 1, 2):
+            await dp.feed_update(bot, ThrottlingTests.update(update_id))
+        self.assertEqual(seen, [1, 2, BLOCK_BITS + 1])
+        self.assertEqual(dedup.stats()['duplicates'], 2)
+        self.assertEqual(dedup.stats()['duplicate_rate'], 0.4)
+        # One bitmap per block of update_ids, each with a TTL
+        self.assertEqual(sorted(await redis.keys()), [b"updates:seen:0", b"updates:seen:1"])
+        self.assertGreater(await redis.ttl("updates:seen:1"), 0)
+
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                await dp.feed_update(bot, ThrottlingTests.update(3, text="boom"))
+        self.assertEqual(seen[-2:], [3, 3])
+        await bot.session.close()
+
+    async def test_update_cut_by_worker_timeout_is_handled_again(self):
+        import json
+        import time
+        from aiogram import Bot, Dispatcher, Router
+        from services.dedup import DedupMiddleware
+        from services.update_stream import UpdateConsumer
+
+        redis = await self.connect()
+        seen = []
+        router = Router()
+
+        @router.message()
+        async def handler(message):
+            seen.append(message.message_id)
+            if len(seen) == 1:
+                await asyncio.sleep(10)     # hangs the first time
+
+        dp = Dispatcher()
+        dp.update.outer_middleware(DedupMiddleware(redis, ttl=60))
+        dp.include_router(router)
+        consumer = UpdateConsumer(dp, Bot("123456:TEST"), redis, consumer="w1", partitions=1, handle_timeout=0.1)
+        consumer._lease_until[0] = time.monotonic() + 60
+        fields = {b'k': b'5', b'u': json.dumps(ThrottlingTests.update(7).model_dump(mode='json', exclude_none=True))}
+
+        # Cut off by the timeout, then delivered again (reclaim): handled, not skipped as a duplicate
+        for _ in range(2):
+            consumer.schedule(0, "1-0", fields)
+            await asyncio.wait(list(consumer._tails.values()))
+        self.assertEqual(seen, [7, 7])
+        self.assertEqual((consumer.failed, consumer.handled), (1, 1))
+
+
+class IdentityTests(TestCase):
+    """
+    BotUser of the sender: resolved once, served from memory, created with one upsert,
+    name changes written in one batch.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = BotUser.objects.create(telegram_id=111, username="ola", first_name="Ola")
+
+    @staticmethod
+    def sender(user_id: int, username: str = "ola", first_name: str = "Ola"):
+        return SimpleNamespace(id=user_id, is_bot=False, username=username, first_name=first_name)
+
+    def make_identity(self):
+        from services.identity import Identity
+
+        identity = Identity(size=10, ttl=60)
+        identity.start()
+        return identity
+
+    def test_cached_and_created(self):
+        identity = self.make_identity()
+
+        with self.assertNumQueries(2):
+            self.assertEqual(async_to_sync(identity.get)(self.sender(111)), self.user)
+            self.assertEqual(async_to_sync(identity.get)(self.sender(111)), self.user)
+            # Unknown users are remembered too
+            self.assertIsNone(async_to_sync(identity.get)(self.sender(222)))
+        user, created = async_to_sync(identity.ensure)(self.sender(222, "kari", "Kari"))
+        self.assertTrue(created)
+        self.assertEqual(BotUser.objects.get(telegram_id=222).pk, user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(identity.ensure)(self.sender(222, "kari", "Kari")), (user, False))
+        self.assertEqual(identity.stats()['misses'], 2)
+
+    def test_created_user_is_announced(self):
+        from services import identity as identity_module
+
+        identity = self.make_identity()
+        with mock.patch.object(identity_module, "publish") as publish:
+            async_to_sync(identity.ensure)(self.sender(111))
+            publish.assert_not_called()
+            async_to_sync(identity.ensure)(self.sender(222, "kari", "Kari"))
+        # The other processes drop their cached "no row"
+        publish.assert_called_once_with(identity_module.USERS_CHANGED, "222")
+
+    def test_user_inserted_by_another_process_is_not_created(self):
+        from services import identity as identity_module
+
+        identity = self.make_identity()
+        self.assertIsNone(async_to_sync(identity.get)(self.sender(222)))
+        # Another process inserts the row after this one cached "no row"
+        BotUser.objects.create(telegram_id=222, username="kari", first_name="Kari")
+
+        with mock.patch.object(identity_module, "publish") as publish:
+            user, created = async_to_sync(identity.ensure)(self.sender(222, "kari_n", "Kari"))
+        self.assertFalse(created)
+        self.assertEqual(user.pk, BotUser.objects.get(telegram_id=222).pk)
+        self.assertEqual(identity.stats()['created'], 0)
+        publish.assert_not_called()
+        # The name it came with is written by the next batch
+        async_to_sync(identity.flush)()
+        self.assertEqual(BotUser.objects.get(telegram_id=222).username, "kari_n")
+
+    def test_names_refreshed_in_one_batch(self):
+        identity = self.make_identity()
+        BotUser.objects.create(telegram_id=222, username="kari", first_name="Kari")
+
+        async_to_sync(identity.get)(self.sender(111, "ola_n", "Ola"))
+        async_to_sync(identity.get)(self.sender(222, "kari", "Kari N"))
+        with self.assertNumQueries(1):
+            async_to_sync(identity.flush)()
+        self.assertEqual(
+            list(BotUser.objects.order_by('telegram_id').values_list('username', 'first_name')),
+            [("ola_n", "Ola"), ("kari", "Kari N")],
+        )
+        with self.assertNumQueries(0):
+            async_to_sync(identity.flush)()
+
+    def test_admin_delete_drops_cached_user(self):
+        from services import identity as identity_module
+
+        identity = self.make_identity()
+        async_to_sync(identity.get)(self.sender(111))
+        with mock.patch.object(identity_module, "identity", identity), self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        self.assertNotIn(111, identity._cache)
+
+    def test_middleware_passes_bot_user(self):
+        from services.identity import UserMiddleware
+
+        middleware = UserMiddleware(self.make_identity())
+        handler = AsyncMock()
+        private = SimpleNamespace(type="private")
+        async_to_sync(middleware)(handler, None, {'event_from_user': self.sender(111), 'event_chat': private})
+        self.assertEqual(handler.await_args.args[1]['bot_user'], self.user)
+
+        # The support group: curators are not students
+        group = SimpleNamespace(type="supergroup")
+        async_to_sync(middleware)(handler, None, {'event_from_user': self.sender(111), 'event_chat': group})
+        self.assertNotIn('bot_user', handler.await_args.args[1])
+
+    def test_quiz_answer_with_resolved_user(self):
+        from handlers.learning import check_quiz_answer
+
+        course = Course.objects.create(title="Norsk A1")
+        lesson = Lesson.objects.create(
+            course=course, day_number=1, lesson_type='quiz', quiz_options="Ja\nNei", correct_answer="Ja"
+        )
+        catalog.invalidate()
+        catalog.load()
+        callback = SimpleNamespace(
+            data=f"ans:{lesson.id}:Ja", from_user=SimpleNamespace(id=111),
+            message=fake_message(111), answer=AsyncMock(),
+        )
+        # Only the progress INSERT
+        with self.assertNumQueries(1):
+            async_to_sync(check_quiz_answer)(callback, bot=None, bot_user=self.user)
+        self.assertTrue(UserProgress.objects.filter(user=self.user, lesson=lesson).exists())
+
+
+class ActivationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.courses = [Course.objects.create(title=f"Kurs {i}") for i in (1, 2)]
+        for course in cls.courses:
+            Lesson.objects.create(course=course, day_number=2, text="Hei")
+        cls.code = AccessCode.objects.create(code="NORSK1")
+        cls.code.courses.set(cls.courses)
+        cls.user = BotUser.objects.create(telegram_id=111)
+        cls.other = BotUser.objects.create(telegram_id=222)
+
+    def test_activation(self):
+        from services.activation import activate_code
+
+        result = activate_code(111, "NORSK1")
+        self.assertEqual(result.status, 'activated')
+        self.assertCountEqual(result.course_ids, [course.id for course in self.courses])
+        self.assertEqual(Enrollment.objects.filter(user=self.user, is_active=True).count(), 2)
+        self.assertEqual(ScheduledDelivery.objects.filter(enrollment_id__in=result.enrollment_ids).count(), 2)
+
+        self.assertEqual(activate_code(111, "NORSK1").status, 'already_activated')
+        self.assertEqual(activate_code(222, "NORSK1").status, 'taken')
+        self.assertEqual(activate_code(222, "NOPE").status, 'not_found')
+        self.assertEqual(activate_code(333, "NORSK1").status, 'unknown_user')
+
+    def test_finished_courses_start_over(self):
+        from services.activation import activate_code
+
+        old = Enrollment.objects.create(user=self.user, course=self.courses[0], current_day=7, is_active=False)
+        self.assertEqual(activate_code(111, "NORSK1").status, 'activated')
+        old.refresh_from_db()
+        self.assertTrue(old.is_active)
+        self.assertEqual(old.current_day, 1)
+        self.assertEqual(Enrollment.objects.filter(user=self.user).count(), 2)
+
+    def test_already_enrolled(self):
+        from services.activation import activate_code
+
+        Enrollment.objects.create(user=self.user, course=self.courses[0])
+        self.assertEqual(activate_code(111, "NORSK1").status, 'already_enrolled')
+        self.assertEqual(Enrollment.objects.filter(user=self.user).count(), 1)
+
+    def test_inactive_and_empty_codes(self):
+        from services.activation import activate_code
+
+        AccessCode.objects.create(code="OFF", is_active=False)
+        AccessCode.objects.create(code="EMPTY")
+        self.assertEqual(activate_code(111, "OFF").status, 'inactive')
+        self.assertEqual(activate_code(111, "EMPTY").status, 'no_courses')
+        self.assertFalse(AccessCode.objects.filter(code="EMPTY", activated_by__isnull=False).exists())
+
+    def test_round_trips(self):
+        from services.activation import activate_code
+
+        # user, locked code, courses, claim, active check, upsert + the planner
+        with CaptureQueriesContext(connection) as ctx:
+            activate_code(111, "NORSK1")
+        self.assertLessEqual(len(ctx.captured_queries), 12)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Row locks need Postgres")
+class ActivationRaceTests(TransactionTestCase):
+    """
+    Many users redeem the same code at the same moment: exactly one gets it.
+    """
+
+    def test_concurrent_redemption(self):
+        from services.activation import activate_code
+
+        course = Course.objects.create(title="Kurs")
+        code = AccessCode.objects.create(code="RACE")
+        code.courses.add(course)
+        users = [BotUser.objects.create(telegram_id=1000 + i) for i in range(8)]
+
+        barrier = threading.Barrier(len(users))
+        statuses = []
+
+        def redeem(telegram_id):
+            try:
+                barrier.wait()
+                statuses.append(activate_code(telegram_id, "RACE").status)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=redeem, args=(user.telegram_id,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses.count('activated'), 1)
+        self.assertEqual(statuses.count('taken'), len(users) - 1)
+        self.assertEqual(Enrollment.objects.filter(course=course).count(), 1)
+
+
+class AccessCodeBatchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.courses = [Course.objects.create(title=f"Kurs {i}") for i in (1, 2)]
+        cls.course_ids = [course.id for course in cls.courses]
+
+    def test_generate(self):
+        from services import codes
+
+        with mock.patch.object(codes, 'CHUNK_SIZE', 100):
+            generated = [code for chunk in codes.generate_codes(250, self.course_ids, alphabet="ABC123", length=8) for code in chunk]
+        self.assertEqual(len(generated), 250)
+        self.assertEqual(len(set(generated)), 250)
+        self.assertTrue(all(len(code) == 8 and set(code) <= set("ABC123") for code in generated))
+        self.assertEqual(AccessCode.objects.count(), 250)
+        self.assertEqual(AccessCode.courses.through.objects.count(), 500)
+
+    def test_code_space_too_small(self):
+        from services import codes
+
+        with self.assertRaises(ValueError):
+            list(codes.generate_codes(1000, self.course_ids, alphabet="AB", length=6))
+
+    def test_collisions_are_skipped(self):
+        from services import codes
+
+        AccessCode.objects.create(code="AAAAAAAA")
+        # Every candidate is the existing code: never inserted twice, gives up after MAX_ATTEMPTS
+        with mock.patch.object(codes.secrets, 'choice', side_effect=lambda alphabet: "A"):
+            with self.assertRaises(RuntimeError):
+                list(codes.generate_codes(1, self.course_ids, alphabet="AB", length=8))
+        self.assertEqual(AccessCode.objects.count(), 1)
+
+    def test_import(self):
+        from services import codes
+
+        AccessCode.objects.create(code="OLD1")
+        stats = codes.import_codes(["code\n", "NEW1\n", "NEW2;x\n", "OLD1\n", "NEW1\n", "\n", "X" * 30 + "\n"], self.course_ids)
+        self.assertEqual(stats, {'created': 2, 'existing': 2, 'invalid': 1})
+        self.assertEqual(set(AccessCode.objects.get(code="NEW1").courses.all()), set(self.courses))
+
+    def test_admin_action(self):
+        from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+        from django.contrib.auth.models import User
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "pass"))
+        url = "/admin/core/course/"
+        data = {'action': 'generate_access_codes', ACTION_CHECKBOX_NAME: self.course_ids}
+
+        page = self.client.post(url, data)
+        self.assertContains(page, "Сколько кодов создать")
+
+        response = self.client.post(url, {**data, 'apply': '1', 'count': 30, 'length': 8, 'alphabet': "ABCDEFGH2345"})
+        rows = b"".join(response.streaming_content).decode().split()
+        self.assertEqual(rows[0], "code")
+        self.assertEqual(len(rows), 31)
+        self.assertEqual(AccessCode.objects.count(), 30)
+
+        upload = SimpleUploadedFile("codes.csv", b"IMP1\nIMP2\n")
+        response = self.client.post(url, {**data, 'apply': '1', 'length': 8, 'alphabet': "AB", 'file': upload})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(AccessCode.objects.filter(code="IMP2", courses=self.courses[1]).exists())
+
+
+class DeliveryPlanTests(TestCase):
+    """
+    The materialized delivery plan: filled on enrollment, claimed by the scheduler, marked sent.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(title="Norsk A1", duration_days=2)
+        cls.lessons = [
+            Lesson.objects.create(course=cls.course, day_number=day, send_time=time(9, 0), text=f"Dag {day}")
+            for day in (1, 2)
+        ]
+        cls.user = BotUser.objects.create(telegram_id=111)
+
+    def setUp(self):
+        catalog.invalidate()
+
+    def at(self, instant):
+        from services import clock
+
+        # The scheduler's "now" (lease expiry included)
+        clock.set_source(lambda: instant)
+        self.addCleanup(clock.set_source, None)
+        return instant
+
+    def enroll(self, **kwargs):
+        from services.planner import plan_enrollments
+
+        enrollment = Enrollment.objects.create(user=self.user, course=self.course, **kwargs)
+        plan_enrollments([enrollment.id])
+        return enrollment
+
+    def test_plan_claim_mark_sent(self):
+        from services.planner import compute_due_at
+        from services.scheduler import claim_due_blocks, mark_deliveries
+
+        enrollment = self.enroll()
+        plan = list(ScheduledDelivery.objects.filter(enrollment=enrollment).order_by('day_number'))
+        self.assertEqual([row.day_number for row in plan], [1, 2])
+        self.assertEqual(plan[0].due_at, compute_due_at(enrollment.start_date, 1, time(9, 0)))
+        self.assertTrue(all(row.status == 'pending' for row in plan))
+
+        # Day 1 is due: one block with its lesson, leased to this worker
+        blocks = claim_due_blocks(self.at(plan[0].due_at))
+        self.assertEqual([(block.delivery_id, [lesson.id for lesson in block.lessons]) for block in blocks],
+                         [(plan[0].id, [self.lessons[0].id])])
+        self.assertFalse(blocks[0].is_last)
+        claimed = ScheduledDelivery.objects.get(id=plan[0].id)
+        self.assertEqual(claimed.status, 'sending')
+        self.assertIsNotNone(claimed.claimed_until)
+        self.assertEqual(claim_due_blocks(plan[0].due_at), [])
+
+        async_to_sync(mark_deliveries)([plan[0].id], 'sent')
+        self.assertEqual(ScheduledDelivery.objects.get(id=plan[0].id).status, 'sent')
+
+        # Day 2 is the last block of the course
+        blocks = claim_due_blocks(self.at(plan[1].due_at))
+        self.assertEqual([block.delivery_id for block in blocks], [plan[1].id])
+        self.assertTrue(blocks[0].is_last)
+
+    def test_block_is_one_day_and_time_without_sent_lessons(self):
+        from services.scheduler import claim_due_blocks
+
+        morning = Lesson.objects.create(course=self.course, day_number=1, send_time=time(9, 0), text="Ord")
+        Lesson.objects.create(course=self.course, day_number=1, send_time=time(18, 0), text="Kveld")
+        enrollment = self.enroll()
+        # Already sent before (the course was restarted): not repeated
+        UserProgress.objects.create(user=self.user, lesson=self.lessons[0])
+
+        nine = ScheduledDelivery.objects.get(enrollment=enrollment, day_number=1, send_time=time(9, 0))
+        blocks = claim_due_blocks(nine.due_at)
+        self.assertEqual(len(blocks), 1)
+        self.assertEqual(blocks[0].delivery_id, nine.id)
+        self.assertEqual([lesson.id for lesson in blocks[0].lessons], [morning.id])
+        self.assertEqual((blocks[0].telegram_id, blocks[0].course_title), (111, "Norsk A1"))
+
+    def send_day1(self, send_message):
+        from services import scheduler as module
+        from services.pipeline import pipeline
+
+        Lesson.objects.create(course=self.course, day_number=1, send_time=time(9, 0), text="Ord")
+        enrollment = self.enroll()
+        day1 = ScheduledDelivery.objects.get(enrollment=enrollment, day_number=1)
+        bot = SimpleNamespace(send_message=AsyncMock(side_effect=send_message))
+        with mock.patch.object(pipeline, "per_chat_interval", 0), mock.patch.object(pipeline, "BACKOFF", 0), \
+                mock.patch.object(module.scheduler, "wake") as wake:
+            async_to_sync(module.check_and_send_lessons)(bot, None, self.at(day1.due_at))
+        due_at = day1.due_at
+        day1.refresh_from_db()
+        return day1, due_at, wake
+
+    def test_failed_lesson_is_not_recorded(self):
+        from aiogram.exceptions import TelegramForbiddenError
+        from aiogram.methods import SendMessage
+
+        async def send_message(chat_id, text, **kwargs):
+            if text == "Ord":
+                raise TelegramForbiddenError(SendMessage(chat_id=chat_id, text=text), "bot was blocked by the user")
+
+        day1, _, _ = self.send_day1(send_message)
+        # The first lesson got through, the second did not
+        self.assertEqual(day1.status, 'failed')
+        self.assertEqual(list(UserProgress.objects.values_list('lesson_id', flat=True)), [self.lessons[0].id])
+
+    def test_block_is_retried_when_telegram_is_down(self):
+        from aiogram.exceptions import TelegramNetworkError
+        from aiogram.methods import SendMessage
+        from config import SCHEDULER_RETRY_SECONDS
+
+        async def send_message(chat_id, text, **kwargs):
+            raise TelegramNetworkError(SendMessage(chat_id=chat_id, text=text), "timeout")
+
+        day1, due_at, wake = self.send_day1(send_message)
+        self.assertEqual((day1.status, day1.claimed_by), ('pending', ''))
+        self.assertEqual(day1.due_at, due_at + timedelta(seconds=SCHEDULER_RETRY_SECONDS))
+        self.assertFalse(UserProgress.objects.exists())
+        wake.assert_called_once()
+
+    def test_catch_up_after_downtime(self):
+        from config import SCHEDULER_CATCHUP_HOURS, SCHEDULER_WORKER_ID
+        from services.scheduler import recover_backlog
+
+        enrollment = self.enroll()
+        now = timezone.now()
+        day1, day2 = ScheduledDelivery.objects.filter(enrollment=enrollment).order_by('day_number')
+        # Day 1 was being sent by this worker when it went down two hours ago,
+        # day 2 is older than the catch-up horizon
+        ScheduledDelivery.objects.filter(id=day1.id).update(
+            due_at=now - timedelta(hours=2), status='sending', claimed_by=SCHEDULER_WORKER_ID,
+            claimed_until=now + timedelta(minutes=5),
+        )
+        ScheduledDelivery.objects.filter(id=day2.id).update(due_at=now - timedelta(hours=SCHEDULER_CATCHUP_HOURS + 1))
+
+        self.assertEqual(recover_backlog(now), 1)
+        day1.refresh_from_db()
+        self.assertEqual((day1.status, day1.claimed_by, day1.claimed_until), ('pending', '', None))
+        self.assertEqual(ScheduledDelivery.objects.get(id=day2.id).status, 'skipped')
+
+    def test_catch_up_starts_at_the_watermark(self):
+        from services.scheduler import recover_backlog, save_watermark
+
+        enrollment = self.enroll()
+        now = timezone.now()
+        day1, day2 = ScheduledDelivery.objects.filter(enrollment=enrollment).order_by('day_number')
+        # Processed until 30 minutes ago, then down: only day 2 came due in the gap.
+        # Day 1 is an ordinary due row (e.g. a late enrollment) - the regular tick sends it
+        async_to_sync(save_watermark)(now - timedelta(minutes=30))
+        ScheduledDelivery.objects.filter(id=day1.id).update(due_at=now - timedelta(hours=1))
+        ScheduledDelivery.objects.filter(id=day2.id).update(due_at=now - timedelta(minutes=10))
+
+        self.assertEqual(recover_backlog(now), 1)
+        self.assertEqual(ScheduledDelivery.objects.filter(status='pending').count(), 2)
+
+        # Up again right away: no gap, nothing to drain
+        async_to_sync(save_watermark)(now)
+        self.assertEqual(recover_backlog(now), 0)
+
+    def test_drain_in_batches(self):
+        from services import scheduler as module
+
+        before = timezone.now()
+        batches = AsyncMock(side_effect=[module.SCHEDULER_CATCHUP_BATCH, module.SCHEDULER_CATCHUP_BATCH, 3])
+        with mock.patch.object(module, "check_and_send_lessons", batches), \
+                mock.patch.object(module, "SCHEDULER_CATCHUP_PAUSE", 0):
+            async_to_sync(module.drain_backlog)(bot=None)
+        # Full batches go on, a short one means the backlog is empty
+        self.assertEqual(batches.await_count, 3)
+        self.assertEqual({call.kwargs['limit'] for call in batches.await_args_list}, {module.SCHEDULER_CATCHUP_BATCH})
+        self.assertTrue(before <= module.get_watermark() <= timezone.now())
+
+    def test_claim_of_a_dead_worker_is_taken_over(self):
+        from config import SCHEDULER_WORKER_ID
+        from services.scheduler import claim_due_blocks, extend_claims, mark_deliveries
+
+        enrollment = self.enroll()
+        day1 = ScheduledDelivery.objects.get(enrollment=enrollment, day_number=1)
+        ScheduledDelivery.objects.filter(id=day1.id).update(
+            status='sending', claimed_by="other", claimed_until=day1.due_at + timedelta(minutes=5),
+        )
+
+        # Its lease runs: not ours to send, mark or extend
+        self.assertEqual(claim_due_blocks(day1.due_at + timedelta(minutes=1)), [])
+        async_to_sync(mark_deliveries)([day1.id], 'sent')
+        async_to_sync(extend_claims)([day1.id])
+        day1.refresh_from_db()
+        self.assertEqual((day1.status, day1.claimed_until), ('sending', day1.due_at + timedelta(minutes=5)))
+
+        # The worker died, the lease ran out: the row goes back to the queue and to us
+        blocks = claim_due_blocks(day1.due_at + timedelta(minutes=6))
+        self.assertEqual([block.delivery_id for block in blocks], [day1.id])
+        day1.refresh_from_db()
+        self.assertEqual((day1.status, day1.claimed_by), ('sending', SCHEDULER_WORKER_ID))
+
+    def test_replan_keeps_block_being_sent(self):
+        from services.planner import plan_enrollments
+
+        enrollment = self.enroll()
+        sending = ScheduledDelivery.objects.get(enrollment=enrollment, day_number=1)
+        ScheduledDelivery.objects.filter(id=sending.id).update(status='sending', claimed_by="other")
+
+        # Reactivation while another worker sends day 1: its row survives, day 1 is not planned twice
+        plan_enrollments([enrollment.id])
+        self.assertEqual(
+            sorted(ScheduledDelivery.objects.filter(enrollment=enrollment).values_list('day_number', 'status')),
+            [(1, 'sending'), (2, 'pending')],
+        )
+        self.assertEqual(ScheduledDelivery.objects.get(id=sending.id).claimed_by, "other")
+
+    def test_deactivated_enrollment_stops_delivery(self):
+        from services.scheduler import claim_due_blocks
+
+        enrollment = self.enroll()
+        Enrollment.objects.filter(id=enrollment.id).update(is_active=False)
+        self.assertEqual(claim_due_blocks(timezone.now() + timedelta(days=10)), [])
+        self.assertFalse(ScheduledDelivery.objects.exclude(status='pending').exists())
+
+    def test_admin_created_enrollment_is_planned(self):
+        from django.contrib.auth.models import User
+
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "pass"))
+        response = self.client.post(f"/admin/core/botuser/{self.user.id}/change/", {
+            'telegram_id': 111, 'username': "", 'first_name': "Ola",
+            'enrollments-TOTAL_FORMS': 1, 'enrollments-INITIAL_FORMS': 0,
+            'enrollments-MIN_NUM_FORMS': 0, 'enrollments-MAX_NUM_FORMS': 1000,
+            'enrollments-0-course': self.course.id, 'enrollments-0-current_day': 1, 'enrollments-0-is_active': "on",
+        })
+        self.assertEqual(response.status_code, 302)
+        enrollment = Enrollment.objects.get(user=self.user, course=self.course)
+        self.assertEqual(ScheduledDelivery.objects.filter(enrollment=enrollment, status='pending').count(), 2)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "SKIP LOCKED needs Postgres")
+class SchedulerWorkersTests(TransactionTestCase):
+    """
+    Several workers claim the plan at the same moment: every block goes to exactly one of them.
+    """
+
+    def test_concurrent_claims_are_disjoint(self):
+        from services.planner import plan_enrollments
+        from services.scheduler import claim_due_blocks
+
+        course = Course.objects.create(title="Kurs", duration_days=1)
+        Lesson.objects.create(course=course, day_number=1, send_time=time(9, 0), text="Hei")
+        users = BotUser.objects.bulk_create([BotUser(telegram_id=1000 + i) for i in range(40)])
+        enrollments = Enrollment.objects.bulk_create([Enrollment(user=user, course=course) for user in users])
+        plan_enrollments([e.id for e in enrollments])
+        now = timezone.now()
+        ScheduledDelivery.objects.update(due_at=now - timedelta(minutes=1))
+
+        barrier = threading.Barrier(4)
+        claimed = []
+
+        def claim():
+            try:
+                barrier.wait()
+                claimed.extend(block.delivery_id for block in claim_due_blocks(now, limit=15))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=claim) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(claimed), 40)
+        self.assertEqual(len(set(claimed)), 40)
+
+
+class UserProgressTests(TransactionTestCase):
+    """
+    One UserProgress row per (user, lesson): old duplicates are removed by a migration,
+    every writer inserts with ON CONFLICT DO NOTHING.
+    """
+
+    def migrate(self, target):
+        from django.db.migrations.executor import MigrationExecutor
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(target or executor.loader.graph.leaf_nodes())
+        return executor.loader.project_state(target).apps if target else None
+
+    def test_dedupe_migration(self):
+        apps = self.migrate([('core', '0021_scheduleddelivery_lease')])
+        self.addCleanup(self.migrate, None)
+        OldProgress = apps.get_model('core', 'UserProgress')
+        user = apps.get_model('core', 'BotUser').objects.create(telegram_id=111)
+        course = apps.get_model('core', 'Course').objects.create(title="Kurs")
+        first, second = (apps.get_model('core', 'Lesson').objects.create(course=course, day_number=day) for day in (1, 2))
+        kept = OldProgress.objects.create(user=user, lesson=first)
+        OldProgress.objects.bulk_create([OldProgress(user=user, lesson=first) for _ in range(2)])
+        OldProgress.objects.create(user=user, lesson=second)
+
+        self.migrate([('core', '0023_userprogress_unique_user_lesson')])
+        # The first row of every pair stays
+        self.assertEqual(UserProgress.objects.count(), 2)
+        self.assertEqual(UserProgress.objects.get(lesson_id=first.id).id, kept.id)
+
+    def test_recording_is_idempotent(self):
+        from services.progress import ProgressRecorder, record_progress
+
+        course = Course.objects.create(title="Kurs")
+        lessons = [Lesson.objects.create(course=course, day_number=day) for day in (1, 2, 3)]
+        user = BotUser.objects.create(telegram_id=111)
+        async_to_sync(record_progress)([(user.id, lessons[0].id)])
+
+        recorder = ProgressRecorder(flush_every=2)
+        self.assertFalse(recorder.add(user.id, [lessons[0].id]))
+        self.assertTrue(recorder.add(user.id, [lessons[1].id, lessons[2].id]))
+        # One INSERT for the batch, the already recorded pair is skipped
+        with CaptureQueriesContext(connection) as ctx:
+            async_to_sync(recorder.flush)()
+        self.assertEqual([q['sql'].split()[0] for q in ctx.captured_queries if 'INSERT' in q['sql']], ["INSERT"])
+        async_to_sync(record_progress)([(user.id, lessons[1].id)])
+        self.assertEqual(UserProgress.objects.filter(user=user).count(), 3)
+
+
+class SimulateScheduleTests(TransactionTestCase):
+    """
+    simulate_schedule runs the real scheduler over a whole course on the virtual clock.
+    """
+
+    def test_whole_course_is_delivered(self):
+        import io
+        from core.management.commands.simulate_schedule import Command
+        from services import clock
+        from services.pipeline import pipeline
+
+        self.addCleanup(clock.set_source, None)
+        self.addCleanup(setattr, pipeline, 'bucket', pipeline.bucket)
+        self.addCleanup(setattr, pipeline, 'per_chat_interval', pipeline.per_chat_interval)
+        catalog.invalidate()
+        self.addCleanup(catalog.invalidate)
+
+        out = io.StringIO()
+        command = Command(stdout=out)
+        # handle() only adds the throwaway database around this
+        command.simulate({'users': 10, 'courses': 2, 'days': 3, 'lessons_per_day': 2, 'spread_days': 2})
+
+        self.assertFalse(ScheduledDelivery.objects.exclude(status='sent').exists())
+        self.assertEqual(UserProgress.objects.count(), 10 * 3 * 2)
+        self.assertFalse(Enrollment.objects.filter(is_active=True).exists())
+        self.assertIn("📊", out.getvalue())
+        self.assertIn("SQL-запросов на тик", out.getvalue())
+
+
+class SchedulerCoreTests(SimpleTestCase):
+    """
+    The event-driven loop: sleeps until the nearest due_at, re-reads the plan when woken.
+    """
+
+    async def run_scheduler(self, deadlines, sleep):
+        from services import scheduler as module
+
+        ticks = []
+
+        async def tick(bot, dp, now):
+            ticks.append(now)
+            raise asyncio.CancelledError
+
+        core = module.DeliveryScheduler()
+        core.load_deadlines = AsyncMock(side_effect=deadlines)
+        core.catch_up = AsyncMock()
+        core._sleep = lambda seconds: sleep(core, seconds)
+        with mock.patch.object(module, "check_and_send_lessons", tick), \
+                mock.patch.object(module.logger, "exception") as failed:
+            with self.assertRaises(asyncio.CancelledError):
+                await core.run(bot=None)
+        failed.assert_not_called()
+        return core, ticks
+
+    async def test_sleeps_until_deadline(self):
+        from services import clock
+
+        due = timezone.now() + timedelta(seconds=30)
+        self.addCleanup(clock.set_source, None)
+        slept = []
+
+        async def sleep(core, seconds):
+            slept.append(seconds)
+            clock.set_source(lambda: due)
+            return False
+
+        core, ticks = await self.run_scheduler([[due]], sleep)
+        self.assertAlmostEqual(slept[0], 30, delta=1)
+        self.assertEqual(ticks, [due])
+
+    async def test_deadline_passed_during_previous_batch_is_not_a_stall(self):
+        from services import clock
+
+        now = timezone.now()
+        self.addCleanup(clock.set_source, None)
+        clock.set_source(lambda: now)
+
+        async def sleep(core, seconds):
+            raise AssertionError("nothing to wait for")
+
+        # Came due 10 minutes ago, while a big batch was going out
+        core, ticks = await self.run_scheduler([[now - timedelta(minutes=10)]], sleep)
+        self.assertEqual(ticks, [now])
+        self.assertEqual(core.catch_up.await_count, 1)      # only the one at startup
+
+    async def test_wake_during_timeout(self):
+        from services import clock
+
+        due = timezone.now() + timedelta(seconds=5)
+        self.addCleanup(clock.set_source, None)
+
+        async def sleep(core, seconds):
+            # The plan changes exactly when the sleep runs out
+            core.wake()
+            clock.set_source(lambda: due)
+            return False
+
+        core, ticks = await self.run_scheduler([[due], [due]], sleep)
+        self.assertEqual(core.load_deadlines.await_count, 2)
+        self.assertEqual(ticks, [due])
+
+
+class SendPipelineTests(SimpleTestCase):
+    """
+    Global rate, per-chat pacing and order, flood control and retries of the shared send queue.
+    """
+
+    @staticmethod
+    @contextlib.asynccontextmanager
+    async def running(rate: float = 1000, per_chat_interval: float = 0.1, workers: int = 2):
+        from services.pipeline import SendPipeline
+
+        pipeline = SendPipeline(rate=rate, per_chat_interval=per_chat_interval, workers=workers)
+        pipeline.BACKOFF = 0.01
+        pipeline.start()
+        try:
+            yield pipeline
+        finally:
+            await pipeline.stop()
+
+    @staticmethod
+    def recorder():
+        sent = []
+
+        async def send(chat_id, text):
+            sent.append((chat_id, text, time_module.monotonic()))
+            return text
+
+        return sent, send
+
+    async def test_pacing_does_not_hold_workers(self):
+        # A chat with 5 queued messages (one per 0.2 s) must not hold the 2 workers:
+        # the other chats are sent right away
+        async with self.running(per_chat_interval=0.2) as pipeline:
+            sent, send = self.recorder()
+
+            started = time_module.monotonic()
+            await asyncio.gather(
+                *(pipeline.send(0, send, 0, text) for text in "abcde"),
+                *(pipeline.send(chat_id, send, chat_id, "x") for chat_id in range(1, 10)),
+            )
+            others = [at for chat, _, at in sent if chat != 0]
+            self.assertLess(max(others) - started, 0.1)
+            self.assertEqual(pipeline.stats()['sent'], 14)
+
+            busy = [(text, at) for chat, text, at in sent if chat == 0]
+            self.assertEqual([text for text, _ in busy], list("abcde"))
+            self.assertTrue(all(later - earlier >= 0.19 for (_, earlier), (_, later) in zip(busy, busy[1:])))
+
+    async def test_global_rate(self):
+        async with self.running(rate=20, per_chat_interval=0) as pipeline:
+            sent, send = self.recorder()
+
+            await asyncio.gather(*(pipeline.send(chat_id, send, chat_id, "x") for chat_id in range(40)))
+            # The bucket starts full (20), the other 20 take about a second
+            self.assertGreater(sent[-1][2] - sent[0][2], 0.8)
+
+    async def test_retry_after_pauses_everyone(self):
+        from aiogram.exceptions import TelegramRetryAfter
+        from aiogram.methods import SendMessage
+
+        async with self.running() as pipeline:
+            sent, send = self.recorder()
+            calls = []
+
+            async def flooded(chat_id, text):
+                calls.append(time_module.monotonic())
+                if len(calls) == 1:
+                    raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Flood", retry_after=1)
+                return await send(chat_id, text)
+
+            first = asyncio.create_task(pipeline.send(1, flooded, 1, "a"))
+            await asyncio.sleep(0.05)
+            self.assertEqual(await pipeline.send(2, send, 2, "b"), "b")
+            self.assertEqual(await first, "a")
+
+            # Chat 2 also waited for the pause
+            self.assertGreaterEqual(sent[0][2] - calls[0], 0.9)
+            self.assertEqual(pipeline.stats()['retry_after_events'], 1)
+            self.assertEqual(pipeline.stats()['retried'], 1)
+
+    async def test_network_errors_are_retried_then_raised(self):
+        from aiogram.exceptions import TelegramNetworkError
+        from aiogram.methods import SendMessage
+
+        async with self.running() as pipeline:
+            calls = 0
+
+            async def broken(chat_id, text):
+                nonlocal calls
+                calls += 1
+                raise TelegramNetworkError(SendMessage(chat_id=chat_id, text=text), "timeout")
+
+            with self.assertRaises(TelegramNetworkError):
+                await pipeline.send(1, broken, 1, "a")
+            self.assertEqual(calls, pipeline.MAX_RETRIES + 1)
+            self.assertEqual(pipeline.stats()['failed'], 1)
+
+            # The chat is not stuck behind the failed message
+            sent, send = self.recorder()
+            self.assertEqual(await pipeline.send(1, send, 1, "b"), "b")
+            self.assertEqual(pipeline.stats()['chats_waiting'], 0)
+
+    async def test_without_workers(self):
+        from services.pipeline import SendPipeline
+
+        pipeline = SendPipeline(rate=1000, per_chat_interval=0.1, workers=2)
+        sent, send = self.recorder()
+        self.assertEqual(await pipeline.send(1, send, 1, "a"), "a")
+        self.assertEqual(await pipeline.send(1, send, 1, "b"), "b")
+        self.assertGreaterEqual(sent[1][2] - sent[0][2], 0.09)
+
+
+class MediaCacheTests(TestCase):
+    """
+    Lesson media is uploaded to Telegram once, later sends reuse the file_id until the file changes.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lesson = Lesson.objects.create(course=Course.objects.create(title="Norsk A1"), day_number=1, text="Bilde")
+
+    def setUp(self):
+        import tempfile
+        from services import media
+
+        media._file_ids.clear()
+        media._hashes.clear()
+        media._loaded = False
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "bilde.jpg")
+        self.write(b"first")
+
+    def write(self, content: bytes):
+        with open(self.path, 'wb') as f:
+            f.write(content)
+        # A new mtime even on coarse file systems
+        os.utime(self.path, ns=(time_module.time_ns(), time_module.time_ns() + len(content)))
+
+    def make_bot(self):
+        uploads = iter(range(1, 100))
+        bot = SimpleNamespace(send_photo=AsyncMock(
+            side_effect=lambda chat_id, photo: SimpleNamespace(
+                photo=[SimpleNamespace(file_id=photo if isinstance(photo, str) else f"file{next(uploads)}")]
+            )
+        ))
+        return bot
+
+    def sent(self, bot) -> list:
+        return [call.args[1] if isinstance(call.args[1], str) else "upload" for call in bot.send_photo.await_args_list]
+
+    async def test_uploaded_once(self):
+        from services.media import send_media
+
+        bot = self.make_bot()
+        lesson = SimpleNamespace(id=self.lesson.id, image=self.path)
+        for chat_id in (1, 2, 3):
+            await send_media(bot, chat_id, lesson, 'image')
+        self.assertEqual(self.sent(bot), ["upload", "file1", "file1"])
+        self.assertEqual(await LessonMediaCache.objects.filter(lesson=self.lesson).values_list('file_id', flat=True).aget(), "file1")
+
+        # A replaced file is uploaded again
+        self.write(b"second")
+        await send_media(bot, 4, lesson, 'image')
+        await send_media(bot, 5, lesson, 'image')
+        self.assertEqual(self.sent(bot)[3:], ["upload", "file2"])
+
+    async def test_survives_restart_and_invalid_file_id(self):
+        from aiogram.exceptions import TelegramBadRequest
+        from aiogram.methods import SendPhoto
+        from services import media
+
+        lesson = SimpleNamespace(id=self.lesson.id, image=self.path)
+        await LessonMediaCache.objects.acreate(
+            lesson=self.lesson, field='image', file_hash=media.file_hash(self.path), file_id="stale",
+        )
+        bot = self.make_bot()
+        upload = bot.send_photo.side_effect
+
+        def send_photo(chat_id, photo):
+            if photo == "stale":
+                raise TelegramBadRequest(SendPhoto(chat_id=chat_id, photo=photo), "wrong file identifier")
+            return upload(chat_id, photo)
+
+        bot.send_photo.side_effect = send_photo
+        await media.send_media(bot, 1, lesson, 'image')
+        # Loaded from the table, rejected by Telegram, uploaded again
+        self.assertEqual(self.sent(bot), ["stale", "upload"])
+        self.assertEqual(media.cached_file_id(self.lesson.id, 'image', media.file_hash(self.path)), "file1")
+
+    async def test_file_id_uploaded_by_another_process(self):
+        from services import media
+
+        bot = self.make_bot()
+        await media.load_cache()
+        # preupload_media ran while this process was up
+        await LessonMediaCache.objects.acreate(
+            lesson=self.lesson, field='image', file_hash=media.file_hash(self.path), file_id="preuploaded",
+        )
+        lesson = SimpleNamespace(id=self.lesson.id, image=self.path)
+        await media.send_media(bot, 1, lesson, 'image')
+        await media.send_media(bot, 2, lesson, 'image')
+        self.assertEqual(self.sent(bot), ["preuploaded", "preuploaded"])
+
+    def test_forget_drops_file_id(self):
+        from services import media
+
+        LessonMediaCache.objects.create(lesson=self.lesson, field='image', file_hash="x", file_id="file1")
+        media._file_ids[(self.lesson.id, 'image')] = ("x", "file1")
+        media.forget(self.lesson.id, ['image'])
+        self.assertFalse(LessonMediaCache.objects.exists())
+        self.assertIsNone(media.cached_file_id(self.lesson.id, 'image', "x"))
+
+
+class CatalogTests(TestCase):
+    """
+    The in-memory course/lesson snapshot is dropped on change events, after a lost
+    Redis subscription and after its TTL; the scheduler never trusts a stale one.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(title="Norsk A1")
+        Lesson.objects.create(course=cls.course, day_number=1, send_time=time(9, 0), text="Hei")
+
+    def setUp(self):
+        catalog.invalidate()
+
+    def test_changed_after_commit(self):
+        snapshot = catalog.load()
+        self.assertIs(catalog.load(), snapshot)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Course.objects.filter(id=self.course.id).update(title="Norsk A2")
+            catalog.changed()
+        fresh = catalog.load()
+        self.assertGreater(fresh.version, snapshot.version)
+        self.assertEqual(fresh.courses[self.course.id].title, "Norsk A2")
+
+    def test_ttl(self):
+        snapshot = catalog.load()
+        with mock.patch.object(catalog, "CATALOG_TTL", 0):
+            self.assertGreater(catalog.load().version, snapshot.version)
+
+    async def test_resubscribe_drops_caches(self):
+        from services import events
+
+        class PubSub:
+            async def subscribe(self, *channels):
+                pass
+
+            async def listen(self):
+                raise asyncio.CancelledError
+                yield
+
+            async def aclose(self):
+                pass
+
+        handlers = {events.CATALOG_CHANGED: mock.Mock(), events.FSM_CHANGED: mock.Mock()}
+        with self.assertRaises(asyncio.CancelledError):
+            await events.listen(SimpleNamespace(pubsub=PubSub), handlers)
+        for handler in handlers.values():
+            handler.assert_called_once_with(None)
+
+    def test_scheduler_reloads_stale_snapshot(self):
+        from services.planner import plan_enrollments
+        from services.scheduler import claim_due_blocks
+
+        catalog.load()
+        # Created after the snapshot, and the change event never arrived
+        course = Course.objects.create(title="Norsk B1")
+        lesson = Lesson.objects.create(course=course, day_number=1, send_time=time(9, 0), text="Hallo")
+        enrollment = Enrollment.objects.create(user=BotUser.objects.create(telegram_id=111), course=course)
+        plan_enrollments([enrollment.id])
+        ScheduledDelivery.objects.update(due_at=timezone.now() - timedelta(minutes=1))
+
+        blocks = claim_due_blocks(timezone.now())
+        self.assertEqual([(block.course_title, [l.id for l in block.lessons]) for block in blocks],
+                         [("Norsk B1", [lesson.id])])
+
+
+class HotPathQueryTests(TestCase):
+    """
+    Query counts of the hot paths must not grow with the number of rows (no N+1).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(title="Norsk A1", duration_days=2)
+        for day in (1, 2):
+            for send_time in (time(9, 0), time(18, 0)):
+                Lesson.objects.create(course=cls.course, day_number=day, send_time=send_time, text=f"Dag {day}")
+
+    def setUp(self):
+        catalog.invalidate()
+        catalog.load()
+
+    def enroll(self, count: int, due_at=None):
+        from services.planner import plan_enrollments
+
+        offset = BotUser.objects.count()
+        users = BotUser.objects.bulk_create([BotUser(telegram_id=1000 + offset + i) for i in range(count)])
+        enrollments = Enrollment.objects.bulk_create([Enrollment(user=user, course=self.course) for user in users])
+        plan_enrollments([e.id for e in enrollments])
+        ScheduledDelivery.objects.filter(enrollment__in=enrollments).update(
+            due_at=due_at or timezone.now() - timedelta(minutes=1)
+        )
+        return enrollments
+
+    def count_queries(self, func, *args) -> int:
+        with CaptureQueriesContext(connection) as ctx:
+            func(*args)
+        return len(ctx.captured_queries)
+
+    def test_plan_enrollments_is_constant(self):
+        from services.planner import plan_enrollments
+
+        one = [e.id for e in self.enroll(1)]
+        many = [e.id for e in self.enroll(20)]
+        self.assertEqual(self.count_queries(plan_enrollments, one), self.count_queries(plan_enrollments, many))
+
+    def test_claim_due_blocks_is_constant(self):
+        from services.scheduler import claim_due_blocks
+
+        self.enroll(1)
+        few = self.count_queries(claim_due_blocks, timezone.now())
+        ScheduledDelivery.objects.all().delete()
+        self.enroll(20)
+        self.assertEqual(few, self.count_queries(claim_due_blocks, timezone.now()))
+
+    def test_quiz_answer_queries(self):
+        from handlers.learning import check_quiz_answer
+
+        lesson = Lesson.objects.create(
+            course=self.course, day_number=1, lesson_type='quiz', quiz_options="Ja\nNei", correct_answer="Ja"
+        )
+        catalog.invalidate()
+        BotUser.objects.create(telegram_id=111)
+
+        def answer(option: str):
+            callback = SimpleNamespace(
+                data=f"ans:{lesson.id}:{option}", from_user=SimpleNamespace(id=111),
+                message=fake_message(111), answer=AsyncMock(),
+            )
+            async_to_sync(check_quiz_answer)(callback, bot=None)
+
+        catalog.load()
+        # The lesson comes from the catalog: a wrong answer touches no table at all...
+        with self.assertNumQueries(0):
+            answer("Nei")
+        # ...a right one - the user lookup and one progress INSERT
+        with self.assertNumQueries(2):
+            answer("Ja")
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "EXPLAIN checks need Postgres")
+class QueryPlanTests(TestCase):
+    """
+    The hot lookups must be served by an index. Sequential scans are disabled for
+    the check, so the plan shows whether a usable index exists at all (on tiny test
+    tables the planner would prefer a seq scan anyway).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(title="Norsk A1")
+        cls.lesson = Lesson.objects.create(course=cls.course, text="Hei")
+        cls.user = BotUser.objects.create(telegram_id=111)
+        cls.enrollment = Enrollment.objects.create(user=cls.user, course=cls.course)
+
+    def assertUsesIndex(self, queryset, index_name: str = None):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = queryset.explain()
+        self.assertNotIn("Seq Scan", plan, plan)
+        if index_name:
+            self.assertIn(index_name, plan, plan)
+
+    def test_pending_deliveries(self):
+        self.assertUsesIndex(
+            ScheduledDelivery.objects.filter(status='pending', due_at__lte=timezone.now()).order_by('due_at'),
+            'delivery_pending_due_idx',
+        )
+
+    def test_expired_leases(self):
+        self.assertUsesIndex(
+            ScheduledDelivery.objects.filter(status='sending', claimed_until__lt=timezone.now()),
+            'delivery_sending_lease_idx',
+        )
+
+    def test_later_blocks_of_enrollment(self):
+        self.assertUsesIndex(ScheduledDelivery.objects.filter(enrollment_id=self.enrollment.id, status='pending'))
+
+    def test_course_blocks(self):
+        self.assertUsesIndex(
+            Lesson.objects.filter(course_id=self.course.id).values_list('day_number', 'send_time').distinct(),
+            'lesson_course_block_idx',
+        )
+
+    def test_active_enrollments_of_course(self):
+        self.assertUsesIndex(
+            Enrollment.objects.filter(course_id=self.course.id, is_active=True).values_list('id', 'start_date'),
+            'enrollment_active_course_idx',
+        )
+
+    def test_already_sent_lessons(self):
+        self.assertUsesIndex(
+            UserProgress.objects.filter(user_id__in=[self.user.id], lesson_id__in=[self.lesson.id]),
+            'unique_user_lesson_progress',
+        )
+
+    def test_codes_of_user(self):
+        self.assertUsesIndex(AccessCode.objects.filter(activated_by=self.user))
+
+    def test_user_by_telegram_id(self):
+        self.assertUsesIndex(BotUser.objects.filter(telegram_id=111))
+
+
+class ConnectionReleaseTests(TransactionTestCase):
+    """
+    The bot keeps its connection between updates; it goes back to the pool after an error or max_age.
+    """
+
+    def setUp(self):
+        from services import dbpool
+
+        dbpool._held_since.clear()
+        self.addCleanup(dbpool._held_since.clear)
+
+    def test_connection_is_reused(self):
+        from services import dbpool
+
+        middleware = dbpool.ReleaseConnectionMiddleware()
+        BotUser.objects.exists()
+        raw = connection.connection
+        with mock.patch.object(connection, "close") as close:
+            for _ in range(3):
+                async_to_sync(middleware)(AsyncMock(), None, {})
+                # The next update queries on the same connection, no pool checkout
+                BotUser.objects.exists()
+                self.assertIs(connection.connection, raw)
+            close.assert_not_called()
+
+            # Held for max_age - back to the pool
+            async_to_sync(dbpool.release)(max_age=0)
+            close.assert_called_once()
+
+    def test_broken_connection_is_released(self):
+        from services import dbpool
+
+        BotUser.objects.exists()
+        with mock.patch.object(connection, "close") as close:
+            connection.errors_occurred = True
+            async_to_sync(dbpool.release)()
+            # Still usable (e.g. an IntegrityError): kept
+            close.assert_not_called()
+            self.assertFalse(connection.errors_occurred)
+
+            connection.errors_occurred = True
+            with mock.patch.object(connection, "is_usable", return_value=False):
+                async_to_sync(dbpool.release)()
+            close.assert_called_once()
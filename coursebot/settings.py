@@ -91,6 +91,23 @@ DATABASES = {
     }
 }
 
+# Bot process: pooled connections (psycopg 3 pool, Django >= 5.1).
+# bot.py sets DJANGO_DB_POOL=1 before django.setup(), the admin keeps plain connections.
+# Pooling can't be combined with CONN_MAX_AGE - it must stay 0 (the default).
+if os.getenv("DJANGO_DB_POOL") == "1":
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+            'max_size': int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+            # Connections above min_size are closed after being idle this long (seconds)
+            'max_idle': float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+            # How long a query waits for a free connection before failing
+            'timeout': float(os.getenv("DB_POOL_TIMEOUT", "10")),
+            # Django adds check=ConnectionPool.check_connection itself:
+            # every checkout is health-checked, a dead connection is replaced, not handed out
+        },
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -2,9 +2,9 @@ from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
-from asgiref.sync import sync_to_async
 
 from core.models import BotUser
+from services.identity import identity
 from services.utils import get_text
 from states import Registration
 from keyboards import main_menu_keyboard
@@ -12,15 +12,10 @@ from keyboards import main_menu_keyboard
 router = Router()
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
-    # 1. Create or obtain a user immediately (so as not to lose it)
-    user, created = await sync_to_async(BotUser.objects.get_or_create)(
-        telegram_id=message.from_user.id,
-        defaults={
-            'username': message.from_user.username,
-            'first_name': message.from_user.first_name
-        }
-    )
+async def cmd_start(message: Message, state: FSMContext, bot_user: BotUser = None):
+    # 1. Create the user immediately (so as not to lose it) - one upsert, only if there is no row yet
+    if bot_user is None:
+        await identity.ensure(message.from_user)
 
     # 2. Receive the greeting text
     text = await get_text("welcome_text", default="Привет! Введи свой код доступа, чтобы начать обучение.")
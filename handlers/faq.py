@@ -3,26 +3,25 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.filters.callback_data import CallbackData
 from aiogram.filters import StateFilter
-from asgiref.sync import sync_to_async
-from core.models import FAQItem 
+from aiogram.fsm.context import FSMContext
+from keyboards import MAIN_MENU_BUTTONS
+from services import faq_index
+from states import Faq
 
 router = Router()
 
-@sync_to_async
-def get_faq_answer(item_id: int):
-    try:
-        return FAQItem.objects.get(id=item_id)
-    except FAQItem.DoesNotExist:
-        return None
+async def get_faq_answer(item_id: int):
+    # From the in-memory FAQ snapshot, no DB query
+    return (await faq_index.aload()).by_id.get(item_id)
 
-# Enter the menu (by clicking the "❓ Часто задаваемые вопросы" button) 
+# Enter the menu (by clicking the "❓ Часто задаваемые вопросы" button)
 @router.message(F.text.in_({"❓ Часто задаваемые вопросы", "/faq"}), StateFilter('*'))
 async def cmd_faq(message: Message):
     kb = await get_faq_main_kb()
     if not kb:
         await message.answer("Список вопросов пока пуст.")
         return
-        
+
     await message.answer("👇 Выберите вопрос:", reply_markup=kb)
 
 # Callback for navigation: only pass the question ID
@@ -30,37 +29,43 @@ class FaqCallback(CallbackData, prefix="faq"):
     action: str  # 'list' or 'show'
     id: int = 0  # Database record ID
 
-# Asynchronous function for retrieving questions from the database
-@sync_to_async
-def get_faq_list():
-    # Convert QuerySet to a list for safe use in asynchronous operations
-    return list(FAQItem.objects.filter(is_visible=True).order_by('order'))
+# Prebuilt keyboards: FAQ snapshot version -> markup
+_main_kb = (None, None)
+_back_kb = None
 
-# Question list keyboard (built dynamically)
+# Question list keyboard (built once per FAQ version)
 async def get_faq_main_kb():
-    builder = InlineKeyboardBuilder()
-    items = await get_faq_list()
-    
-    if not items:
-        return None
+    global _main_kb
+    snapshot = await faq_index.aload()
+    if _main_kb[0] == snapshot.version:
+        return _main_kb[1]
 
-    for item in items:
-        builder.button(
-            text=item.question,
-            callback_data=FaqCallback(action="show", id=item.id)
-        )
-    
-    builder.button(text="❌ Закрыть", callback_data="close_faq")
-    builder.adjust(1)
-    return builder.as_markup()
+    kb = None
+    if snapshot.items:
+        builder = InlineKeyboardBuilder()
+        for item in snapshot.items:
+            builder.button(
+                text=item.question,
+                callback_data=FaqCallback(action="show", id=item.id)
+            )
+        builder.button(text="🔎 Поиск по вопросам", callback_data="faq_search")
+        builder.button(text="❌ Закрыть", callback_data="close_faq")
+        builder.adjust(1)
+        kb = builder.as_markup()
+
+    _main_kb = (snapshot.version, kb)
+    return kb
 
 # Back Keyboard
 def get_back_kb():
-    builder = InlineKeyboardBuilder()
-    builder.button(text="🔙 К списку вопросов", callback_data=FaqCallback(action="list"))
-    return builder.as_markup()
+    global _back_kb
+    if _back_kb is None:
+        builder = InlineKeyboardBuilder()
+        builder.button(text="🔙 К списку вопросов", callback_data=FaqCallback(action="list"))
+        _back_kb = builder.as_markup()
+    return _back_kb
 
-# Show list ("Назад" button) 
+# Show list ("Назад" button)
 @router.callback_query(FaqCallback.filter(F.action == "list"))
 async def faq_list_callback(callback: CallbackQuery):
     kb = await get_faq_main_kb()
@@ -68,12 +73,11 @@ async def faq_list_callback(callback: CallbackQuery):
     await callback.message.edit_text("👇 Выберите вопрос:", reply_markup=kb)
     await callback.answer()
 
-# Show answer 
+# Show answer
 @router.callback_query(FaqCallback.filter(F.action == "show"))
 async def faq_show_callback(callback: CallbackQuery, callback_data: FaqCallback):
-    # Retrieve the answer from the database by ID
     item = await get_faq_answer(callback_data.id)
-    
+
     if not item:
         await callback.answer("Этот вопрос был удален.", show_alert=True)
         kb = await get_faq_main_kb()
@@ -87,8 +91,41 @@ async def faq_show_callback(callback: CallbackQuery, callback_data: FaqCallback)
     )
     await callback.answer()
 
-# Close 
+# Search: the user types a question in free form
+@router.callback_query(F.data == "faq_search")
+async def faq_search_callback(callback: CallbackQuery, state: FSMContext):
+    # Only the next message is a search; then the user is back in the state they came from
+    previous = await state.get_state()
+    if previous != Faq.waiting_for_query.state:
+        await state.update_data(faq_previous_state=previous)
+    await state.set_state(Faq.waiting_for_query)
+    await callback.message.answer("🔎 Напиши свой вопрос своими словами, я найду похожие ответы:")
+    await callback.answer()
+
+@router.message(Faq.waiting_for_query, F.text, ~F.text.in_(MAIN_MENU_BUTTONS), ~F.text.startswith("/"))
+async def faq_search_query(message: Message, state: FSMContext):
+    # Inverted index in memory - no DB query per search
+    items = (await faq_index.aload()).search(message.text)
+
+    data = await state.get_data()
+    await state.set_state(data.pop('faq_previous_state', None))
+    await state.set_data(data)
+
+    if not items:
+        await message.answer(
+            "😔 Ничего похожего не нашлось. Нажми «🔎 Поиск по вопросам» и сформулируй иначе "
+            "или нажми «🆘 Написать в поддержку»."
+        )
+        return
+
+    builder = InlineKeyboardBuilder()
+    for item in items:
+        builder.button(text=item.question, callback_data=FaqCallback(action="show", id=item.id))
+    builder.adjust(1)
+    await message.answer("👇 Возможно, ответ здесь:", reply_markup=builder.as_markup())
+
+# Close
 @router.callback_query(F.data == "close_faq")
 async def close_faq(callback: CallbackQuery):
     await callback.message.delete()
-    await callback.answer()
\ No newline at end of file
+    await callback.answer()
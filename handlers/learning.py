@@ -1,11 +1,13 @@
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
-from core.models import Course, BotUser, Lesson, UserProgress
+from core.models import Course, BotUser
 from states import Learning
 from django.utils import timezone # Для фиксации времени старта
 from keyboards import main_menu_keyboard
-from asgiref.sync import sync_to_async
+from services import catalog
+from services.identity import identity
+from services.progress import record_progress
 from services.utils import normalize_text
 
 router = Router()
@@ -32,7 +34,7 @@ async def on_reply_click(callback: CallbackQuery, state: FSMContext):
     
 # BUTTON PROCESSING (QUIZ) 
 @router.callback_query(F.data.startswith("ans:"))
-async def check_quiz_answer(callback: CallbackQuery, bot: Bot):
+async def check_quiz_answer(callback: CallbackQuery, bot: Bot, bot_user: BotUser = None):
     try:
         _, lesson_id_str, selected_answer = callback.data.split(":", 2)
         lesson_id = int(lesson_id_str)
@@ -40,14 +42,14 @@ async def check_quiz_answer(callback: CallbackQuery, bot: Bot):
         await callback.answer("Ошибка данных кнопки.")
         return
 
-    try:
-        lesson = Lesson.objects.get(id=lesson_id)
-    except Lesson.DoesNotExist:
+    # Lessons are served from the in-memory catalog, no DB query per click
+    lesson = (await catalog.aload()).lessons.get(lesson_id)
+    if lesson is None:
         await callback.answer("Урок не найден.")
         return
 
     selected_answer = selected_answer.strip()
-    correct_answer = lesson.correct_answer.strip()
+    correct_answer = lesson.correct_answer
     
     is_correct = (selected_answer == correct_answer)
 
@@ -72,15 +74,15 @@ async def check_quiz_answer(callback: CallbackQuery, bot: Bot):
         
         await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=new_keyboard))
 
-        user = await sync_to_async(BotUser.objects.get)(telegram_id=callback.from_user.id)
-        # It is important to use sync_to_async for database queries.
-        _, created = await sync_to_async(UserProgress.objects.get_or_create)(user=user, lesson=lesson)
+        # The user comes from UserMiddleware (identity cache); only the async ORM on the event loop
+        user = bot_user or await identity.get(callback.from_user)
+        if user is not None:
+            await record_progress([(user.id, lesson.id)])
     else:
         # WRONG ANSWER
-        # We get lists of options and explanations.
-        # splitlines() is more reliable than split(‘\n’) because it removes line breaks correctly.
-        options = [opt.strip() for opt in lesson.quiz_options.splitlines() if opt.strip()]
-        explanations = [exp.strip() for exp in lesson.error_feedback.splitlines()] # Тут пустые строки важны!
+        # Lists of options and explanations are prepared by the catalog (empty explanation lines are kept!)
+        options = lesson.quiz_options
+        explanations = lesson.error_feedback_lines
 
         feedback_text = "❌ Неправильно."
 
@@ -102,7 +104,7 @@ async def check_quiz_answer(callback: CallbackQuery, bot: Bot):
 
 # PROCESSING THE TEXT RESPONSE
 @router.message(Learning.waiting_for_text_answer)
-async def check_text_answer(message: Message, state: FSMContext, bot: Bot):
+async def check_text_answer(message: Message, state: FSMContext, bot: Bot, bot_user: BotUser = None):
     # Let's find out which lesson the user is responding to
     data = await state.get_data()
     lesson_id = data.get("lesson_id")
@@ -114,21 +116,20 @@ async def check_text_answer(message: Message, state: FSMContext, bot: Bot):
         return
 
     # We get the lesson
-    try:
-        lesson = await sync_to_async(Lesson.objects.get)(id=lesson_id)
-    except Lesson.DoesNotExist:
+    lesson = (await catalog.aload()).lessons.get(lesson_id)
+    if lesson is None:
         await message.answer("⚠️ Урок был удален.")
         await state.clear()
         return
 
     # COMPARISON (we convert everything to lowercase for reliability)
-    user_words = normalize_text(message.text)
-    correct_words = normalize_text(lesson.correct_answer)
+    user_words = tuple(normalize_text(message.text))
+    correct_words = lesson.correct_words
 
     is_correct = (user_words == correct_words)
 
     if is_correct or attempts >= 3:
-        user = await sync_to_async(BotUser.objects.get)(telegram_id=message.from_user.id)
+        user = bot_user or await identity.get(message.from_user)
 
         if is_correct:
             feedback = (f"✅ <b>Абсолютно верно!</b>\n"
@@ -141,7 +142,8 @@ async def check_text_answer(message: Message, state: FSMContext, bot: Bot):
         
         await message.reply(feedback, parse_mode="HTML")
 
-        await sync_to_async(UserProgress.objects.get_or_create)(user=user, lesson=lesson)
+        if user is not None:
+            await record_progress([(user.id, lesson.id)])
 
         await state.update_data(attempts=0)
 
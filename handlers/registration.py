@@ -2,9 +2,12 @@ from aiogram import Router
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 from asgiref.sync import sync_to_async
-from django.utils import timezone
 
-from core.models import AccessCode, BotUser, Enrollment
+from core.models import BotUser
+from services import catalog
+from services.activation import activate_code
+from services.identity import identity
+from services.throttling import missing_codes
 from services.utils import get_text
 from states import Registration
 from keyboards import main_menu_keyboard
@@ -12,54 +15,45 @@ from keyboards import main_menu_keyboard
 router = Router()
 
 @router.message(Registration.waiting_for_access_code)
-async def process_code(message: Message, state: FSMContext):
+async def process_code(message: Message, state: FSMContext, bot_user: BotUser = None):
     code_text = message.text.strip()
-    user_id = message.from_user.id
 
-    user = await sync_to_async(BotUser.objects.get)(telegram_id=user_id)
+    # The same wrong code again: answered from Redis, no transaction
+    if await missing_codes.is_missing(code_text):
+        await message.answer("❌ Такой код не найден. Попробуй еще раз.")
+        return
+
+    user = bot_user or await identity.get(message.from_user)
+    if user is None:
+        await message.answer("⚠️ Сначала нажми /start.")
+        return
 
-    access_code = await sync_to_async(
-        lambda: AccessCode.objects.select_related('activated_by').prefetch_related('courses').filter(code=code_text).first()
-    )()
+    # The whole activation is one transaction (the code row is locked) - runs in a thread
+    result = await sync_to_async(activate_code)(message.from_user.id, code_text, user_id=user.id)
 
-    if not access_code:
+    if result.status == 'not_found':
+        await missing_codes.remember(code_text)
         await message.answer("❌ Такой код не найден. Попробуй еще раз.")
         return
 
-    if not access_code.is_active:
+    if result.status == 'inactive':
         await message.answer("⛔ Этот код уже неактивен.")
         return
     
-    if access_code.activated_by:
-        if access_code.activated_by.telegram_id != user_id:
-            await message.answer("⛔ Ошибка! Этот код уже активирован другим человеком.")
-            return
-        else:
-            await message.answer("⚠️ Ты уже активировал этот код ранее.")
-            await state.clear()
-            return
-    else:
-        access_code.activated_by = user
-        await sync_to_async(access_code.save)()
+    if result.status == 'taken':
+        await message.answer("⛔ Ошибка! Этот код уже активирован другим человеком.")
+        return
 
-    
-    courses = await sync_to_async(list)(access_code.courses.all())
+    if result.status == 'already_activated':
+        await message.answer("⚠️ Ты уже активировал этот код ранее.")
+        await state.clear()
+        return
 
-    if not courses:
+    if result.status == 'no_courses':
         await message.answer("⚠️ К этому коду не привязано ни одного курса. Напиши администратору.")
         return
 
-    courses_ids = [c.id for c in courses]
-    
-    already_enrolled = await sync_to_async(
-        lambda: Enrollment.objects.filter(
-            user=user, 
-            course_id__in=courses_ids, 
-            is_active=True
-        ).exists()
-    )()
-
-    if already_enrolled:
+    if result.status == 'already_enrolled':
         await message.answer(
             "⚠️ <b>У тебя уже есть доступ к этим курсам!</b>\n"
             "Повторная активация не требуется.",
@@ -69,24 +63,14 @@ async def process_code(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    access_code.activated_by = user
-    await sync_to_async(access_code.save)()
-
+    # Titles and start messages come from the in-memory catalog
+    courses = (await catalog.aload()).courses
     activated_courses_titles = []
 
-    for course in courses:
-        enrollment, created = await sync_to_async(Enrollment.objects.get_or_create)(
-            user=user,
-            course=course,
-            defaults={'current_day': 1, 'is_active': True}
-        )
-        
-        if not created and not enrollment.is_active:
-            enrollment.is_active = True
-            enrollment.current_day = 1
-            enrollment.start_date = timezone.now()
-            await sync_to_async(enrollment.save)()
-
+    for course_id in result.course_ids:
+        course = courses.get(course_id)
+        if course is None:
+            continue
         activated_courses_titles.append(course.title)
         
         if course.start_message:
@@ -98,4 +82,4 @@ async def process_code(message: Message, state: FSMContext):
     text = text + "\nКурсы:\n" + courses_str
 
     await message.answer(text, reply_markup=main_menu_keyboard())
-    await state.clear()
\ No newline at end of file
+    await state.clear()
@@ -4,26 +4,21 @@ from aiogram.types import Message, ReactionTypeEmoji
 from aiogram.fsm.context import FSMContext
 from states import Support, Registration, Learning
 from keyboards import main_menu_keyboard
-from asgiref.sync import sync_to_async
+from services import botcache, tickets
+from services.identity import identity
+from services.pipeline import pipeline
 from services.utils import get_text
 from config import ADMIN_ID
 from aiogram.filters import StateFilter, Command
-from core.models import AccessCode, BotUser, BotSettings
+from core.models import BotUser, Enrollment
 
 router = Router()
 
 async def get_setting(key: str):
-    try:
-        setting = await sync_to_async(BotSettings.objects.get)(key=key)
-        return setting.value
-    except BotSettings.DoesNotExist:
-        return None
+    return await botcache.get_setting(key)
 
 async def set_setting(key: str, value: str):
-    await sync_to_async(BotSettings.objects.update_or_create)(
-        key=key,
-        defaults={'value': value}
-    )
+    await botcache.set_setting(key, value)
 
 # COMMAND FOR ASSIGNING A GROUP (For admins only) 
 @router.message(Command("setgroup"))
@@ -52,7 +47,7 @@ async def cmd_support(message: Message, state: FSMContext):
 
 # User wrote text (we are in waiting_for_message state) 
 @router.message(Support.waiting_for_message)
-async def process_support_message(message: Message, state: FSMContext, bot: Bot):
+async def process_support_message(message: Message, state: FSMContext, bot: Bot, bot_user: BotUser = None):
     if not message.text:
         await message.answer("Пожалуйста, отправьте текстовое сообщение.")
         return
@@ -66,8 +61,17 @@ async def process_support_message(message: Message, state: FSMContext, bot: Bot)
     
     chat_id_to_send = int(support_group_id)
 
+    # The ticket needs the student row; someone who never got past the code has none yet
+    if bot_user is None:
+        user, user_created = await identity.ensure(message.from_user)
+    else:
+        user, user_created = bot_user, False
+    ticket_id, ticket_created = await tickets.open_ticket(user.id)
+    ref = tickets.TicketRef(ticket_id, message.from_user.id)
+
+    title = "📩 <b>Новый вопрос от ученика!</b>" if ticket_created else "💬 <b>Продолжение обращения</b>"
     admin_text = (
-        f"📩 <b>Новый вопрос от ученика!</b>\n"
+        f"{title} #{ticket_id}\n"
         f"От: {message.from_user.full_name}\n"
         f"ID: <code>{message.from_user.id}</code>\n" 
         f"👇👇👇\n\n"
@@ -76,73 +80,117 @@ async def process_support_message(message: Message, state: FSMContext, bot: Bot)
     text = await get_text("question_send", default="✅ Ваше сообщение отправлено! Отвечу, как только смогу.")
 
     try:
-        await bot.send_message(chat_id=chat_id_to_send, text=admin_text)
+        sent = await pipeline.send(chat_id_to_send, bot.send_message, chat_id_to_send, admin_text)
+        # Replies to this group message find the ticket by its message_id
+        await tickets.link_message(
+            ref, chat_id_to_send, sent.message_id, 'in',
+            message.from_user.id, message.from_user.full_name, message.text,
+        )
         await message.answer(text, reply_markup=main_menu_keyboard())
     except Exception as e:
+        if ticket_created:
+            # The question never reached the curators: no empty ticket left behind
+            await tickets.discard_ticket(ticket_id)
         await message.answer(f"Ошибка отправки (возможно бот не админ в группе): {e}", reply_markup=main_menu_keyboard())
     
-    user = BotUser.objects.filter(telegram_id=message.from_user.id).first()
-    
-    # If the user is not in the database, it means they TRIED to enter the access code.
+    # If the user was not in the database, it means they TRIED to enter the access code.
     # Return them to this mode!
-    if not user:
+    if user_created:
         await state.set_state(Registration.waiting_for_access_code)
         await message.answer("🔄 <b>Теперь можешь снова попробовать ввести код доступа:</b>")
         return
     
-    has_activated_code = await sync_to_async(
-        lambda: AccessCode.objects.filter(activated_by=user).exists()
-    )()
+    has_active_course = await Enrollment.objects.filter(user=user, is_active=True).aexists()
     
     # If the user exists, check whether they are taking the course
-    if user.current_course:
+    if has_active_course:
         # If you are taking a course, switch to learning mode.
         await state.set_state(Learning.in_process)
-    elif has_activated_code and not user.course_start_date:
-        # If it is in the database but has not yet started the course (waiting for the code word to be entered)
-        await state.set_state(Learning.waiting_for_keyword)
-        text = await get_text("wait_code_text", default="🔄 Жду кодовое слово из видео.")
-        await message.answer(text)
     else:
         # In other cases, we simply reset
         await state.set_state(Registration.waiting_for_access_code)
         text = await get_text("wait_keyword_text", default="🔄 Введите код доступа, чтобы продолжить:")
         await message.answer(text)
 
+async def is_support_group(message: Message) -> bool:
+    support_group_id = await get_setting("support_group_id")
+    return bool(support_group_id) and str(message.chat.id) == str(support_group_id)
+
+# Curator closes the ticket: /close as a reply to any message of the thread
+@router.message(Command("close"), F.reply_to_message)
+async def cmd_close_ticket(message: Message, bot: Bot):
+    if not await is_support_group(message):
+        return
+
+    ref = await tickets.resolve(message.chat.id, message.reply_to_message.message_id)
+    if ref is None:
+        await message.answer("❌ Это сообщение не относится ни к одному обращению.")
+        return
+
+    if not await tickets.close_ticket(ref.ticket_id):
+        await message.answer(f"Обращение #{ref.ticket_id} уже закрыто.")
+        return
+
+    await message.react([ReactionTypeEmoji(emoji="✍")])
+    text = await get_text("ticket_closed_text", default="✅ Ваше обращение закрыто. Если остались вопросы - напишите в поддержку снова.")
+    await pipeline.send(ref.telegram_id, bot.send_message, ref.telegram_id, text)
+
+# Response time per curator
+@router.message(Command("tickets"))
+async def cmd_ticket_stats(message: Message):
+    if not await is_support_group(message):
+        return
+
+    open_count, unanswered = await tickets.waiting_count()
+    lines = [
+        f"📊 <b>Поддержка за {tickets.STATS_DAYS} дней</b>",
+        f"Открыто обращений: {open_count}, без ответа: {unanswered}",
+        "",
+    ]
+    stats = await tickets.curator_stats()
+    for item in stats:
+        lines.append(
+            f"👩‍🏫 {item.name or item.curator_id}: {item.tickets} обр., "
+            f"медиана {tickets.format_duration(item.median)}, "
+            f"среднее {tickets.format_duration(item.avg)}, "
+            f"худшее {tickets.format_duration(item.worst)}"
+        )
+    if not stats:
+        lines.append("Ответов пока нет.")
+    await message.answer("\n".join(lines))
+
 # Admin replies
-# This handler will work when ADMIN replies to a message that starts with “📩”
+# This handler works when a curator replies to any message of a ticket thread (question or answer)
 @router.message(F.reply_to_message)
 async def process_admin_reply(message: Message, bot: Bot):
-    support_group_id = await get_setting("support_group_id")
-    if not support_group_id:
+    if not await is_support_group(message):
         return
-    
-    if str(message.chat.id) != str(support_group_id):
+
+    # O(1): the replied message_id -> ticket and student, no text parsing
+    ref = await tickets.resolve(message.chat.id, message.reply_to_message.message_id)
+    if ref is None:
         return
 
-    replied_text = message.reply_to_message.text or ""
-    if "Новый вопрос от ученика!" not in replied_text:
-        return 
+    if not message.text:
+        await message.answer("❌ Пока можно отвечать только текстом.")
+        return
 
     try:
-        lines = replied_text.split('\n')
-        user_id_line = next((line for line in lines if "ID: " in line), None)
-        
-        if not user_id_line:
-            await message.answer("❌ Не могу найти ID пользователя в сообщении.")
-            return
+        answer_text = await get_text("curator_answer_text", default="👩‍🏫 <b>Ответ от куратора:</b>")
 
-        user_id_str = user_id_line.replace("ID: ", "").strip()
-        user_id = int(user_id_str)
-
-        answer_text = get_text("curator_answer_text", default="👩‍🏫 <b>Ответ от куратора:</b>")
-
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"{answer_text}\n\n{message.text}"
+        await pipeline.send(
+            ref.telegram_id,
+            bot.send_message,
+            ref.telegram_id,
+            f"{answer_text}\n\n{message.text}"
+        )
+        # The answer joins the thread: replying to it continues the same ticket
+        await tickets.record_answer(
+            ref, message.chat.id, message.message_id,
+            message.from_user.id, message.from_user.full_name, message.text,
         )
         # await message.answer("✅ Ответ отправлен.")
         await message.react([ReactionTypeEmoji(emoji="👍")])
 
     except Exception as e:
-        await message.answer(f"❌ Не удалось доставить ответ: {e}")
\ No newline at end of file
+        await message.answer(f"❌ Не удалось доставить ответ: {e}")
@@ -1,14 +1,13 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
+# Texts of the main menu buttons (free-text handlers must not swallow them)
+MAIN_MENU_BUTTONS = ("🆘 Написать в поддержку", "❓ Часто задаваемые вопросы", "🔑 Ввести код доступа")
+
 def main_menu_keyboard():
     return ReplyKeyboardMarkup(
         keyboard=[
-            [
-                KeyboardButton(text="🆘 Написать в поддержку"),
-                KeyboardButton(text="❓ Часто задаваемые вопросы"),
-                KeyboardButton(text="🔑 Ввести код доступа"),
-                # You can add a “My Progress” button 
-            ]
+            [KeyboardButton(text=text) for text in MAIN_MENU_BUTTONS],
+            # You can add a “My Progress” button 
         ],
         resize_keyboard=True, # So that the buttons are small and neat
         persistent=True       # So that the menu does not hide
@@ -0,0 +1,64 @@
+from collections import namedtuple
+
+from django.db import transaction
+
+from core.models import AccessCode, BotUser, Enrollment
+from services.planner import plan_enrollments
+
+# status: 'activated', 'not_found', 'inactive', 'taken' (by another user), 'already_activated',
+# 'no_courses', 'already_enrolled', 'unknown_user'
+Activation = namedtuple('Activation', ['status', 'course_ids', 'enrollment_ids'])
+
+
+def activate_code(telegram_id: int, code_text: str, user_id: int = None) -> Activation:
+    """
+    Redeems an access code in one transaction: the code row is locked (SELECT ... FOR UPDATE),
+    so two users redeeming the same code at once can't both get it.
+    All linked courses are enrolled with one upsert, the delivery plan is built in the same transaction.
+    user_id - the BotUser pk if the caller already knows it (the bot's identity cache), saves the lookup.
+    """
+    with transaction.atomic():
+        if user_id is None:
+            user_id = BotUser.objects.filter(telegram_id=telegram_id).values_list('id', flat=True).first()
+        if user_id is None:
+            return Activation('unknown_user', [], [])
+
+        # The second redeemer waits here until the first one commits, then sees activated_by
+        code = (
+            AccessCode.objects.select_for_update()
+            .filter(code=code_text)
+            .values_list('id', 'is_active', 'activated_by_id')
+            .first()
+        )
+        if code is None:
+            return Activation('not_found', [], [])
+
+        code_id, is_active, activated_by_id = code
+        if not is_active:
+            return Activation('inactive', [], [])
+        if activated_by_id is not None:
+            status = 'already_activated' if activated_by_id == user_id else 'taken'
+            return Activation(status, [], [])
+
+        course_ids = list(AccessCode.courses.through.objects.filter(accesscode_id=code_id).values_list('course_id', flat=True))
+        if not course_ids:
+            return Activation('no_courses', [], [])
+
+        # The code is taken by this user from now on (as before: also when the courses are already active)
+        AccessCode.objects.filter(id=code_id).update(activated_by_id=user_id)
+
+        if Enrollment.objects.filter(user_id=user_id, course_id__in=course_ids, is_active=True).exists():
+            return Activation('already_enrolled', course_ids, [])
+
+        # New subscriptions are inserted, finished ones start over - one statement for all courses
+        enrollments = Enrollment.objects.bulk_create(
+            [Enrollment(user_id=user_id, course_id=course_id, current_day=1, is_active=True) for course_id in course_ids],
+            update_conflicts=True,
+            unique_fields=['user', 'course'],
+            update_fields=['is_active', 'current_day', 'start_date'],
+        )
+        enrollment_ids = [enrollment.id for enrollment in enrollments]
+
+        plan_enrollments(enrollment_ids)
+
+    return Activation('activated', course_ids, enrollment_ids)
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+
+from django.db import transaction
+
+from config import BOT_CACHE_TTL
+from core.models import BotMessage, BotSettings
+from services.events import TEXTS_CHANGED, publish
+
+logger = logging.getLogger(__name__)
+
+# BotMessage texts and BotSettings values change maybe once a month,
+# so the bot keeps all of them in memory and reloads on change events.
+# The TTL is only a safety net for a lost event.
+_texts = {}
+_settings = {}
+_loaded_at = None       # time.monotonic() of the last load, None - must reload
+_generation = 0         # bumped by every invalidation
+_lock = None            # created on first use, inside the running loop
+
+hits = 0
+misses = 0
+
+
+def _is_fresh() -> bool:
+    return _loaded_at is not None and time.monotonic() - _loaded_at < BOT_CACHE_TTL
+
+
+async def _ensure_loaded():
+    global _texts, _settings, _loaded_at, _lock, hits, misses
+    if _is_fresh():
+        hits += 1
+        return
+
+    misses += 1
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:
+        if _is_fresh():
+            return
+        generation = _generation
+        texts = {slug: text async for slug, text in BotMessage.objects.values_list('slug', 'text')}
+        settings = {key: value async for key, value in BotSettings.objects.values_list('key', 'value')}
+        _texts, _settings = texts, settings
+        # An invalidation arrived while we were loading - serve it, but reload next time
+        _loaded_at = time.monotonic() if generation == _generation else None
+        logger.info(f"💬 Bot cache loaded: {len(texts)} texts, {len(settings)} settings")
+
+
+async def get_text(slug: str, default: str = None) -> str:
+    await _ensure_loaded()
+    text = _texts.get(slug)
+    if text is not None:
+        return text
+    return default if default else f"[Текст не задан: {slug}]"
+
+
+async def get_setting(key: str) -> str | None:
+    await _ensure_loaded()
+    return _settings.get(key)
+
+
+async def set_setting(key: str, value: str):
+    await BotSettings.objects.aupdate_or_create(key=key, defaults={'value': value})
+    # Our own write is visible right away, the other processes get the event
+    _settings[key] = value
+
+
+def stats() -> dict:
+    return {
+        'hits': hits,
+        'misses': misses,
+        'texts': len(_texts),
+        'settings': len(_settings),
+        'age_s': round(time.monotonic() - _loaded_at) if _loaded_at is not None else None,
+    }
+
+
+async def report_loop(every: int = 300):
+    last_hits = 0
+    while True:
+        await asyncio.sleep(every)
+        if hits != last_hits:
+            logger.info(f"💬 Bot cache: {stats()}")
+            last_hits = hits
+
+
+def invalidate(*args):
+    global _loaded_at, _generation
+    _generation += 1
+    _loaded_at = None
+
+
+def changed():
+    """
+    Called on BotMessage/BotSettings save/delete (in any process).
+    """
+    transaction.on_commit(invalidate)
+    publish(TEXTS_CHANGED)
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import threading
+import time
+
+from django.db import transaction
+
+from config import CATALOG_TTL
+from core.models import Course, Lesson
+from services.events import CATALOG_CHANGED, publish
+from services.media import MEDIA_FIELDS
+from services.utils import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+class CourseRecord:
+    __slots__ = ('id', 'title', 'start_message', 'finish_message', 'duration_days')
+
+    def __init__(self, course: Course):
+        self.id = course.id
+        self.title = course.title
+        self.start_message = course.start_message
+        self.finish_message = course.finish_message
+        self.duration_days = course.duration_days
+
+
+class LessonRecord:
+    """
+    Read-only copy of a Lesson, with everything the bot needs already prepared.
+    Media fields hold the absolute file path ('' if there is no file).
+    """
+    __slots__ = (
+        'id', 'course_id', 'day_number', 'send_time', 'lesson_type', 'text',
+        'image', 'audio', 'video_note', 'file_doc',
+        'quiz_options', 'correct_answer', 'correct_words', 'error_feedback', 'error_feedback_lines',
+    )
+
+    def __init__(self, lesson: Lesson):
+        self.id = lesson.id
+        self.course_id = lesson.course_id
+        self.day_number = lesson.day_number
+        self.send_time = lesson.send_time
+        self.lesson_type = lesson.lesson_type
+        self.text = lesson.text
+        for field in MEDIA_FIELDS:
+            file = getattr(lesson, field)
+            setattr(self, field, file.path if file else '')
+
+        # Quiz: non-empty options; explanations keep empty lines (line N explains option N)
+        self.quiz_options = tuple(opt.strip() for opt in lesson.quiz_options.splitlines() if opt.strip())
+        self.correct_answer = lesson.correct_answer.strip()
+        self.correct_words = tuple(normalize_text(lesson.correct_answer))
+        self.error_feedback = lesson.error_feedback
+        self.error_feedback_lines = tuple(exp.strip() for exp in lesson.error_feedback.splitlines())
+
+
+class Catalog:
+    """
+    Immutable snapshot of all courses and lessons. A new version replaces the old one as a whole.
+    """
+    __slots__ = ('version', 'courses', 'lessons', 'blocks')
+
+    def __init__(self, version: int, courses, lessons):
+        self.version = version
+        self.courses = {course.id: course for course in courses}
+        self.lessons = {lesson.id: lesson for lesson in lessons}
+
+        # (course_id, day_number, send_time) -> lessons of the block in sending order
+        blocks = {}
+        for lesson in sorted(self.lessons.values(), key=lambda l: (l.send_time, l.id)):
+            blocks.setdefault((lesson.course_id, lesson.day_number, lesson.send_time), []).append(lesson)
+        self.blocks = {key: tuple(value) for key, value in blocks.items()}
+
+    def block(self, course_id: int, day_number: int, send_time) -> tuple:
+        return self.blocks.get((course_id, day_number, send_time), ())
+
+
+_current = None
+_loaded_at = 0.0     # time.monotonic() when _current was loaded
+_version = 0
+_generation = 0     # bumped by every invalidation
+_lock = threading.Lock()
+_async_lock = None   # created on first use, inside the running loop
+
+
+def _fresh() -> Catalog | None:
+    # The snapshot, unless it was invalidated or is older than the TTL (safety net for a lost event)
+    if _current is not None and time.monotonic() - _loaded_at < CATALOG_TTL:
+        return _current
+    return None
+
+
+def _install(generation: int, courses, lessons) -> Catalog:
+    global _current, _loaded_at, _version
+    _version += 1
+    catalog = Catalog(_version, courses, lessons)
+    # An invalidation arrived while we were loading - serve it, but reload next time
+    if generation == _generation:
+        _current = catalog
+        _loaded_at = time.monotonic()
+    logger.info(f"📚 Catalog v{catalog.version}: {len(catalog.courses)} courses, {len(catalog.lessons)} lessons")
+    return catalog
+
+
+def load() -> Catalog:
+    """
+    Returns the current snapshot, (re)loading it from the database if it was invalidated.
+    """
+    catalog = _fresh()
+    if catalog is not None:
+        return catalog
+
+    with _lock:
+        if _fresh() is not None:
+            return _current
+        generation = _generation
+        courses = [CourseRecord(course) for course in Course.objects.all()]
+        lessons = [LessonRecord(lesson) for lesson in Lesson.objects.all()]
+        return _install(generation, courses, lessons)
+
+
+async def aload() -> Catalog:
+    """
+    Same as load(), for the event loop (async ORM).
+    """
+    global _async_lock
+    catalog = _fresh()
+    if catalog is not None:
+        return catalog
+
+    if _async_lock is None:
+        _async_lock = asyncio.Lock()
+    async with _async_lock:
+        if _fresh() is not None:
+            return _current
+        generation = _generation
+        courses = [CourseRecord(course) async for course in Course.objects.all()]
+        lessons = [LessonRecord(lesson) async for lesson in Lesson.objects.all()]
+        return _install(generation, courses, lessons)
+
+
+def invalidate(*args):
+    global _current, _generation
+    _generation += 1
+    _current = None
+
+
+def changed():
+    """
+    Called on Course/Lesson save/delete (in any process): drops the local snapshot
+    and tells the other processes (the admin edits, the bot serves) to do the same.
+    """
+    transaction.on_commit(invalidate)
+    publish(CATALOG_CHANGED)
@@ -0,0 +1,16 @@
+from datetime import datetime
+
+from django.utils import timezone
+
+# Where the scheduler gets "now" from. The simulation (manage.py simulate_schedule)
+# replaces it with a virtual clock.
+_source = timezone.now
+
+
+def now() -> datetime:
+    return _source()
+
+
+def set_source(source):
+    global _source
+    _source = source or timezone.now
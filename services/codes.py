@@ -0,0 +1,107 @@
+import csv
+import secrets
+
+from django.db import IntegrityError, transaction
+
+from core.models import AccessCode
+from services.throttling import forget_missing_codes
+
+# No 0/O and 1/I/L: codes are typed by hand
+DEFAULT_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
+DEFAULT_LENGTH = 8
+CHUNK_SIZE = 2000
+# The code space must be much bigger than the batch, otherwise almost every candidate collides
+MIN_SPACE_FACTOR = 100
+MAX_ATTEMPTS = 10
+
+CODE_MAX_LENGTH = AccessCode._meta.get_field('code').max_length
+
+
+def _insert_chunk(codes: list[str], course_ids) -> list[str]:
+    """
+    Inserts codes that are not in the database yet and links them to the courses.
+    Returns the inserted codes. Existing codes are found with one query against the unique index.
+    """
+    existing = set(AccessCode.objects.filter(code__in=codes).values_list('code', flat=True))
+    new_codes = [code for code in codes if code not in existing]
+    if not new_codes:
+        return []
+
+    with transaction.atomic():
+        created = AccessCode.objects.bulk_create([AccessCode(code=code) for code in new_codes])
+        Through = AccessCode.courses.through
+        Through.objects.bulk_create(
+            [Through(accesscode_id=code.id, course_id=course_id) for code in created for course_id in course_ids]
+        )
+        # bulk_create sends no post_save: clear the bot's "no such code" cache here
+        forget_missing_codes(new_codes)
+    return new_codes
+
+
+def _insert_chunk_safe(codes: list[str], course_ids) -> list[str]:
+    try:
+        return _insert_chunk(codes, course_ids)
+    except IntegrityError:
+        # Someone inserted one of these codes between the check and the insert - check again
+        return _insert_chunk(codes, course_ids)
+
+
+def generate_codes(count: int, course_ids, alphabet: str = DEFAULT_ALPHABET, length: int = DEFAULT_LENGTH, prefix: str = ''):
+    """
+    Creates `count` new unique codes for the courses, CHUNK_SIZE per transaction.
+    Yields the codes chunk by chunk, so they can be streamed out while the rest is generated.
+    """
+    alphabet = ''.join(dict.fromkeys(alphabet))     # without repeated letters
+    if len(prefix) + length > CODE_MAX_LENGTH:
+        raise ValueError(f"Код длиннее {CODE_MAX_LENGTH} символов.")
+    if len(alphabet) < 2 or len(alphabet) ** length < count * MIN_SPACE_FACTOR:
+        raise ValueError("Слишком короткий код или алфавит для такого количества - увеличьте длину.")
+
+    left, attempts = count, 0
+    while left > 0:
+        size = min(left, CHUNK_SIZE)
+        candidates = set()
+        while len(candidates) < size:
+            candidates.add(prefix + ''.join(secrets.choice(alphabet) for _ in range(length)))
+
+        created = _insert_chunk_safe(list(candidates), course_ids)
+        left -= len(created)
+        attempts = attempts + 1 if not created else 0
+        if attempts >= MAX_ATTEMPTS:
+            raise RuntimeError("Не удаётся сгенерировать новые коды: пространство кодов почти исчерпано.")
+        if created:
+            yield created
+
+
+def import_codes(lines, course_ids) -> dict:
+    """
+    Imports an externally generated list (one code per line or the first CSV column).
+    Returns counters: created / existing (already in the database or repeated) / invalid.
+    """
+    stats = {'created': 0, 'existing': 0, 'invalid': 0}
+    seen = set()
+    chunk = []
+
+    def flush():
+        created = _insert_chunk_safe(chunk, course_ids)
+        stats['created'] += len(created)
+        stats['existing'] += len(chunk) - len(created)
+        chunk.clear()
+
+    for row in csv.reader(lines):
+        code = row[0].strip() if row else ''
+        if not code or code.lower() == 'code':    # empty line or a header
+            continue
+        if len(code) > CODE_MAX_LENGTH:
+            stats['invalid'] += 1
+            continue
+        if code in seen:
+            stats['existing'] += 1
+            continue
+        seen.add(code)
+        chunk.append(code)
+        if len(chunk) >= CHUNK_SIZE:
+            flush()
+    if chunk:
+        flush()
+    return stats
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from asgiref.sync import sync_to_async
+from django.db import connection, connections
+
+from config import DB_RELEASE_EVERY
+
+logger = logging.getLogger(__name__)
+
+
+def stats() -> dict | None:
+    """
+    Pool metrics (psycopg_pool counters are cumulative since start).
+    None when the process runs without a pool (admin, management commands).
+    """
+    pool = getattr(connection, 'pool', None)
+    if pool is None:
+        return None
+    raw = pool.get_stats()
+    size, available = raw.get('pool_size', 0), raw.get('pool_available', 0)
+    return {
+        'size': size,
+        'checked_out': size - available,
+        'available': available,
+        'waiting': raw.get('requests_waiting', 0),
+        'requests': raw.get('requests_num', 0),
+        'queued': raw.get('requests_queued', 0),
+        'wait_ms_total': raw.get('requests_wait_ms', 0),
+        'timeouts': raw.get('requests_errors', 0),
+        # Churn: new connections opened, broken ones dropped by the health check
+        'connections_opened': raw.get('connections_num', 0),
+        'connections_lost': raw.get('connections_lost', 0),
+        'returns_bad': raw.get('returns_bad', 0),
+    }
+
+
+_held_since = {}     # alias -> when the current connection was taken from the pool
+
+
+def _release_if_due(max_age: float):
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is None:
+            _held_since.pop(conn.alias, None)
+            continue
+        if conn.in_atomic_block:
+            continue
+        held_since = _held_since.setdefault(conn.alias, time.monotonic())
+        if conn.errors_occurred:
+            if conn.is_usable():
+                conn.errors_occurred = False
+            else:
+                # Broken (the database restarted): the pool replaces it on the next checkout
+                conn.close()
+                _held_since.pop(conn.alias, None)
+                continue
+        if time.monotonic() - held_since >= max_age:
+            conn.close()
+            _held_since.pop(conn.alias, None)
+
+
+async def release(max_age: float = DB_RELEASE_EVERY):
+    """
+    Gives the ORM thread's connection back to the pool after a database error or once it was held
+    for max_age seconds. In between it is reused as is: no pool round trip and health check per update.
+    (close_old_connections() would return it every time - with the pool CONN_MAX_AGE is 0.)
+    Runs in the same thread as the async ORM calls.
+    """
+    await sync_to_async(_release_if_due)(max_age)
+
+
+class ReleaseConnectionMiddleware(BaseMiddleware):
+    """
+    Outer middleware: after every update checks whether the connection is due back to the pool.
+    """
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            await release()
+
+
+async def report_loop(every: int = 300):
+    last_requests = 0
+    while True:
+        await asyncio.sleep(every)
+        current = await sync_to_async(stats)()
+        if current and current['requests'] != last_requests:
+            logger.info(f"🗄 DB pool: {current}")
+            last_requests = current['requests']
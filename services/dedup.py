@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from redis.asyncio import Redis
+
+from config import DEDUP_TTL
+
+logger = logging.getLogger(__name__)
+
+SEEN = "updates:seen:{}"    # block number
+# update_ids grow one by one, so the seen ones are a bitmap split into blocks of BLOCK_BITS ids
+# (8 KB each). One bit per update whatever the traffic; a block expires DEDUP_TTL after its last update.
+BLOCK_BITS = 1 << 16
+
+
+class DedupMiddleware(BaseMiddleware):
+    """
+    Outer update middleware: an update_id that was already handled (polling restart, webhook retry,
+    stream redelivery) is skipped. SETBIT returns the old bit, so checking and marking is one atomic
+    command - two processes can't both take the same update.
+    If the handler fails or is cancelled (stream worker timeout, shutdown), the mark is removed
+    and a redelivery is handled again.
+    If Redis is unavailable, updates pass.
+    """
+
+    def __init__(self, redis: Redis, ttl: int = DEDUP_TTL):
+        self.redis = redis
+        self.ttl = ttl
+        self.received = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    @staticmethod
+    def _position(update_id: int) -> tuple[str, int]:
+        block, offset = divmod(update_id, BLOCK_BITS)
+        return SEEN.format(block), offset
+
+    async def _mark(self, update_id: int, value: int) -> int:
+        name, offset = self._position(update_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.setbit(name, offset, value)
+            pipe.expire(name, self.ttl)
+            previous, _ = await pipe.execute()
+        return previous
+
+    async def __call__(self, handler, event: Update, data):
+        self.received += 1
+        try:
+            seen = await self._mark(event.update_id, 1)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Dedup: Redis error, update {event.update_id} passes: {e}")
+            return await handler(event, data)
+
+        if seen:
+            self.duplicates += 1
+            logger.info(f"♻️ Update {event.update_id} already handled, skipped")
+            return None
+
+        try:
+            return await handler(event, data)
+        except BaseException:
+            try:
+                await self._mark(event.update_id, 0)
+            except Exception:
+                pass
+            raise
+
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'duplicate_rate': round(self.duplicates / self.received, 4) if self.received else None,
+            'redis_errors': self.errors,
+        }
+
+    async def report_loop(self, every: int = 300):
+        while True:
+            await asyncio.sleep(every)
+            logger.info(f"♻️ Dedup: {self.stats()}")
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+
+from django.db import transaction
+from redis import Redis as SyncRedis
+from redis.asyncio import Redis
+
+from config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Channels (Redis pub/sub) between the admin container and the bot container
+SCHEDULE_CHANGED = "coursebot:schedule"
+CATALOG_CHANGED = "coursebot:catalog"
+TEXTS_CHANGED = "coursebot:texts"
+FAQ_CHANGED = "coursebot:faq"
+# Bot process -> bot processes: a user's FSM state changed (payload "<origin> <key>")
+FSM_CHANGED = "coursebot:fsm"
+# A BotUser row was added/changed/deleted (payload - telegram_id)
+USERS_CHANGED = "coursebot:users"
+
+_publisher = None
+# After a failed publish the next ones are skipped for RETRY_PAUSE seconds
+RETRY_PAUSE = 30
+_retry_at = 0.0
+
+
+def publish(channel: str, payload: str = "1"):
+    """
+    Sends an event to all bot processes. Best effort: if Redis is down,
+    the bot still catches up by itself (periodic re-check).
+    Inside a transaction (e.g. an admin save) the event waits for the commit,
+    otherwise the bot could re-read the old data.
+    """
+    transaction.on_commit(lambda: _publish(channel, payload))
+
+
+def _publish(channel: str, payload: str):
+    run_sync(f"событие {channel}", lambda redis: redis.publish(channel, payload))
+
+
+def run_sync(what: str, call):
+    """
+    Runs call(redis) on the shared sync connection of the admin side. Best effort, like the events.
+    """
+    global _publisher, _retry_at
+    # Redis is down: don't make every save wait for the connect timeout
+    if time.monotonic() < _retry_at:
+        return
+    try:
+        if _publisher is None:
+            _publisher = SyncRedis(host=REDIS_HOST, port=REDIS_PORT, db=0, socket_timeout=2, socket_connect_timeout=2)
+        call(_publisher)
+    except Exception as e:
+        _retry_at = time.monotonic() + RETRY_PAUSE
+        logger.warning(f"⚠️ Не удалось отправить {what}: {e}")
+
+
+async def listen(redis: Redis, handlers: dict):
+    """
+    Subscribes to the channels and calls handlers[channel](payload) for every event.
+    Reconnects by itself if the connection is lost. Events published while we were not
+    subscribed are lost, so after every (re)subscribe each handler is called with None:
+    "anything may have changed", every cache drops its copy.
+    """
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(*handlers)
+            logger.info(f"📡 Listening to events: {', '.join(handlers)}")
+            for channel, handler in handlers.items():
+                try:
+                    handler(None)
+                except Exception:
+                    logger.exception(f"❌ Ошибка обработки события {channel}")
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                channel = message["channel"].decode() if isinstance(message["channel"], bytes) else message["channel"]
+                payload = message["data"].decode() if isinstance(message["data"], bytes) else message["data"]
+                try:
+                    handlers[channel](payload)
+                except Exception:
+                    logger.exception(f"❌ Ошибка обработки события {channel}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Потеряно соединение с Redis (events): {e}")
+            await asyncio.sleep(5)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import math
+import re
+
+from django.db import transaction
+
+from core.models import FAQItem
+from services.events import FAQ_CHANGED, publish
+
+logger = logging.getLogger(__name__)
+
+# Russian and Norwegian change word endings (курс/курса/курсов, kurs/kurset/kursene),
+# so words are compared by their first STEM_LENGTH letters
+STEM_LENGTH = 5
+# A short word (MIN_PREFIX letters or more) also matches the longer words it starts
+MIN_PREFIX = 3
+# A question word counts more than a word somewhere in the answer
+QUESTION_WEIGHT = 3
+ANSWER_WEIGHT = 1
+
+STOP_WORDS = {
+    # ru
+    'и', 'в', 'во', 'на', 'не', 'что', 'как', 'а', 'но', 'с', 'со', 'к', 'ко', 'по', 'за', 'из', 'у', 'о', 'об',
+    'от', 'до', 'для', 'ли', 'же', 'то', 'это', 'я', 'мне', 'меня', 'мы', 'вы', 'вам', 'вас', 'он', 'она',
+    'они', 'их', 'его', 'ее', 'её', 'там', 'тут', 'где', 'или', 'бы', 'если', 'можно', 'нужно',
+    # no
+    'og', 'i', 'på', 'er', 'det', 'den', 'en', 'et', 'ei', 'til', 'av', 'som', 'for', 'med', 'jeg', 'du',
+    'vi', 'de', 'har', 'kan', 'om', 'å', 'ikke', 'hva', 'hvor', 'hvordan',
+}
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def stem(word: str) -> str:
+    return word[:STEM_LENGTH]
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercase words without punctuation and stop words, cut to their stem.
+    """
+    return [stem(word) for word in _WORD_RE.findall(text.lower().replace('ё', 'е')) if word not in STOP_WORDS]
+
+
+class FaqRecord:
+    __slots__ = ('id', 'question', 'answer')
+
+    def __init__(self, item: FAQItem):
+        self.id = item.id
+        self.question = item.question
+        self.answer = item.answer
+
+
+class FaqSnapshot:
+    """
+    Visible FAQ items (in menu order) plus an inverted index: stem -> {item_id: weight},
+    and short prefix -> longer stems, so a short query word does not scan the vocabulary.
+    """
+    __slots__ = ('version', 'items', 'by_id', 'index', 'idf', 'prefixes')
+
+    def __init__(self, version: int, items):
+        self.version = version
+        self.items = tuple(items)
+        self.by_id = {item.id: item for item in self.items}
+
+        index = {}
+        for item in self.items:
+            for weight, text in ((QUESTION_WEIGHT, item.question), (ANSWER_WEIGHT, item.answer)):
+                for token in tokenize(text):
+                    postings = index.setdefault(token, {})
+                    postings[item.id] = postings.get(item.id, 0) + weight
+        self.index = index
+        # Rare words decide more than words found in every item
+        self.idf = {token: math.log(1 + len(self.items) / len(postings)) for token, postings in index.items()}
+
+        prefixes = {}
+        for token in index:
+            for length in range(MIN_PREFIX, min(len(token), STEM_LENGTH)):
+                prefixes.setdefault(token[:length], []).append(token)
+        self.prefixes = prefixes
+
+    def _matching_stems(self, token: str):
+        if token in self.index:
+            yield token
+        # Short words: "код" finds "кодом", "коды" finds "код" (a prefix of MIN_PREFIX+ letters is enough)
+        yield from self.prefixes.get(token, ())
+        for length in range(MIN_PREFIX, min(len(token), STEM_LENGTH)):
+            if token[:length] in self.index:
+                yield token[:length]
+
+    def search(self, query: str, limit: int = 5) -> list[FaqRecord]:
+        scores = {}
+        for token in set(tokenize(query)):
+            for known in self._matching_stems(token):
+                idf = self.idf[known]
+                for item_id, weight in self.index[known].items():
+                    scores[item_id] = scores.get(item_id, 0) + weight * idf
+        best = sorted(scores, key=lambda item_id: -scores[item_id])[:limit]
+        return [self.by_id[item_id] for item_id in best]
+
+
+_current = None
+_version = 0
+_generation = 0     # bumped by every invalidation
+_lock = None        # created on first use, inside the running loop
+
+
+async def aload() -> FaqSnapshot:
+    global _current, _version, _lock
+    snapshot = _current
+    if snapshot is not None:
+        return snapshot
+
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:
+        if _current is not None:
+            return _current
+        generation = _generation
+        items = [FaqRecord(item) async for item in FAQItem.objects.filter(is_visible=True).order_by('order', 'id')]
+        _version += 1
+        snapshot = FaqSnapshot(_version, items)
+        # An invalidation arrived while we were loading - serve it, but reload next time
+        if generation == _generation:
+            _current = snapshot
+        logger.info(f"❓ FAQ v{snapshot.version}: {len(snapshot.items)} items, {len(snapshot.index)} stems")
+        return snapshot
+
+
+def invalidate(*args):
+    global _current, _generation
+    _generation += 1
+    _current = None
+
+
+def changed():
+    """
+    Called on FAQItem save/delete (in any process).
+    """
+    transaction.on_commit(invalidate)
+    publish(FAQ_CHANGED)
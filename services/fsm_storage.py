@@ -0,0 +1,337 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, Mapping
+
+import msgpack
+from aiogram import BaseMiddleware
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from redis.asyncio import Redis
+
+from config import FSM_CACHE_SIZE, FSM_CACHE_TTL, SCHEDULER_WORKER_ID
+from services.events import FSM_CHANGED
+
+logger = logging.getLogger(__name__)
+
+# Writes of the current update: cache key -> (StorageKey, entry). None outside of an update.
+_pending: ContextVar[dict | None] = ContextVar('fsm_pending', default=None)
+
+
+class CompactRedisStorage(BaseStorage):
+    """
+    One Redis hash per user instead of two string keys: field "s" - state, field "d" - data in msgpack.
+    Empty fields are removed, a user without state and data has no key at all.
+    Small hashes are stored by Redis as a listpack, so a typical user costs a fraction of the JSON layout.
+    """
+
+    def __init__(self, redis: Redis, key_builder: KeyBuilder = None, ttl: int = None):
+        self.redis = redis
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.ttl = ttl
+
+    async def load(self, key: StorageKey) -> tuple[str | None, dict]:
+        state, data = await self.redis.hmget(self.key_builder.build(key), "s", "d")
+        return _decode(state), msgpack.unpackb(data) if data else {}
+
+    def queue_write(self, pipe, key: StorageKey, state: str | None, data: dict):
+        name = self.key_builder.build(key)
+        if state is None and not data:
+            pipe.delete(name)
+            return
+        self._queue_field(pipe, name, "s", state)
+        self._queue_field(pipe, name, "d", msgpack.packb(data) if data else None)
+
+    def _queue_field(self, pipe, name: str, field: str, value):
+        if value is None:
+            # The last field gone - Redis removes the hash itself
+            pipe.hdel(name, field)
+            return
+        pipe.hset(name, field, value)
+        if self.ttl:
+            pipe.expire(name, self.ttl)
+
+    async def _set_field(self, key: StorageKey, field: str, value):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self._queue_field(pipe, self.key_builder.build(key), field, value)
+            await pipe.execute()
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return _decode(await self.redis.hget(self.key_builder.build(key), "s"))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        data = await self.redis.hget(self.key_builder.build(key), "d")
+        return msgpack.unpackb(data) if data else {}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._set_field(key, "s", state.state if isinstance(state, State) else state)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        await self._set_field(key, "d", msgpack.packb(data) if data else None)
+
+    async def migrate_legacy_keys(self, json_loads=json.loads) -> int:
+        """
+        Moves users saved by RedisStorage (<key>:state / <key>:data, JSON) into hashes.
+        Safe to run again and from several processes; users already in a hash are left alone.
+        """
+        moved = 0
+        async for raw in self.redis.scan_iter(match="fsm:*:state", count=1000):
+            state_key = _decode(raw)
+            name = state_key[:-len(":state")]
+            data_key = f"{name}:data"
+            state, data = await self.redis.mget(state_key, data_key)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hsetnx(name, "s", state)
+                if data:
+                    pipe.hsetnx(name, "d", msgpack.packb(json_loads(data)))
+                if self.ttl:
+                    pipe.expire(name, self.ttl)
+                pipe.delete(state_key, data_key)
+                await pipe.execute()
+            moved += 1
+        # Data without a state (rare)
+        async for raw in self.redis.scan_iter(match="fsm:*:data", count=1000):
+            data_key = _decode(raw)
+            name = data_key[:-len(":data")]
+            data = await self.redis.get(data_key)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                if data:
+                    pipe.hsetnx(name, "d", msgpack.packb(json_loads(data)))
+                    if self.ttl:
+                        pipe.expire(name, self.ttl)
+                pipe.delete(data_key)
+                await pipe.execute()
+            moved += 1
+        return moved
+
+    async def close(self) -> None:
+        await self.redis.aclose(close_connection_pool=True)
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class _Entry:
+    __slots__ = ('state', 'data', 'loaded_at')
+
+    def __init__(self, state: str | None, data: dict, loaded_at: float):
+        self.state = state
+        self.data = data
+        self.loaded_at = loaded_at
+
+
+class CachedStorage(BaseStorage):
+    """
+    Redis FSM storage (RedisStorage or CompactRedisStorage) with an in-process LRU cache in front of it.
+
+    Reads: state and data of a user are loaded together with one pipelined round trip,
+    then served from memory. Writes go to the cache at once; inside an update
+    (see FlushMiddleware) all of them are sent in one pipeline when the update is done,
+    outside of it (scheduler) right away. Every write also announces the key to the other
+    processes (FSM_CHANGED), which drop their copy.
+
+    Concurrent misses of one key share a single load, so every caller gets the same entry.
+    The updates of one user must still not overlap (a handler reads, awaits, then writes):
+    OrderedDispatcher runs them one after another inside a process (polling, webhook),
+    stream workers do it per partition. Several webhook instances behind a balancer are not covered.
+    """
+
+    def __init__(self, storage: 'RedisStorage | CompactRedisStorage', size: int = FSM_CACHE_SIZE,
+                 ttl: float = FSM_CACHE_TTL, origin: str = SCHEDULER_WORKER_ID):
+        self.storage = storage
+        self.redis = storage.redis
+        self.key_builder = storage.key_builder
+        if isinstance(storage, CompactRedisStorage):
+            self._load, self._queue_write = storage.load, storage.queue_write
+        else:
+            self._load, self._queue_write = self._load_split, self._queue_split
+        self.size = size
+        self.ttl = ttl
+        self.origin = origin
+        self._cache = OrderedDict()     # key_builder.build(key) -> _Entry, LRU order
+        self._loading = {}              # key_builder.build(key) -> load in progress (future of _Entry)
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0         # pipelines sent
+        self.coalesced = 0      # state/data changes that shared a pipeline with another one
+
+    # --- Cache ---
+
+    def _remember(self, name: str, entry: _Entry):
+        self._cache[name] = entry
+        self._cache.move_to_end(name)
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    async def _entry(self, key: StorageKey) -> _Entry:
+        name = self.key_builder.build(key)
+        entry = self._cache.get(name)
+        if entry is not None and time.monotonic() - entry.loaded_at < self.ttl:
+            self.hits += 1
+            self._cache.move_to_end(name)
+            return entry
+
+        loading = self._loading.get(name)
+        if loading is None:
+            self.misses += 1
+            loading = self._loading[name] = asyncio.ensure_future(self._fetch(key, name))
+        # A cancelled caller must not cancel the load the others wait for
+        return await asyncio.shield(loading)
+
+    async def _fetch(self, key: StorageKey, name: str) -> _Entry:
+        loading = self._loading[name]
+        try:
+            state, data = await self._load(key)
+        except BaseException:
+            if self._loading.get(name) is loading:
+                del self._loading[name]
+            raise
+        entry = _Entry(state, data, time.monotonic())
+        # Forgotten while loading (another process wrote it) - what we read may be older, don't keep it
+        if self._loading.get(name) is loading:
+            del self._loading[name]
+            self._remember(name, entry)
+        return entry
+
+    async def _load_split(self, key: StorageKey) -> tuple[str | None, dict]:
+        # RedisStorage layout: <key>:state and <key>:data (JSON), both in one round trip
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.key_builder.build(key, "state"))
+            pipe.get(self.key_builder.build(key, "data"))
+            state, data = await pipe.execute()
+        if isinstance(state, bytes):
+            state = state.decode("utf-8")
+        return state, self.storage.json_loads(data) if data else {}
+
+    def _queue_split(self, pipe, key: StorageKey, state: str | None, data: dict):
+        state_key = self.key_builder.build(key, "state")
+        data_key = self.key_builder.build(key, "data")
+        if state is None:
+            pipe.delete(state_key)
+        else:
+            pipe.set(state_key, state, ex=self.storage.state_ttl)
+        if data:
+            pipe.set(data_key, self.storage.json_dumps(data), ex=self.storage.data_ttl)
+        else:
+            pipe.delete(data_key)
+
+    def forget(self, name: str = None):
+        """
+        Drops one cached user (by key_builder.build(key)) or everything.
+        """
+        if name is None:
+            self._cache.clear()
+            self._loading.clear()
+        else:
+            self._cache.pop(name, None)
+            self._loading.pop(name, None)
+
+    def on_remote_change(self, payload: str):
+        # FSM_CHANGED handler: another process wrote this key (None - events were missed, drop everything)
+        if payload is None:
+            self.forget()
+            return
+        origin, _, name = payload.partition(" ")
+        if origin != self.origin:
+            self.forget(name)
+
+    # --- BaseStorage ---
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._entry(key)).state
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        # A copy: update_data() changes the returned dict before set_data()
+        return dict((await self._entry(key)).data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        await self._changed(key, entry)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        entry = await self._entry(key)
+        entry.data = dict(data)
+        await self._changed(key, entry)
+
+    async def _changed(self, key: StorageKey, entry: _Entry):
+        pending = _pending.get()
+        if pending is None:
+            await self.write({self.key_builder.build(key): (key, entry)})
+            return
+        name = self.key_builder.build(key)
+        if name in pending:
+            self.coalesced += 1
+        pending[name] = (key, entry)
+
+    async def write(self, changes: dict):
+        """
+        One pipeline for all changed users: state and data (delete instead of writing empty ones)
+        plus the FSM_CHANGED announcement.
+        """
+        if not changes:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for name, (key, entry) in changes.items():
+                    self._queue_write(pipe, key, entry.state, entry.data)
+                    pipe.publish(FSM_CHANGED, f"{self.origin} {name}")
+                await pipe.execute()
+            self.writes += 1
+        except Exception:
+            # Memory is ahead of Redis now - drop it, the next read takes what Redis has
+            for name in changes:
+                self.forget(name)
+            raise
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'cached': len(self._cache),
+            'hit_rate': round(self.hits / total, 3) if total else None,
+            'misses': self.misses,
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+        }
+
+    async def report_loop(self, every: int = 300):
+        while True:
+            await asyncio.sleep(every)
+            logger.info(f"🧠 FSM cache: {self.stats()}")
+
+
+class FlushMiddleware(BaseMiddleware):
+    """
+    Collects the FSM writes of one update and sends them in one pipeline when the update is done.
+    OrderedDispatcher and UpdateConsumer let the next update of the user in only after that,
+    so it reads the flushed state.
+    """
+
+    def __init__(self, storage: CachedStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        token = _pending.set({})
+        try:
+            return await handler(event, data)
+        finally:
+            changes = _pending.get()
+            _pending.reset(token)
+            try:
+                await self.storage.write(changes)
+            except Exception:
+                logger.exception("❌ FSM write failed")
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from django.db import transaction
+
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, USER_REFRESH_EVERY
+from core.models import BotUser
+from services.events import USERS_CHANGED, publish
+
+logger = logging.getLogger(__name__)
+
+
+class Identity:
+    """
+    telegram_id -> BotUser, an LRU cache with TTL in front of the table. Unknown users are cached
+    too (as None), so someone who never pressed /start costs no query per message.
+    New users are created with get_or_create; changed usernames/first names are collected and written
+    in one batch every USER_REFRESH_EVERY seconds.
+
+    Works as a cache only after start() (bot process); before that every call goes to the DB.
+    """
+
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.enabled = False
+        self._cache = OrderedDict()     # telegram_id -> (BotUser | None, loaded_at), LRU order
+        self._refresh = {}              # pk -> BotUser with the new names
+
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.refreshed = 0
+
+    def start(self):
+        self.enabled = bool(self.size)
+
+    # --- Cache ---
+
+    def _remember(self, telegram_id: int, user: BotUser | None):
+        if not self.enabled:
+            return
+        self._cache[telegram_id] = (user, time.monotonic())
+        self._cache.move_to_end(telegram_id)
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    def forget(self, telegram_id: int = None):
+        if telegram_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(telegram_id, None)
+
+    def on_remote_change(self, payload: str):
+        # USERS_CHANGED handler: the admin added/edited/deleted this user (None - events were missed)
+        self.forget(None if payload is None else int(payload))
+
+    # --- Lookups ---
+
+    async def get(self, from_user) -> BotUser | None:
+        """
+        The BotUser of a Telegram user, None if they have no row yet.
+        """
+        cached = self._cache.get(from_user.id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            self.hits += 1
+            self._cache.move_to_end(from_user.id)
+            user = cached[0]
+        else:
+            self.misses += 1
+            user = await BotUser.objects.filter(telegram_id=from_user.id).afirst()
+            self._remember(from_user.id, user)
+        if user is not None and self.enabled:
+            self._refresh_later(user, from_user)
+        return user
+
+    async def ensure(self, from_user) -> tuple[BotUser, bool]:
+        """
+        Like get(), but creates the row if there is none. get_or_create falls back to a read
+        when another process inserted the same user between our lookup and the INSERT.
+        created - this call inserted the row. Other processes may have cached "no row"
+        for the user; the BotUser post_save signal tells them (see changed()).
+        """
+        user = await self.get(from_user)
+        if user is not None:
+            return user, False
+
+        user, created = await BotUser.objects.aget_or_create(
+            telegram_id=from_user.id,
+            defaults={'username': from_user.username, 'first_name': from_user.first_name},
+        )
+        self._remember(from_user.id, user)
+        if not created:
+            # Someone else created them a moment ago - only the names may be new
+            if self.enabled:
+                self._refresh_later(user, from_user)
+            return user, False
+
+        self.created += 1
+        return user, True
+
+    # --- Background refresh ---
+
+    def _refresh_later(self, user: BotUser, from_user):
+        if user.username == from_user.username and user.first_name == from_user.first_name:
+            return
+        user.username = from_user.username
+        user.first_name = from_user.first_name
+        self._refresh[user.pk] = user
+
+    async def flush(self):
+        """
+        Writes the collected name changes with one UPDATE.
+        """
+        users, self._refresh = list(self._refresh.values()), {}
+        if users:
+            await BotUser.objects.abulk_update(users, ['username', 'first_name'])
+            self.refreshed += len(users)
+
+    async def flush_loop(self, every: int = USER_REFRESH_EVERY):
+        while True:
+            await asyncio.sleep(every)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("❌ BotUser refresh failed")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'cached': len(self._cache),
+            'hit_rate': round(self.hits / total, 3) if total else None,
+            'misses': self.misses,
+            'created': self.created,
+            'refreshed': self.refreshed,
+        }
+
+    async def report_loop(self, every: int = 300):
+        while True:
+            await asyncio.sleep(every)
+            logger.info(f"👤 Users: {self.stats()}")
+
+
+identity = Identity()
+
+
+def changed(telegram_id: int):
+    """
+    Called on BotUser save/delete (admin): the bot processes drop their cached copy.
+    """
+    transaction.on_commit(lambda: identity.forget(telegram_id))
+    publish(USERS_CHANGED, str(telegram_id))
+
+
+class UserMiddleware(BaseMiddleware):
+    """
+    Outer update middleware: resolves the sender's BotUser once per update and passes it to the handlers
+    as `bot_user` (None - no row yet, the handler decides whether to create it).
+    Group chats (the support group) are skipped.
+    """
+
+    def __init__(self, identity: Identity = identity):
+        self.identity = identity
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is not None and not user.is_bot and (chat is None or chat.type == "private"):
+            data["bot_user"] = await self.identity.get(user)
+        return await handler(event, data)
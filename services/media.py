@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import os
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+from asgiref.sync import sync_to_async
+
+from core.models import LessonMediaCache
+from services.pipeline import pipeline
+
+# Lesson field -> (Bot method, attribute of the returned Message)
+MEDIA_FIELDS = {
+    'image': ('send_photo', 'photo'),
+    'audio': ('send_audio', 'audio'),
+    'video_note': ('send_video_note', 'video_note'),
+    'file_doc': ('send_document', 'document'),
+}
+
+# (lesson_id, field) -> (file_hash, file_id)
+_file_ids = {}
+# path -> (size, mtime, sha256): the file is hashed only once while it is unchanged
+_hashes = {}
+# One upload per (lesson, field) at a time, the other recipients wait for its file_id
+_upload_locks = {}
+_loaded = False
+
+
+def file_hash(path: str) -> str:
+    stat = os.stat(path)
+    cached = _hashes.get(path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime):
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    _hashes[path] = (stat.st_size, stat.st_mtime, digest.hexdigest())
+    return _hashes[path][2]
+
+
+async def load_cache():
+    global _loaded
+    async for lesson_id, field, hash_, file_id in LessonMediaCache.objects.values_list('lesson_id', 'field', 'file_hash', 'file_id'):
+        _file_ids[(lesson_id, field)] = (hash_, file_id)
+    _loaded = True
+
+
+def cached_file_id(lesson_id: int, field: str, hash_: str) -> str | None:
+    cached = _file_ids.get((lesson_id, field))
+    return cached[1] if cached and cached[0] == hash_ else None
+
+
+async def stored_file_id(lesson_id: int, field: str, hash_: str) -> str | None:
+    """
+    Memory missed: another process (preupload_media, another worker) may have uploaded it since load_cache().
+    """
+    file_id = await LessonMediaCache.objects.filter(
+        lesson_id=lesson_id, field=field, file_hash=hash_
+    ).values_list('file_id', flat=True).afirst()
+    if file_id:
+        _file_ids[(lesson_id, field)] = (hash_, file_id)
+    return file_id
+
+
+async def remember(lesson_id: int, field: str, hash_: str, file_id: str):
+    _file_ids[(lesson_id, field)] = (hash_, file_id)
+    await LessonMediaCache.objects.aupdate_or_create(
+        lesson_id=lesson_id, field=field, defaults={'file_hash': hash_, 'file_id': file_id}
+    )
+
+
+def forget(lesson_id: int, fields=None):
+    """
+    Drops the cached file_id (the file was replaced in the admin).
+    """
+    fields = fields or list(MEDIA_FIELDS)
+    for field in fields:
+        _file_ids.pop((lesson_id, field), None)
+    LessonMediaCache.objects.filter(lesson_id=lesson_id, field__in=fields).delete()
+
+
+async def aforget(lesson_id: int, fields=None):
+    fields = fields or list(MEDIA_FIELDS)
+    for field in fields:
+        _file_ids.pop((lesson_id, field), None)
+    await LessonMediaCache.objects.filter(lesson_id=lesson_id, field__in=fields).adelete()
+
+
+def extract_file_id(message, attr: str) -> str | None:
+    media = getattr(message, attr, None)
+    if isinstance(media, list):     # photo comes as a list of sizes
+        media = media[-1] if media else None
+    return media.file_id if media else None
+
+
+async def send_media(bot: Bot, chat_id: int, lesson, field: str):
+    """
+    Sends one media field of the lesson (a catalog LessonRecord: the field holds the file path).
+    The first send uploads the file, every next one reuses the Telegram file_id.
+    """
+    method_name, attr = MEDIA_FIELDS[field]
+    method = getattr(bot, method_name)
+    path = getattr(lesson, field)
+
+    if not _loaded:
+        await load_cache()
+
+    # Reading the file blocks - in a thread
+    hash_ = await sync_to_async(file_hash)(path)
+    key = (lesson.id, field)
+
+    file_id = cached_file_id(lesson.id, field, hash_)
+    if file_id:
+        try:
+            return await pipeline.send(chat_id, method, chat_id, file_id)
+        except TelegramBadRequest:
+            # file_id is not valid anymore (e.g. another bot token) - upload again
+            await aforget(lesson.id, [field])
+
+    lock = _upload_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        file_id = cached_file_id(lesson.id, field, hash_) or await stored_file_id(lesson.id, field, hash_)
+        if file_id:
+            return await pipeline.send(chat_id, method, chat_id, file_id)
+
+        message = await pipeline.send(chat_id, method, chat_id, FSInputFile(path))
+        file_id = extract_file_id(message, attr)
+        if file_id:
+            await remember(lesson.id, field, hash_, file_id)
+        return message
@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from config import SEND_PER_CHAT_INTERVAL, SEND_RATE, SEND_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, up to `capacity` at once.
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _Job:
+    __slots__ = ('method', 'args', 'kwargs', 'future', 'attempt')
+
+    def __init__(self, method, args, kwargs, future):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempt = 0
+
+
+class SendPipeline:
+    """
+    Shared queue for everything the bot sends on its own (lessons, notifications).
+    - global token bucket (Telegram: ~30 msg/s per bot);
+    - per-chat pacing (~1 msg/s per chat), messages of one chat keep their order;
+    - bounded worker pool and bounded number of queued messages;
+    - TelegramRetryAfter pauses the whole pipeline for retry_after seconds and retries.
+
+    Every chat with queued messages has one entry in a heap ordered by the time it may send next.
+    Workers only take chats that are ready, so a worker never sleeps out a chat's pacing
+    interval (or a retry backoff) while other chats are waiting.
+    """
+    MAX_RETRIES = 3
+    # Network/server errors: retried after BACKOFF * 2**attempt seconds
+    BACKOFF = 1.0
+
+    def __init__(self, rate: float, per_chat_interval: float, workers: int):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.workers_count = workers
+        self.max_queued = workers * 50
+        self._workers = []
+        self._capacity = None
+        self._paused_until = 0.0
+        self._chats = {}        # chat_id -> deque of _Job; the chat is in the heap or being sent
+        self._ready = []        # heap of (ready_at, seq, chat_id)
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+        self._chat_next = {}    # chat_id -> monotonic time of the next allowed send
+
+        # Metrics
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.retry_after_events = 0
+        self._recent = deque()  # send timestamps of the last minute
+
+    # --- PUBLIC API ---
+    def start(self):
+        if not self._workers:
+            self._capacity = asyncio.Semaphore(self.max_queued)
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+            logger.info(f"📮 Send pipeline started: {self.workers_count} workers, {self.bucket.rate} msg/s")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def send(self, chat_id: int, method, *args, **kwargs):
+        """
+        Enqueues bot.send_*(...) and waits for its result.
+        Outside of the bot process (no workers) the call is executed right away.
+        """
+        job = _Job(method, args, kwargs, asyncio.get_running_loop().create_future())
+        if not self._workers:
+            return await self._send_now(chat_id, job)
+
+        # Released by the worker when the job is finished
+        await self._capacity.acquire()
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            self._chats[chat_id] = deque([job])
+            self._schedule(chat_id, self._chat_next.get(chat_id, 0))
+        else:
+            queue.append(job)
+        return await job.future
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > 60:
+            self._recent.popleft()
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'retry_after_events': self.retry_after_events,
+            'queued': sum(len(queue) for queue in self._chats.values()),
+            'chats_waiting': len(self._chats),
+            'msg_per_sec_1m': round(len(self._recent) / 60, 2),
+        }
+
+    async def report_loop(self, every: int = 300):
+        last_sent = 0
+        while True:
+            await asyncio.sleep(every)
+            if self.sent != last_sent or self.failed:
+                logger.info(f"📮 Send pipeline: {self.stats()}")
+                last_sent = self.sent
+
+    # --- INTERNALS ---
+    def _schedule(self, chat_id: int, ready_at: float):
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+        self._changed.set()
+
+    async def _next_chat(self) -> int:
+        # Sleeps until the earliest chat may send (or a new chat is queued)
+        while True:
+            timeout = None
+            if self._ready:
+                ready_at = max(self._ready[0][0], self._paused_until)
+                now = time.monotonic()
+                if ready_at <= now:
+                    return heapq.heappop(self._ready)[2]
+                timeout = ready_at - now
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._next_chat()
+            queue = self._chats[chat_id]
+            job = queue[0]
+            try:
+                retry_at = await self._attempt(chat_id, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                retry_at = None
+                _resolve(job.future, exception=e)
+
+            if retry_at is not None:
+                # The job stays first: the chat's later messages wait for it
+                self._schedule(chat_id, retry_at)
+                continue
+            queue.popleft()
+            self._capacity.release()
+            if queue:
+                self._schedule(chat_id, self._chat_next[chat_id])
+            else:
+                del self._chats[chat_id]
+
+    async def _send_now(self, chat_id: int, job: _Job):
+        retry_at = 0.0
+        while True:
+            # A flood-control pause can start while we are waiting - check again after sleeping
+            wait = max(self._paused_until, self._chat_next.get(chat_id, 0), retry_at) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            retry_at = await self._attempt(chat_id, job)
+            if retry_at is None:
+                return await job.future
+
+    async def _attempt(self, chat_id: int, job: _Job) -> float | None:
+        """
+        One try. Resolves the job's future and returns None, or returns when to try again.
+        """
+        await self.bucket.acquire()
+        self._chat_next[chat_id] = time.monotonic() + self.per_chat_interval
+        # Keep the pacing table small: forget chats that are free again
+        if len(self._chat_next) > 10000:
+            now = time.monotonic()
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now or k in self._chats}
+
+        try:
+            result = await job.method(*job.args, **job.kwargs)
+        except TelegramRetryAfter as e:
+            # Telegram asked everyone to slow down
+            self.retry_after_events += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            logger.warning(f"⏳ Flood control: pause for {e.retry_after}s (chat {chat_id})")
+            error = RuntimeError(f"Сообщение для {chat_id} не отправлено после {self.MAX_RETRIES} попыток")
+            return self._retry(job, error, self._paused_until)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            return self._retry(job, e, time.monotonic() + self.BACKOFF * 2 ** job.attempt)
+        except Exception as e:
+            self.failed += 1
+            _resolve(job.future, exception=e)
+            return None
+
+        self.sent += 1
+        self._recent.append(time.monotonic())
+        _resolve(job.future, result=result)
+        return None
+
+    def _retry(self, job: _Job, error: Exception, at: float) -> float | None:
+        if job.attempt >= self.MAX_RETRIES:
+            self.failed += 1
+            _resolve(job.future, exception=error)
+            return None
+        job.attempt += 1
+        self.retried += 1
+        return at
+
+
+def _resolve(future, result=None, exception: Exception = None):
+    # The caller may have given up (cancelled) in the meantime
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+# One pipeline per bot process
+pipeline = SendPipeline(rate=SEND_RATE, per_chat_interval=SEND_PER_CHAT_INTERVAL, workers=SEND_WORKERS)
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from core.models import Enrollment, Lesson, ScheduledDelivery
+from services import clock
+from services.events import SCHEDULE_CHANGED, publish
+
+BATCH_SIZE = 1000
+
+
+def compute_due_at(start_date: datetime, day_number: int, send_time) -> datetime:
+    """
+    Start_Date (local day) + day_number days, at the lesson send_time.
+    Day 1 -> the day after the registration.
+    """
+    start_day = timezone.localtime(start_date).date()
+    return timezone.make_aware(datetime.combine(start_day + timedelta(days=day_number), send_time))
+
+
+def get_course_blocks(course_ids) -> dict[int, set]:
+    """
+    Returns {course_id: {(day_number, send_time), ...}} - all lesson blocks of the courses.
+    """
+    blocks = {}
+    rows = Lesson.objects.filter(course_id__in=course_ids).values_list('course_id', 'day_number', 'send_time').distinct()
+    for course_id, day_number, send_time in rows:
+        blocks.setdefault(course_id, set()).add((day_number, send_time))
+    return blocks
+
+
+def _insert_deliveries(deliveries):
+    # Existing (enrollment, day, time) rows are kept as they are
+    ScheduledDelivery.objects.bulk_create(deliveries, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def plan_enrollments(enrollment_ids):
+    """
+    Fills the delivery plan for freshly created or reactivated enrollments.
+    The pending part of the old plan is replaced, already sent rows stay as history.
+    Rows a worker is sending right now are kept too: the unique block key then stops
+    the new plan from adding the same block again.
+    """
+    now = clock.now()
+    enrollments = list(
+        Enrollment.objects.filter(id__in=enrollment_ids, is_active=True).values_list('id', 'course_id', 'start_date')
+    )
+    if not enrollments:
+        return
+
+    ScheduledDelivery.objects.filter(enrollment_id__in=[e[0] for e in enrollments]).exclude(status__in=['sent', 'sending']).delete()
+
+    blocks = get_course_blocks({e[1] for e in enrollments})
+    deliveries = []
+    for enrollment_id, course_id, start_date in enrollments:
+        for day_number, send_time in blocks.get(course_id, ()):
+            due_at = compute_due_at(start_date, day_number, send_time)
+            if due_at < now:
+                continue
+            deliveries.append(ScheduledDelivery(
+                enrollment_id=enrollment_id, day_number=day_number, send_time=send_time, due_at=due_at
+            ))
+
+    _insert_deliveries(deliveries)
+    publish(SCHEDULE_CHANGED)
+
+
+def replan_blocks(course_id: int, keys):
+    """
+    Incremental rebuild after a lesson was added, edited or deleted.
+    keys - the (day_number, send_time) blocks touched by the change (old and new values).
+    """
+    keys = {key for key in keys if key is not None}
+    if not keys:
+        return
+
+    now = clock.now()
+    key_filter = Q()
+    for day_number, send_time in keys:
+        key_filter |= Q(day_number=day_number, send_time=send_time)
+
+    existing = set(Lesson.objects.filter(key_filter, course_id=course_id).values_list('day_number', 'send_time').distinct())
+
+    # Blocks without lessons disappear from the plan
+    for day_number, send_time in keys - existing:
+        ScheduledDelivery.objects.filter(
+            enrollment__course_id=course_id, day_number=day_number, send_time=send_time, status='pending'
+        ).delete()
+
+    if not existing:
+        publish(SCHEDULE_CHANGED)
+        return
+
+    enrollments = Enrollment.objects.filter(course_id=course_id, is_active=True).values_list('id', 'start_date')
+    deliveries = []
+    for enrollment_id, start_date in enrollments.iterator(chunk_size=BATCH_SIZE):
+        for day_number, send_time in existing:
+            due_at = compute_due_at(start_date, day_number, send_time)
+            if due_at < now:
+                continue
+            deliveries.append(ScheduledDelivery(
+                enrollment_id=enrollment_id, day_number=day_number, send_time=send_time, due_at=due_at
+            ))
+
+    _insert_deliveries(deliveries)
+    publish(SCHEDULE_CHANGED)
+
+
+def replan_course(course_id: int):
+    """
+    Full rebuild of one course (used when lessons are edited inline on the course page).
+    """
+    planned = ScheduledDelivery.objects.filter(
+        enrollment__course_id=course_id, status='pending'
+    ).values_list('day_number', 'send_time').distinct()
+    keys = set(planned) | get_course_blocks([course_id]).get(course_id, set())
+    replan_blocks(course_id, keys)
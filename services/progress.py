@@ -0,0 +1,34 @@
+from core.models import UserProgress
+
+BATCH_SIZE = 500
+
+
+async def record_progress(rows):
+    """
+    rows - iterable of (user_id, lesson_id). One INSERT per batch,
+    already recorded pairs are ignored by the unique constraint.
+    """
+    objs = [UserProgress(user_id=user_id, lesson_id=lesson_id) for user_id, lesson_id in rows]
+    if objs:
+        await UserProgress.objects.abulk_create(objs, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+class ProgressRecorder:
+    """
+    Collects progress rows during a scheduler tick and writes them in batches:
+    when the buffer reaches flush_every rows and at the end of the tick.
+    """
+    def __init__(self, flush_every: int = BATCH_SIZE):
+        self.flush_every = flush_every
+        self._rows = set()
+
+    def add(self, user_id: int, lesson_ids) -> bool:
+        """
+        Returns True when the buffer is full and should be flushed.
+        """
+        self._rows.update((user_id, lesson_id) for lesson_id in lesson_ids)
+        return len(self._rows) >= self.flush_every
+
+    async def flush(self):
+        rows, self._rows = self._rows, set()
+        await record_progress(rows)
@@ -1,110 +1,417 @@
 import asyncio
+import heapq
 import logging
-import schedule
-import time
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
 from asgiref.sync import sync_to_async
 from services.sender import send_lesson_block
 
 from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from django.utils import timezone
-from django.db.models import F
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from core.models import Lesson, Enrollment, UserProgress
+from config import (
+    SCHEDULER_CATCHUP_BATCH, SCHEDULER_CATCHUP_HOURS, SCHEDULER_CATCHUP_PAUSE,
+    SCHEDULER_LEASE_SECONDS, SCHEDULER_RETRY_SECONDS, SCHEDULER_WORKER_ID,
+)
+from core.models import BotSettings, Course, ScheduledDelivery, UserProgress
+from services import clock, dbpool
+from services.catalog import CourseRecord, invalidate as invalidate_catalog, load as load_catalog
+from services.progress import ProgressRecorder
 from services.utils import finish_course
 
 logger = logging.getLogger(__name__)
 
-async def check_and_send_lessons(bot: Bot, dp: Dispatcher):
-    now = timezone.localtime(timezone.now())
-    
-    # We get a list of courses that have ANY lessons available at this moment.
-    active_course_ids = await sync_to_async(list)(
-        Lesson.objects.filter(
-            send_time__hour=now.hour,
-            send_time__minute=now.minute
-        ).values_list('course_id', flat=True).distinct()
+# One due block = all lessons of one enrollment for one day and send time.
+DueBlock = namedtuple(
+    'DueBlock',
+    ['delivery_id', 'enrollment_id', 'user_id', 'telegram_id', 'course_id', 'course_title', 'finish_message', 'lessons', 'is_last']
+)
+
+CLAIM_BATCH_SIZE = 500
+WATERMARK_KEY = "scheduler_watermark"
+# A deadline handled later than this means the bot was down or stalled
+STALL_SECONDS = 120
+# Worth another try later (the pipeline has already retried a few times); anything else
+# (the user blocked the bot, a broken lesson) marks the delivery failed
+TRANSIENT_ERRORS = (TelegramNetworkError, TelegramRetryAfter, TelegramServerError)
+# How often the loop persists the watermark (a restart is detected with this precision)
+WATERMARK_EVERY = 60
+
+
+def release_expired_claims(now: datetime) -> int:
+    """
+    Rows claimed by a worker that died (lease expired) go back to the queue.
+    Lessons already recorded in UserProgress are not sent again.
+    """
+    return ScheduledDelivery.objects.filter(status='sending', claimed_until__lt=now).update(
+        status='pending', claimed_by='', claimed_until=None
+    )
+
+
+def claim_due_blocks(now: datetime, limit: int = CLAIM_BATCH_SIZE) -> list[DueBlock]:
+    """
+    Takes the pending deliveries with due_at <= now from the plan (only active enrollments:
+    unticking "is_active" in the admin stops the lessons).
+    The rows are locked with SKIP LOCKED and leased to this worker in one transaction,
+    so any number of workers can share the plan without sending a block twice.
+    Then the content of the due lessons is loaded once per lesson.
+    """
+    release_expired_claims(now)
+
+    with transaction.atomic():
+        ids = list(
+            ScheduledDelivery.objects
+            .select_for_update(skip_locked=True)
+            .filter(status='pending', due_at__lte=now, enrollment__is_active=True)
+            .order_by('due_at')
+            .values_list('id', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        ScheduledDelivery.objects.filter(id__in=ids).update(
+            status='sending',
+            claimed_by=SCHEDULER_WORKER_ID,
+            claimed_until=clock.now() + timedelta(seconds=SCHEDULER_LEASE_SECONDS),
+        )
+
+    # Something is still planned after this block (claimed rows of the same batch count too)
+    later_deliveries = ScheduledDelivery.objects.filter(
+        Q(status='pending') | Q(status='sending', due_at__gt=OuterRef('due_at')),
+        enrollment_id=OuterRef('enrollment_id'),
+    )
+    rows = list(
+        ScheduledDelivery.objects
+        .filter(id__in=ids)
+        .annotate(
+            user_id=F('enrollment__user_id'),
+            telegram_id=F('enrollment__user__telegram_id'),
+            course_id=F('enrollment__course_id'),
+            has_more=Exists(later_deliveries),
+        )
+        .values_list('id', 'enrollment_id', 'user_id', 'telegram_id', 'course_id', 'has_more', 'day_number', 'send_time')
+        .order_by('due_at', 'id')
     )
 
-    if not active_course_ids:
-        return
+    # Lesson content comes from the in-memory catalog
+    catalog = load_catalog()
+    if any(row[4] not in catalog.courses or not catalog.block(row[4], row[6], row[7]) for row in rows):
+        # The plan knows a course or block the snapshot doesn't (a change event was lost): reload from the DB
+        invalidate_catalog()
+        catalog = load_catalog()
+
+    # "Already sent" lessons (e.g. the course was reactivated) are not repeated
+    sent = set(
+        UserProgress.objects.filter(
+            user_id__in={row[2] for row in rows},
+            lesson_id__in=[lesson.id for row in rows for lesson in catalog.block(row[4], row[6], row[7])],
+        ).values_list('user_id', 'lesson_id')
+    )
+
+    blocks = []
+    for delivery_id, enrollment_id, user_id, telegram_id, course_id, has_more, day_number, send_time in rows:
+        course = catalog.courses.get(course_id)
+        if course is None:
+            course = CourseRecord(Course.objects.get(id=course_id))
+        lessons = [
+            lesson for lesson in catalog.block(course_id, day_number, send_time)
+            if (user_id, lesson.id) not in sent
+        ]
+        blocks.append(DueBlock(
+            delivery_id=delivery_id,
+            enrollment_id=enrollment_id,
+            user_id=user_id,
+            telegram_id=telegram_id,
+            course_id=course_id,
+            course_title=course.title,
+            finish_message=course.finish_message,
+            lessons=lessons,
+            is_last=not has_more,
+        ))
+    return blocks
+
 
-    # We only accept active subscriptions that are relevant to these courses.
-    active_enrollments = await sync_to_async(list)(
-        Enrollment.objects.filter(
-            is_active=True,
-            course_id__in=active_course_ids
-        ).select_related('user', 'course')
+async def mark_deliveries(ids, status: str):
+    # Only our own claims: a row whose lease was lost belongs to another worker now
+    if ids:
+        await ScheduledDelivery.objects.filter(id__in=ids, status='sending', claimed_by=SCHEDULER_WORKER_ID).aupdate(
+            status=status, sent_at=clock.now(), claimed_until=None
+        )
+
+
+async def retry_deliveries(ids, now: datetime):
+    # Back to the queue, due again in SCHEDULER_RETRY_SECONDS (only our own claims, like mark_deliveries)
+    if ids:
+        await ScheduledDelivery.objects.filter(id__in=ids, status='sending', claimed_by=SCHEDULER_WORKER_ID).aupdate(
+            status='pending', claimed_by='', claimed_until=None, due_at=now + timedelta(seconds=SCHEDULER_RETRY_SECONDS)
+        )
+
+
+async def extend_claims(ids):
+    await ScheduledDelivery.objects.filter(id__in=ids, status='sending', claimed_by=SCHEDULER_WORKER_ID).aupdate(
+        claimed_until=clock.now() + timedelta(seconds=SCHEDULER_LEASE_SECONDS)
     )
 
-    if not active_enrollments:
-        return
-
-    for enrollment in active_enrollments:
-        
-        # --- MATH OF DAYS ---
-        # Calculate the difference between “Now” and “Start Date”
-        delta = now.date() - enrollment.start_date.date()
-        
-        # If “Start tomorrow”, then:
-        # Rega 19.01. Now it is 19.01. delta = 0. day_number = 0 (Silence).
-        # Now it is 20.01. delta = 1. day_number = 1 (First lesson).
-        day_number = delta.days 
-        day_number = 1 # for test, default is day_number = delta.days
-        if day_number <= 0:
-            continue 
-
-        # Seeking lessons for this Day and Time
-        lessons = await sync_to_async(list)(
-            Lesson.objects.filter(
-                course=enrollment.course,
-                day_number=day_number,
-                send_time__hour=now.hour,
-                send_time__minute=now.minute
-            )
+
+async def keep_claims_alive(ids):
+    """
+    Heartbeat: extends the lease while the batch is being sent.
+    """
+    while True:
+        await asyncio.sleep(SCHEDULER_LEASE_SECONDS / 3)
+        await extend_claims(ids)
+
+
+# --- WATERMARK (last processed instant, stored in BotSettings) ---
+def get_watermark() -> datetime | None:
+    value = BotSettings.objects.filter(key=WATERMARK_KEY).values_list('value', flat=True).first()
+    return datetime.fromisoformat(value) if value else None
+
+
+async def save_watermark(instant: datetime):
+    # update() sends no post_save: a tick must not invalidate the bot cache of every process
+    if not await BotSettings.objects.filter(key=WATERMARK_KEY).aupdate(value=instant.isoformat()):
+        await BotSettings.objects.aupdate_or_create(key=WATERMARK_KEY, defaults={'value': instant.isoformat()})
+
+
+def recover_backlog(now: datetime) -> int:
+    """
+    Called on startup and after a stall.
+    - blocks claimed by this worker before a restart, or by a worker whose lease
+      expired, are returned to the queue
+      (lessons already recorded in UserProgress are not sent again);
+    - everything older than the catch-up horizon is skipped;
+    - the deliveries that came due after the watermark (while nothing was processed)
+      are the backlog, drained in batches.
+    Returns the number of missed deliveries that will be caught up.
+    """
+    horizon = now - timedelta(hours=SCHEDULER_CATCHUP_HOURS)
+    watermark = get_watermark()
+    # No watermark yet (first start) - anything within the horizon may have been missed
+    since = max(watermark, horizon) if watermark else horizon
+
+    with transaction.atomic():
+        ScheduledDelivery.objects.filter(status='sending', claimed_by=SCHEDULER_WORKER_ID).update(
+            status='pending', claimed_by='', claimed_until=None
         )
+        release_expired_claims(now)
+        skipped = ScheduledDelivery.objects.filter(status='pending', due_at__lt=horizon).update(status='skipped')
+    missed = ScheduledDelivery.objects.filter(
+        status='pending', due_at__gt=since, due_at__lte=now, enrollment__is_active=True
+    ).count()
 
-        if not lessons:
-            pass
-        else:
-            already_sent = await sync_to_async(
-                UserProgress.objects.filter(user=enrollment.user, lesson=lessons[0]).exists
-            )()
-            if not already_sent:
-                try:
-                    await send_lesson_block(bot, enrollment.user, enrollment.course, lessons)
-
-                    for lesson in lessons:
-                        await sync_to_async(UserProgress.objects.create)(user=enrollment.user, lesson=lesson)
-                except Exception as e:
-                    print(f"❌ Error sending block to {enrollment.user}: {e}")
-
-        has_more_lessons = await sync_to_async(lambda: Lesson.objects.filter(
-            course=enrollment.course
-        ).exclude(
-            id__in=UserProgress.objects.filter(user=enrollment.user).values('lesson_id')
-        ).exists())()
-
-        if not has_more_lessons:
+    if skipped or missed:
+        logger.warning(
+            f"⏪ Catch-up: last processed {watermark}, {missed} missed deliveries will be sent, "
+            f"{skipped} older than {SCHEDULER_CATCHUP_HOURS}h skipped."
+        )
+    return missed
+
+
+async def deliver_blocks(bot: Bot, dp: Dispatcher, blocks: list[DueBlock], progress: ProgressRecorder) -> tuple[list, list, list]:
+    """
+    Sends the blocks of one enrollment in order. Returns (sent_ids, failed_ids, retry_ids).
+    Progress is recorded only for the lessons that actually went out.
+    """
+    sent_ids, failed_ids, retry_ids = [], [], []
+    for i, block in enumerate(blocks):
+        if block.lessons:
+            sent = []
+            try:
+                await send_lesson_block(bot, block.telegram_id, block.course_title, block.lessons, sent=sent)
+            except TRANSIENT_ERRORS as e:
+                logger.warning(f"⚠️ Block for {block.telegram_id} will be retried: {e}")
+                # The later blocks of the enrollment wait too, the order of the days is kept
+                retry_ids += [later.delivery_id for later in blocks[i:]]
+                break
+            except Exception:
+                logger.exception(f"❌ Error sending block to {block.telegram_id}")
+                failed_ids.append(block.delivery_id)
+                continue
+            finally:
+                if progress.add(block.user_id, [lesson.id for lesson in sent]):
+                    await progress.flush()
+
+        sent_ids.append(block.delivery_id)
+
+        if block.is_last:
             # Уроків більше немає!
             # Викликаємо спеціальну функцію завершення для Мульти-бота
-            # Передаємо enrollment, щоб знати, ЩО саме закривати
-            await finish_course(bot, enrollment, dp=dp)
+            await finish_course(bot, block.enrollment_id, block.telegram_id, block.finish_message, dp=dp)
+
+    return sent_ids, failed_ids, retry_ids
+
+
+async def check_and_send_lessons(bot: Bot, dp: Dispatcher = None, now: datetime = None, limit: int = CLAIM_BATCH_SIZE) -> int:
+    """
+    One tick: sends every due block. Returns how many blocks were claimed.
+    """
+    now = now or clock.now()
+
+    # Row locks need a transaction, which the async ORM does not have yet - runs in a thread
+    blocks = await sync_to_async(claim_due_blocks)(now, limit)
+
+    if not blocks:
+        return 0
 
+    # Blocks of one user go one after another, different users - in parallel.
+    # The send pipeline takes care of the Telegram limits.
+    by_enrollment = {}
+    for block in blocks:
+        by_enrollment.setdefault(block.enrollment_id, []).append(block)
 
+    # Progress rows of the whole tick are written in a few bulk INSERTs
+    progress = ProgressRecorder()
+    heartbeat = asyncio.create_task(keep_claims_alive([block.delivery_id for block in blocks]))
+    try:
+        results = await asyncio.gather(*(
+            deliver_blocks(bot, dp, enrollment_blocks, progress) for enrollment_blocks in by_enrollment.values()
+        ))
+    finally:
+        heartbeat.cancel()
+        await progress.flush()
 
+    sent_ids, failed_ids, retry_ids = [], [], []
+    for sent, failed, retry in results:
+        sent_ids += sent
+        failed_ids += failed
+        retry_ids += retry
 
+    await mark_deliveries(sent_ids, 'sent')
+    await mark_deliveries(failed_ids, 'failed')
+    if retry_ids:
+        await retry_deliveries(retry_ids, now)
+        # The retry time is a new deadline for this process
+        scheduler.wake()
+    return len(blocks)
 
-async def scheduler_loop(bot: Bot):
+
+async def drain_backlog(bot: Bot, dp: Dispatcher = None):
     """
-    Вічний цикл планувальника.
+    Sends the missed deliveries in small batches with a pause between them.
     """
-    # 1. Перевірка уроків — кожну хвилину
-    schedule.every(1).minutes.do(lambda: asyncio.create_task(check_and_send_lessons(bot)))
+    while True:
+        now = clock.now()
+        claimed = await check_and_send_lessons(bot, dp, now, limit=SCHEDULER_CATCHUP_BATCH)
+        await save_watermark(now)
+        if claimed < SCHEDULER_CATCHUP_BATCH:
+            return
+        await asyncio.sleep(SCHEDULER_CATCHUP_PAUSE)
 
-    logger.info("🚀 Scheduler started!")
 
-    while True:
-        schedule.run_pending()
-        await asyncio.sleep(1)
\ No newline at end of file
+class DeliveryScheduler:
+    """
+    Event-driven scheduler core.
+    Keeps a heap of the next due_at values from the plan and sleeps exactly until
+    the nearest one. wake() interrupts the sleep when the plan changes
+    (a user enrolled, an admin edited a lesson).
+    """
+    # How many upcoming deadlines are loaded at once
+    PREFETCH = 100
+    # Safety net: re-read the plan at least this often even without events
+    MAX_IDLE_SECONDS = 600
+
+    def __init__(self):
+        self._deadlines = []
+        self._stale = False
+        self._wakeup = asyncio.Event()
+        self._watermark_saved = None
+
+    def wake(self, *args):
+        # The plan changed - the loop re-reads the deadlines. Called from the event listener task,
+        # so the heap itself is only ever touched by the loop.
+        self._stale = True
+        self._wakeup.set()
+
+    async def load_deadlines(self) -> list[datetime]:
+        return [
+            due_at async for due_at in
+            ScheduledDelivery.objects
+            .filter(status='pending', enrollment__is_active=True)
+            .order_by('due_at')
+            .values_list('due_at', flat=True)
+            .distinct()[:self.PREFETCH]
+        ]
+
+    async def _sleep(self, seconds: float) -> bool:
+        """
+        Returns True if woken up by an event before the timeout.
+        """
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            return False
+        self._wakeup.clear()
+        return True
+
+    async def catch_up(self, bot: Bot, dp: Dispatcher = None):
+        if await sync_to_async(recover_backlog)(clock.now()):
+            await drain_backlog(bot, dp)
+        self._deadlines = []
+
+    async def run(self, bot: Bot, dp: Dispatcher = None):
+        logger.info("🚀 Scheduler started!")
+
+        # Whatever was missed while the bot was down
+        await self.catch_up(bot, dp)
+
+        while True:
+            try:
+                if self._stale or not self._deadlines:
+                    self._stale = False
+                    self._deadlines = await self.load_deadlines()
+                    heapq.heapify(self._deadlines)
+
+                now = clock.now()
+                if not self._deadlines or (self._deadlines[0] - now).total_seconds() > self.MAX_IDLE_SECONDS:
+                    # Nothing due soon: sleep until an event or the safety re-check
+                    await self._sleep(self.MAX_IDLE_SECONDS)
+                    self._deadlines = []
+                    continue
+
+                delay = (self._deadlines[0] - now).total_seconds()
+                if delay > 0 and (await self._sleep(delay) or self._stale):
+                    continue
+
+                # Late only by what happened since the loop was free: a deadline that came due
+                # while the previous batch was being sent is not a stall
+                late = clock.now() - max(self._deadlines[0], now)
+                now = clock.now()
+                if late.total_seconds() > STALL_SECONDS:
+                    # The loop (or the database) was stuck - same as a restart
+                    logger.warning(f"⚠️ Scheduler stalled, late by {late}")
+                    await self.catch_up(bot, dp)
+                    continue
+
+                while self._deadlines and self._deadlines[0] <= now:
+                    heapq.heappop(self._deadlines)
+
+                claimed = await check_and_send_lessons(bot, dp, now)
+                if self._watermark_saved is None or (now - self._watermark_saved).total_seconds() >= WATERMARK_EVERY:
+                    # Not every tick: the watermark only has to show where a restart left off
+                    await save_watermark(now)
+                    self._watermark_saved = now
+                await dbpool.release()
+                if claimed >= CLAIM_BATCH_SIZE:
+                    # More work is waiting - run the next tick right away
+                    heapq.heappush(self._deadlines, now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"❌ Scheduler tick failed: {e}")
+                self._deadlines = []
+                await asyncio.sleep(5)
+
+
+# One scheduler per bot process
+scheduler = DeliveryScheduler()
+
+
+async def scheduler_loop(bot: Bot, dp: Dispatcher = None):
+    """
+    Вічний цикл планувальника.
+    """
+    await scheduler.run(bot, dp)
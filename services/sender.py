@@ -1,58 +1,56 @@
+import logging
 import os
 from aiogram import Bot
-from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from core.models import  Lesson
+from services.catalog import LessonRecord
+from services.media import MEDIA_FIELDS, send_media
+from services.pipeline import pipeline
+
+logger = logging.getLogger(__name__)
 
 def get_answer_btn(lesson_id):
     builder = InlineKeyboardBuilder()
     builder.button(text="✍️ Написать ответ", callback_data=f"reply_task:{lesson_id}")    
     return builder.as_markup()
 
-async def send_lesson_block(bot: Bot, user, course, lessons):
+async def send_lesson_block(bot: Bot, chat_id: int, course_title: str, lessons, sent: list = None):
     """
     Відправляє заголовок, а потім уроки.
+    Errors are raised; `sent` collects the lessons that got through before (only they count as delivered).
     """
     
     header_text = (
         f"🔔 <b>Уроки на {lessons[0].send_time.strftime('%H:%M')}</b>\n"
-        f"📚 Курс: <b>{course.title}</b>\n"
+        f"📚 Курс: <b>{course_title}</b>\n"
         f"🗓 День: {lessons[0].day_number}"
     )
 
-    try:
-        await bot.send_message(user.telegram_id, header_text, parse_mode="HTML")
-    except Exception as e:
-        print(f"❌ Не удалось отправить заголовок юзеру {user.telegram_id}: {e}")
-        return
+    await pipeline.send(chat_id, bot.send_message, chat_id, header_text, parse_mode="HTML")
 
     for lesson in lessons:
-        await send_lesson(bot, user.telegram_id, lesson)
+        await send_lesson(bot, chat_id, lesson)
+        if sent is not None:
+            sent.append(lesson)
 
-async def send_lesson(bot: Bot, chat_id: int, lesson: Lesson):
+async def send_lesson(bot: Bot, chat_id: int, lesson: LessonRecord):
     # Media dispatch
-    try:
-        if lesson.image:
-            await bot.send_photo(chat_id, FSInputFile(lesson.image.path))
-        if lesson.audio:
-            await bot.send_audio(chat_id, FSInputFile(lesson.audio.path))
-        if lesson.video_note:
-            await bot.send_video_note(chat_id, FSInputFile(lesson.video_note.path))
-        if lesson.file_doc:
-            await bot.send_document(chat_id, FSInputFile(lesson.file_doc.path))
-    except Exception as e:
-        print(f"⚠️ Ошибка медиа: {e}")
+    # (uploaded once, then sent by the cached Telegram file_id)
+    for field in MEDIA_FIELDS:
+        if getattr(lesson, field):
+            try:
+                await send_media(bot, chat_id, lesson, field)
+            except Exception as e:
+                logger.warning(f"⚠️ Lesson {lesson.id}: {field} not sent to {chat_id}: {e}")
+                raise
 
     # Forming the KEYBOARD
     keyboard = None
     
     # OPTION A: This is a QUIZ (test)
     if lesson.lesson_type == 'quiz' and lesson.quiz_options:
-        options = lesson.quiz_options.splitlines() 
         buttons = []
-        for opt in options:
-            opt = opt.strip()
-            if not opt: continue
+        for opt in lesson.quiz_options:
             short_opt = opt[:20]
             cb_data = f"ans:{lesson.id}:{short_opt}" 
             buttons.append([InlineKeyboardButton(text=opt, callback_data=cb_data)])
@@ -73,12 +71,4 @@ async def send_lesson(bot: Bot, chat_id: int, lesson: Lesson):
         else:
             text_to_send = "Материал урока:"
        
-    try:
-        await bot.send_message(chat_id, text_to_send, reply_markup=keyboard)
-        return True
-    except Exception as e:
-        print(f"❌ Не удалось отправить сообщение: {e}")
-        return False
-    
-
-    
+    await pipeline.send(chat_id, bot.send_message, chat_id, text_to_send, reply_markup=keyboard)
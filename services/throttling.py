@@ -0,0 +1,162 @@
+import asyncio
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from django.db import transaction
+from redis.asyncio import Redis
+
+from config import MISSING_CODE_TTL, THROTTLE_RULES
+from services import events
+from states import Learning, Registration
+
+logger = logging.getLogger(__name__)
+
+BUCKET = "throttle:{}:{}"       # group, user id
+MISSING_CODE = "nocode:{}"
+
+# Token bucket in one atomic step, shared by all processes. Time comes from the Redis server,
+# so workers with skewed clocks still agree. Returns {allowed, retry_after_ms, warn}:
+# warn is 1 only for the first rejected update in a row - the user is told once, not per update.
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'warned')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+
+local allowed, retry, warn = 0, 0, 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now, 'warned', 0)
+else
+    retry = math.ceil((1 - tokens) * 1000 / rate)
+    if bucket[3] ~= '1' then warn = 1 end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now, 'warned', 1)
+end
+-- A full bucket is the same as no bucket: the key lives only while it is refilling
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {allowed, retry, warn}
+"""
+
+
+def group_of(update: Update, raw_state: str | None) -> str:
+    """
+    Which bucket the update spends from. Only the state and callback data are used - no DB.
+    """
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        return 'answer' if data.startswith(("ans:", "reply_task:")) else 'default'
+    if update.message:
+        if raw_state == Registration.waiting_for_access_code.state:
+            return 'code'
+        if raw_state == Learning.waiting_for_text_answer.state:
+            return 'answer'
+    return 'default'
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer update middleware: a flooding user's updates are dropped before any handler (and ORM) runs.
+    The first dropped update gets a short reply, the next ones are silent.
+    If Redis is unavailable, updates pass (anti-flood must not take the bot down).
+    """
+
+    def __init__(self, redis: Redis, rules: dict = THROTTLE_RULES):
+        self.rules = rules
+        self._bucket = redis.register_script(TOKEN_BUCKET)
+        self.allowed = {group: 0 for group in rules}
+        self.throttled = {group: 0 for group in rules}
+        self.errors = 0
+
+    async def __call__(self, handler, event: Update, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        group = group_of(event, data.get("raw_state"))
+        rate, burst = self.rules[group]
+        try:
+            allowed, retry_ms, warn = await self._bucket(keys=[BUCKET.format(group, user.id)], args=[rate, burst])
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Throttling: Redis error, update passes: {e}")
+            return await handler(event, data)
+
+        if allowed:
+            self.allowed[group] += 1
+            return await handler(event, data)
+
+        self.throttled[group] += 1
+        seconds = max(1, round(retry_ms / 1000))
+        if event.callback_query:
+            # A callback must be answered anyway, otherwise the button keeps spinning
+            await event.callback_query.answer(f"⏳ Слишком часто! Подожди {seconds} с." if warn else None)
+        elif warn and event.message:
+            await event.message.answer(f"⏳ Слишком много попыток. Попробуй снова через {seconds} с.")
+
+    def stats(self) -> dict:
+        return {
+            'allowed': dict(self.allowed),
+            'throttled': dict(self.throttled),
+            'missing_code_hits': missing_codes.hits,
+            'redis_errors': self.errors,
+        }
+
+    async def report_loop(self, every: int = 300):
+        while True:
+            await asyncio.sleep(every)
+            logger.info(f"🚦 Throttling: {self.stats()}")
+
+
+class MissingCodes:
+    """
+    Negative cache of access codes that were tried recently and don't exist:
+    a repeated guess is answered without the activation transaction.
+    Works only after connect() (bot process); without Redis every code goes to the DB.
+    """
+
+    def __init__(self, ttl: int = MISSING_CODE_TTL):
+        self.ttl = ttl
+        self.redis = None
+        self.hits = 0
+
+    def connect(self, redis: Redis):
+        self.redis = redis
+
+    async def is_missing(self, code: str) -> bool:
+        if self.redis is None:
+            return False
+        try:
+            missing = await self.redis.exists(MISSING_CODE.format(code))
+        except Exception:
+            return False
+        if missing:
+            self.hits += 1
+        return bool(missing)
+
+    async def remember(self, code: str):
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(MISSING_CODE.format(code), 1, ex=self.ttl)
+        except Exception:
+            pass
+
+
+missing_codes = MissingCodes()
+
+
+def forget_missing_codes(codes):
+    """
+    New codes were created (admin, generation, import): they must not stay cached as missing.
+    Runs after the commit, best effort - at worst a code is refused for MISSING_CODE_TTL.
+    """
+    keys = [MISSING_CODE.format(code) for code in codes]
+    if keys:
+        transaction.on_commit(lambda: events.run_sync("сброс кэша кодов", lambda redis: redis.delete(*keys)))
@@ -0,0 +1,162 @@
+import statistics
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+from django.utils import timezone
+
+from core.models import SupportMessage, SupportTicket
+
+# (support group message) -> ticket. Every forwarded question and every curator answer is indexed,
+# so a reply to any message of the thread finds the student without parsing the text.
+TicketRef = namedtuple('TicketRef', ['ticket_id', 'telegram_id'])
+CuratorStats = namedtuple('CuratorStats', ['curator_id', 'name', 'tickets', 'avg', 'median', 'worst'])
+
+# The hot part of the index stays in memory; older messages are found by the unique index in the DB
+INDEX_SIZE = 50_000
+STATS_DAYS = 30
+
+_index = OrderedDict()      # (chat_id, message_id) -> TicketRef, LRU order
+
+hits = 0
+misses = 0
+
+
+def _remember(chat_id: int, message_id: int, ref: TicketRef):
+    _index[(chat_id, message_id)] = ref
+    _index.move_to_end((chat_id, message_id))
+    if len(_index) > INDEX_SIZE:
+        _index.popitem(last=False)
+
+
+def invalidate():
+    global hits, misses
+    _index.clear()
+    hits = misses = 0
+
+
+async def open_ticket(user_id: int) -> tuple[int, bool]:
+    """
+    Returns (ticket_id, created): the student's open ticket, or a new one.
+    The partial unique constraint keeps it at one open ticket even with parallel messages.
+    """
+    ticket, created = await SupportTicket.objects.aget_or_create(user_id=user_id, status='open')
+    return ticket.id, created
+
+
+async def discard_ticket(ticket_id: int):
+    """
+    Removes a ticket whose first question never reached the support group,
+    so an empty ticket does not stay open and count in the stats.
+    """
+    await SupportTicket.objects.filter(id=ticket_id, status='open', messages__isnull=True).adelete()
+
+
+async def link_message(ref: TicketRef, chat_id: int, message_id: int, direction: str,
+                       author_id: int, author_name: str = '', text: str = ''):
+    """
+    Saves a support group message as part of the ticket and puts it into the index.
+    """
+    await SupportMessage.objects.acreate(
+        ticket_id=ref.ticket_id, chat_id=chat_id, message_id=message_id, direction=direction,
+        author_id=author_id, author_name=author_name or '', text=text or '',
+    )
+    _remember(chat_id, message_id, ref)
+
+
+async def resolve(chat_id: int, message_id: int) -> TicketRef | None:
+    """
+    Finds the ticket of a support group message: a dict lookup, after a restart - one indexed query.
+    None if the message does not belong to any ticket.
+    """
+    global hits, misses
+    ref = _index.get((chat_id, message_id))
+    if ref is not None:
+        hits += 1
+        _index.move_to_end((chat_id, message_id))
+        return ref
+
+    misses += 1
+    row = await (
+        SupportMessage.objects.filter(chat_id=chat_id, message_id=message_id)
+        .values_list('ticket_id', 'ticket__user__telegram_id')
+        .afirst()
+    )
+    if row is None:
+        return None
+    ref = TicketRef(*row)
+    _remember(chat_id, message_id, ref)
+    return ref
+
+
+async def record_answer(ref: TicketRef, chat_id: int, message_id: int, curator_id: int,
+                        curator_name: str = '', text: str = ''):
+    """
+    A curator answered the ticket: the answer joins the thread, the first answer sets the response time.
+    """
+    await link_message(ref, chat_id, message_id, 'out', curator_id, curator_name, text)
+    # Only the first answer wins, also when two curators answer at the same moment
+    await SupportTicket.objects.filter(id=ref.ticket_id, first_response_at__isnull=True).aupdate(
+        first_response_at=timezone.now(),
+        first_responder_id=curator_id,
+        first_responder_name=curator_name or '',
+    )
+
+
+async def close_ticket(ticket_id: int) -> bool:
+    """
+    Closes the ticket. False if it was already closed. The next message of the student opens a new one.
+    """
+    updated = await SupportTicket.objects.filter(id=ticket_id, status='open').aupdate(
+        status='closed', closed_at=timezone.now()
+    )
+    return updated > 0
+
+
+async def curator_stats(days: int = STATS_DAYS) -> list[CuratorStats]:
+    """
+    First response time per curator for tickets opened in the last `days` days, fastest first.
+    """
+    since = timezone.now() - timedelta(days=days)
+    rows = SupportTicket.objects.filter(created_at__gte=since, first_response_at__isnull=False).values_list(
+        'first_responder_id', 'first_responder_name', 'created_at', 'first_response_at'
+    )
+
+    times = {}
+    names = {}
+    async for curator_id, name, created_at, answered_at in rows:
+        times.setdefault(curator_id, []).append(answered_at - created_at)
+        names[curator_id] = name
+
+    stats = []
+    for curator_id, durations in times.items():
+        durations.sort()
+        stats.append(CuratorStats(
+            curator_id=curator_id,
+            name=names[curator_id],
+            tickets=len(durations),
+            avg=sum(durations, timedelta()) / len(durations),
+            median=statistics.median(durations),
+            worst=durations[-1],
+        ))
+    stats.sort(key=lambda item: item.median)
+    return stats
+
+
+async def waiting_count() -> tuple[int, int]:
+    """
+    (open tickets, open tickets without any answer yet).
+    """
+    open_tickets = SupportTicket.objects.filter(status='open')
+    return await open_tickets.acount(), await open_tickets.filter(first_response_at__isnull=True).acount()
+
+
+def format_duration(value: timedelta) -> str:
+    seconds = int(value.total_seconds())
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин"
+    hours, minutes = divmod(seconds // 60, 60)
+    if hours < 48:
+        return f"{hours} ч {minutes} мин"
+    return f"{hours // 24} д {hours % 24} ч"
@@ -0,0 +1,349 @@
+import asyncio
+import json
+import logging
+import math
+import time
+import zlib
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+from config import (
+    SCHEDULER_WORKER_ID, UPDATE_CONCURRENCY, UPDATE_HANDLE_TIMEOUT, UPDATE_LEASE_SECONDS, UPDATE_PARTITIONS,
+    UPDATE_STREAM_MAX_MB,
+)
+
+logger = logging.getLogger(__name__)
+
+# updates:<partition> - the stream, updates:owner:<partition> - which worker reads it now,
+# updates:workers - live workers (zset, score = last heartbeat)
+STREAM = "updates:{}"
+OWNER = "updates:owner:{}"
+WORKERS = "updates:workers"
+GROUP = "bot"
+READ_COUNT = 100
+READ_BLOCK_MS = 1000
+# Stream bookkeeping per entry on top of the update JSON (id, field names, listpack headers)
+ENTRY_OVERHEAD = 50
+MIN_MAXLEN = 1000
+
+# Renew/release only our own lease: another worker may have taken it after we stalled
+RENEW_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def partition_of(user_id: int, partitions: int = UPDATE_PARTITIONS) -> int:
+    # Stable across processes and restarts (unlike hash())
+    return zlib.crc32(str(user_id).encode()) % partitions
+
+
+class OrderedDispatcher(Dispatcher):
+    """
+    Polling and webhook handle every update in its own task, so two quick updates of one user
+    would overlap: both read the FSM state before either wrote it. Here the updates of a user pass
+    feed_update one after another, in arrival order - before aiogram reads the state and until the
+    update's FSM writes are flushed. Different users still run in parallel.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._users = {}        # user key -> [lock, updates holding or waiting for it]
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs):
+        context = UserContextMiddleware.resolve_event_context(update)
+        key = context.user.id if context.user else context.chat.id if context.chat else None
+        if key is None:
+            return await super().feed_update(bot, update, **kwargs)
+
+        slot = self._users.setdefault(key, [asyncio.Lock(), 0])
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                return await super().feed_update(bot, update, **kwargs)
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._users[key]
+
+
+class IngestMiddleware(BaseMiddleware):
+    """
+    Receiving side (polling/webhook): every update is appended to the stream of its user's partition
+    instead of being handled here. Workers (BOT_ROLE=worker) handle it.
+
+    Streams have no TTL and Redis never evicts (noeviction), so they are kept within `max_mb`:
+    the length cap follows the average size of the appended updates.
+    """
+
+    def __init__(self, redis: Redis, partitions: int = UPDATE_PARTITIONS, max_mb: float = UPDATE_STREAM_MAX_MB):
+        self.redis = redis
+        self.partitions = partitions
+        self.budget = max_mb * 1024 * 1024 / partitions     # bytes per partition
+        self.entry_size = 1024.0                            # moving average, bytes
+        self.appended = 0
+
+    @property
+    def maxlen(self) -> int:
+        return max(MIN_MAXLEN, int(self.budget / self.entry_size))
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        # Updates without a user (rare: channel posts etc.) go by chat, otherwise anywhere
+        key = user.id if user else chat.id if chat else event.update_id
+        stream = STREAM.format(partition_of(key, self.partitions))
+        payload = event.model_dump_json(by_alias=True, exclude_none=True)
+        self.entry_size += (len(payload) + ENTRY_OVERHEAD - self.entry_size) / 100
+        await self.redis.xadd(stream, {'u': payload, 'k': str(key)}, maxlen=self.maxlen, approximate=True)
+        self.appended += 1
+
+
+class UpdateConsumer:
+    """
+    Worker side. Partitions are spread over the live workers with leases; only the owner of a partition
+    reads its stream, and inside the worker the updates of one user run one after another,
+    so FSM transitions of a user stay ordered. Different users run in parallel (up to `concurrency`).
+
+    When a worker crashes, its lease expires, another worker takes the partition over and
+    claims the entries the dead worker had read but not acknowledged (XAUTOCLAIM). A worker that only
+    stalled may still be running some of them: it starts nothing after its lease ran out (and doesn't
+    acknowledge what it skipped), and handlers are cut at `handle_timeout`. So the new owner waits
+    `handle_timeout` before claiming - no entry is handled by two workers at once.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, redis: Redis, consumer: str = SCHEDULER_WORKER_ID,
+                 partitions: int = UPDATE_PARTITIONS, lease: float = UPDATE_LEASE_SECONDS,
+                 concurrency: int = UPDATE_CONCURRENCY, handle_timeout: float = UPDATE_HANDLE_TIMEOUT):
+        self.dp = dp
+        self.bot = bot
+        self.redis = redis
+        self.consumer = consumer
+        self.partitions = partitions
+        self.lease_ms = int(lease * 1000)
+        self.handle_timeout = handle_timeout
+        self._slots = asyncio.Semaphore(concurrency)
+        # Read ahead at most this many updates (they wait in memory for their user's previous ones)
+        self.max_in_flight = concurrency * 2
+        self._renew = redis.register_script(RENEW_LEASE)
+        self._release = redis.register_script(RELEASE_LEASE)
+
+        self.owned = set()          # partitions we read
+        self._draining = set()      # given away, waiting for their in-flight updates
+        self._taking_over = {}      # leased, not read yet: partition -> when its pending entries may be claimed
+        self._lease_until = {}      # partition -> monotonic time our lease surely lasts until
+        self._in_flight = {}        # partition -> number of unfinished updates
+        self._tails = {}            # user key -> last scheduled task of this user
+        self._stopped = asyncio.Event()
+        self._next_balance = 0.0
+
+        self.handled = 0
+        self.failed = 0
+        self.reclaimed = 0
+        self.skipped = 0
+
+    # --- Partitions ---
+
+    async def ensure_groups(self):
+        for partition in range(self.partitions):
+            try:
+                await self.redis.xgroup_create(STREAM.format(partition), GROUP, id='0', mkstream=True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    async def balance(self):
+        """
+        Heartbeat, renew own leases, give away extra partitions and take free ones up to a fair share.
+        """
+        now = time.time()
+        await self.redis.zadd(WORKERS, {self.consumer: now})
+        await self.redis.zremrangebyscore(WORKERS, 0, now - self.lease_ms / 1000)
+        workers = max(await self.redis.zcard(WORKERS), 1)
+        fair = math.ceil(self.partitions / workers)
+
+        for partition in self.owned | self._draining | set(self._taking_over):
+            started = time.monotonic()
+            if await self._renew(keys=[OWNER.format(partition)], args=[self.consumer, self.lease_ms]):
+                self._lease_until[partition] = started + self.lease_ms / 1000
+            else:
+                # Lost it (we stalled longer than the lease) - the new owner goes on from the stream
+                logger.warning(f"⚠️ Updates: partition {partition} lost")
+                self.owned.discard(partition)
+                self._draining.discard(partition)
+                self._taking_over.pop(partition, None)
+                self._lease_until.pop(partition, None)
+
+        # Too many (a new worker joined): stop reading, hand over once in-flight updates are done
+        while len(self.owned) > fair:
+            self.owned.remove(partition := max(self.owned))
+            self._draining.add(partition)
+        for partition in list(self._draining):
+            if not self._in_flight.get(partition):
+                await self._release(keys=[OWNER.format(partition)], args=[self.consumer])
+                self._draining.discard(partition)
+                self._lease_until.pop(partition, None)
+
+        for partition, ready_at in list(self._taking_over.items()):
+            if time.monotonic() >= ready_at:
+                await self.reclaim(partition)
+                # Entries the old owner read while its lease was running out become idle enough a bit later
+                if not await self._pending(partition, others=True):
+                    del self._taking_over[partition]
+                    self.owned.add(partition)
+
+        for partition in range(self.partitions):
+            if len(self.owned) + len(self._taking_over) >= fair:
+                break
+            if (partition in self.owned or partition in self._draining or partition in self._taking_over
+                    or self._in_flight.get(partition)):
+                continue
+            started = time.monotonic()
+            if await self.redis.set(OWNER.format(partition), self.consumer, nx=True, px=self.lease_ms):
+                self._lease_until[partition] = started + self.lease_ms / 1000
+                if await self._pending(partition):
+                    # Read, not acknowledged: its reader crashed or is stalled and may still be running them
+                    self._taking_over[partition] = time.monotonic() + self.handle_timeout
+                else:
+                    self.owned.add(partition)
+
+        self._next_balance = time.monotonic() + self.lease_ms / 3000
+
+    async def _pending(self, partition: int, others: bool = False) -> int:
+        summary = await self.redis.xpending(STREAM.format(partition), GROUP)
+        if not others:
+            return summary['pending']
+        return sum(
+            consumer['pending'] for consumer in summary['consumers'] if consumer['name'] != self.consumer.encode()
+        )
+
+    def _holds(self, partition: int) -> bool:
+        # Checked locally: after a stall the lease may be gone before balance() notices it
+        return time.monotonic() < self._lease_until.get(partition, 0)
+
+    async def reclaim(self, partition: int):
+        """
+        Takes over entries that the previous owner read but never acknowledged (it crashed or stalled),
+        also our own ones from before a restart. Only entries idle for `handle_timeout`: anything
+        the previous owner could still be handling is newer than that.
+        """
+        stream = STREAM.format(partition)
+        min_idle = int(self.handle_timeout * 1000)
+        start = '0-0'
+        while True:
+            start, entries, *_ = await self.redis.xautoclaim(
+                stream, GROUP, self.consumer, min_idle, start_id=start, count=READ_COUNT,
+            )
+            entries = [entry for entry in entries if entry[1]]      # trimmed entries come back empty
+            for entry_id, fields in entries:
+                self.schedule(partition, entry_id, fields)
+            self.reclaimed += len(entries)
+            if start in (b'0-0', '0-0'):
+                break
+
+    # --- Handling ---
+
+    def schedule(self, partition: int, entry_id, fields: dict):
+        user_key = fields[b'k']
+        update = json.loads(fields[b'u'])
+        previous = self._tails.get(user_key)
+        task = asyncio.create_task(self._handle(previous, partition, entry_id, update))
+        self._tails[user_key] = task
+        self._in_flight[partition] = self._in_flight.get(partition, 0) + 1
+
+        def done(_):
+            self._in_flight[partition] -= 1
+            if self._tails.get(user_key) is task:
+                del self._tails[user_key]
+
+        task.add_done_callback(done)
+
+    async def _handle(self, previous, partition: int, entry_id, update: dict):
+        if previous is not None:
+            # The previous update of this user first (its errors are its own)
+            await asyncio.wait([previous])
+        async with self._slots:
+            if not self._holds(partition):
+                # The partition has (or is about to get) another owner: it handles the entry, so no ack
+                self.skipped += 1
+                return
+            try:
+                await asyncio.wait_for(self.dp.feed_raw_update(self.bot, update), self.handle_timeout)
+                self.handled += 1
+            except Exception:
+                # A broken (or hung) update is not retried forever: logged and acknowledged
+                self.failed += 1
+                logger.exception(f"❌ Update {update.get('update_id')} failed")
+        await self.redis.xack(STREAM.format(partition), GROUP, entry_id)
+
+    async def run(self):
+        await self.ensure_groups()
+        logger.info(f"📥 Update worker {self.consumer}: {self.partitions} partitions")
+        try:
+            while not self._stopped.is_set():
+                if time.monotonic() >= self._next_balance:
+                    await self.balance()
+                readable = sorted(partition for partition in self.owned if self._holds(partition))
+                if not readable:
+                    await asyncio.sleep(self.lease_ms / 3000)
+                    continue
+
+                # Don't read more than we can handle
+                room = self.max_in_flight - sum(self._in_flight.values())
+                if room <= 0:
+                    await asyncio.sleep(0.05)
+                    continue
+                response = await self.redis.xreadgroup(
+                    GROUP, self.consumer, {STREAM.format(partition): '>' for partition in readable},
+                    count=min(READ_COUNT, room), block=READ_BLOCK_MS,
+                )
+                for stream, entries in response or []:
+                    partition = int(stream.rsplit(b':', 1)[1])
+                    for entry_id, fields in entries:
+                        self.schedule(partition, entry_id, fields)
+        finally:
+            await self.shutdown()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def shutdown(self):
+        """
+        Finishes what was read and gives the partitions back right away (no waiting for lease expiry).
+        """
+        if self._tails:
+            await asyncio.wait(list(self._tails.values()))
+        for partition in self.owned | self._draining | set(self._taking_over):
+            await self._release(keys=[OWNER.format(partition)], args=[self.consumer])
+        self.owned.clear()
+        self._draining.clear()
+        self._taking_over.clear()
+        self._lease_until.clear()
+        await self.redis.zrem(WORKERS, self.consumer)
+
+    def stats(self) -> dict:
+        return {
+            'partitions': sorted(self.owned),
+            'in_flight': sum(self._in_flight.values()),
+            'handled': self.handled,
+            'failed': self.failed,
+            'reclaimed': self.reclaimed,
+            'skipped': self.skipped,
+        }
+
+    async def report_loop(self, every: int = 300):
+        while True:
+            await asyncio.sleep(every)
+            logger.info(f"📥 Update worker: {self.stats()}")
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (
+    DROP_PENDING_UPDATES, UPDATE_CONCURRENCY, WEBHOOK_BASE_URL, WEBHOOK_HOST,
+    WEBHOOK_MAX_CONNECTIONS, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Acks the update right away and handles it in a background task (Telegram does not wait for the
+    handlers), but at most `concurrency` updates are handled at once. When all slots are busy,
+    the ack waits for a free one - Telegram then holds back further updates instead of the bot
+    piling up tasks in memory.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, concurrency: int = UPDATE_CONCURRENCY, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._slots = asyncio.Semaphore(concurrency)
+        self.received = 0
+        self.rejected = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.bot):
+            self.rejected += 1
+            return web.Response(body="Unauthorized", status=401)
+
+        await self._slots.acquire()
+        try:
+            update = await request.json(loads=self.bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            return web.Response(body="Bad Request", status=400)
+
+        self.received += 1
+        task = asyncio.create_task(self._background_feed_update(bot=self.bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return web.json_response({}, dumps=self.bot.session.json_dumps)
+
+    __call__ = handle
+
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'in_progress': len(self._background_feed_update_tasks),
+        }
+
+
+def build_app(dp: Dispatcher, bot: Bot, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+              concurrency: int = UPDATE_CONCURRENCY) -> web.Application:
+    """
+    aiohttp application: POST `path` -> dispatcher, GET /healthz for the load balancer.
+    """
+    app = web.Application()
+    handler = LimitedRequestHandler(dp, bot, concurrency=concurrency, secret_token=secret or None)
+    handler.register(app, path=path)
+    app['webhook_handler'] = handler
+
+    async def healthz(request):
+        return web.json_response(handler.stats())
+
+    app.router.add_get('/healthz', healthz)
+    # Runs dp startup/shutdown hooks together with the web app
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, allowed_updates: list[str] = None):
+    """
+    Registers the webhook with Telegram and serves updates until cancelled.
+    """
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_BASE_URL (публичный https-адрес бота)")
+    if not WEBHOOK_SECRET:
+        logger.warning("⚠️ WEBHOOK_SECRET не задан: вебхук примет запросы от кого угодно")
+
+    app = build_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    await bot.set_webhook(
+        url=WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=allowed_updates if allowed_updates is not None else dp.resolve_used_update_types(),
+        drop_pending_updates=DROP_PENDING_UPDATES,
+    )
+    logger.info(f"🌐 Webhook: {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, до {UPDATE_CONCURRENCY} апдейтов параллельно")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # The webhook stays registered: a restarted (or another) instance keeps receiving updates
+        await runner.cleanup()
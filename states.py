@@ -8,4 +8,7 @@ class Learning(StatesGroup):
     waiting_for_text_answer = State()
 
 class Support(StatesGroup):
-    waiting_for_message = State()
\ No newline at end of file
+    waiting_for_message = State()
+
+class Faq(StatesGroup):
+    waiting_for_query = State()
\ No newline at end of file